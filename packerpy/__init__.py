@@ -15,63 +15,191 @@ Quick start::
     MyBuilder("my-build").run()
 """
 
-from packerpy.builder import PackerBuilder
-from packerpy.client import PackerClient
+from __future__ import annotations
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
 from packerpy.exceptions import PackerBuildError, PackerClientError
-from packerpy.models import (
-    AmazonEbs,
-    AzureArmBuilder,
-    Builder,
-    BuilderResource,
-    BuilderSourceConfig,
-    DockerBuilder,
-    DockerImport,
-    DockerPush,
-    DockerTag,
-    EmptyBuilderSourceConfig,
-    EmptyPostProcessor,
-    EmptyProvisioner,
-    FileProvisioner,
-    GoogleComputeBuilder,
-    Manifest,
-    PackerConfig,
-    PackerResource,
-    Plugin,
-    PostProcessor,
-    Provisioner,
-    Requirements,
-    ShellLocalProvisioner,
-    ShellProvisioner,
-    SupportingType,
-)
+
+if TYPE_CHECKING:
+    from packerpy.builder import PackerBuilder
+    from packerpy.checkpoints import CheckpointStore
+    from packerpy.client import PackerClient
+    from packerpy.fleet import AdaptiveConcurrency, ConcurrencyController, DurationHistory, Fleet
+    from packerpy.journal import BuildJournal
+    from packerpy.models import (
+        AmazonEbs,
+        AzureArmBuilder,
+        Builder,
+        BuilderResource,
+        BuilderSourceConfig,
+        DockerBuilder,
+        DockerImport,
+        DockerPush,
+        DockerTag,
+        EmptyBuilderSourceConfig,
+        EmptyPostProcessor,
+        EmptyProvisioner,
+        FileProvisioner,
+        GoogleComputeBuilder,
+        Manifest,
+        PackerConfig,
+        PackerResource,
+        Plugin,
+        PostProcessor,
+        Provisioner,
+        Requirements,
+        ShellLocalProvisioner,
+        ShellProvisioner,
+        SupportingType,
+    )
+    from packerpy.optimizers import (
+        FileBundleOptimizer,
+        ShellFusionOptimizer,
+        SourceOverrideOptimizer,
+        TemplateOptimizer,
+    )
+    from packerpy.output import (
+        CancellationGroup,
+        ErrorsOnlyLoggingPolicy,
+        FatalPatternDetector,
+        LogFileSink,
+        LoggingPolicy,
+        NdjsonLogWriter,
+        NdjsonSink,
+        OutputSink,
+        RateLimitedLoggingPolicy,
+        SampledLoggingPolicy,
+        SecretRedactor,
+        ThrottleSink,
+    )
+    from packerpy.profiling import PhaseProfiler
+    from packerpy.resources import ProcessTreeMonitor
+    from packerpy.wire import SharedPayload
+
+# Public names and the submodule defining them.  Submodules are imported on
+# first attribute access (PEP 562), so ``import packerpy`` stays cheap for
+# short-lived processes that only need part of the package.
+LAZY_IMPORTS: dict[str, str] = {
+    "AdaptiveConcurrency": "packerpy.fleet",
+    "AmazonEbs": "packerpy.models",
+    "AzureArmBuilder": "packerpy.models",
+    "Builder": "packerpy.models",
+    "BuilderResource": "packerpy.models",
+    "BuilderSourceConfig": "packerpy.models",
+    "BuildJournal": "packerpy.journal",
+    "CancellationGroup": "packerpy.output",
+    "CheckpointStore": "packerpy.checkpoints",
+    "ConcurrencyController": "packerpy.fleet",
+    "DockerBuilder": "packerpy.models",
+    "DockerImport": "packerpy.models",
+    "DockerPush": "packerpy.models",
+    "DockerTag": "packerpy.models",
+    "DurationHistory": "packerpy.fleet",
+    "EmptyBuilderSourceConfig": "packerpy.models",
+    "EmptyPostProcessor": "packerpy.models",
+    "EmptyProvisioner": "packerpy.models",
+    "ErrorsOnlyLoggingPolicy": "packerpy.output",
+    "FatalPatternDetector": "packerpy.output",
+    "FileBundleOptimizer": "packerpy.optimizers",
+    "FileProvisioner": "packerpy.models",
+    "Fleet": "packerpy.fleet",
+    "GoogleComputeBuilder": "packerpy.models",
+    "LogFileSink": "packerpy.output",
+    "LoggingPolicy": "packerpy.output",
+    "Manifest": "packerpy.models",
+    "NdjsonLogWriter": "packerpy.output",
+    "NdjsonSink": "packerpy.output",
+    "OutputSink": "packerpy.output",
+    "PackerBuilder": "packerpy.builder",
+    "PackerClient": "packerpy.client",
+    "PackerConfig": "packerpy.models",
+    "PackerResource": "packerpy.models",
+    "PhaseProfiler": "packerpy.profiling",
+    "ProcessTreeMonitor": "packerpy.resources",
+    "Plugin": "packerpy.models",
+    "PostProcessor": "packerpy.models",
+    "Provisioner": "packerpy.models",
+    "RateLimitedLoggingPolicy": "packerpy.output",
+    "Requirements": "packerpy.models",
+    "SampledLoggingPolicy": "packerpy.output",
+    "SecretRedactor": "packerpy.output",
+    "SharedPayload": "packerpy.wire",
+    "ShellFusionOptimizer": "packerpy.optimizers",
+    "ShellLocalProvisioner": "packerpy.models",
+    "ShellProvisioner": "packerpy.models",
+    "SourceOverrideOptimizer": "packerpy.optimizers",
+    "SupportingType": "packerpy.models",
+    "TemplateOptimizer": "packerpy.optimizers",
+    "ThrottleSink": "packerpy.output",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(LAZY_IMPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *LAZY_IMPORTS})
+
 
 __all__ = [
+    "AdaptiveConcurrency",
     "AmazonEbs",
     "AzureArmBuilder",
     "Builder",
     "BuilderResource",
     "BuilderSourceConfig",
+    "BuildJournal",
+    "CancellationGroup",
+    "CheckpointStore",
+    "ConcurrencyController",
     "DockerBuilder",
     "DockerImport",
     "DockerPush",
     "DockerTag",
+    "DurationHistory",
     "EmptyBuilderSourceConfig",
     "EmptyPostProcessor",
     "EmptyProvisioner",
+    "ErrorsOnlyLoggingPolicy",
+    "FatalPatternDetector",
+    "FileBundleOptimizer",
     "FileProvisioner",
+    "Fleet",
     "GoogleComputeBuilder",
+    "LogFileSink",
+    "LoggingPolicy",
     "Manifest",
-    "PackerBuildError",
+    "NdjsonLogWriter",
+    "NdjsonSink",
+    "OutputSink",
     "PackerBuilder",
+    "PackerBuildError",
     "PackerClient",
     "PackerClientError",
     "PackerConfig",
     "PackerResource",
+    "PhaseProfiler",
+    "ProcessTreeMonitor",
     "Plugin",
     "PostProcessor",
     "Provisioner",
+    "RateLimitedLoggingPolicy",
     "Requirements",
+    "SampledLoggingPolicy",
+    "SecretRedactor",
+    "SharedPayload",
+    "ShellFusionOptimizer",
     "ShellLocalProvisioner",
     "ShellProvisioner",
+    "SourceOverrideOptimizer",
     "SupportingType",
+    "TemplateOptimizer",
+    "ThrottleSink",
 ]
@@ -2,13 +2,23 @@
 
 from __future__ import annotations
 
+import copy
 import json
 import logging
 import os
+import time
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
 
+from .checkpoints import CheckpointStore, stage_keys
 from .client import PackerClient
 from .exceptions import PackerBuildError
-from .models import Manifest, PackerConfig
+from .models import Builder, BuilderSourceConfig, Manifest, PackerConfig, PostProcessor, Provisioner
+from .output import SecretRedactor
+from .profiling import NullProfiler, PhaseProfiler
+
+if TYPE_CHECKING:
+    from .fleet import DurationHistory
 
 
 class PackerBuilder:
@@ -31,40 +41,188 @@ class PackerBuilder:
         name: A human-readable name for this build.
         config_file: Path where the generated ``.pkr.json`` template is written.
         manifest_file: Path where the Packer manifest post-processor writes output.
+        env: Optional environment overlay (e.g. ``PACKER_LOG``,
+            ``PACKER_PLUGIN_PATH``, ``PACKER_CACHE_DIR``) for this build's
+            Packer processes.  ``os.environ`` is never modified, so builders
+            with different overlays can run concurrently in one process.
+        parallel_builds: Optional limit passed to ``packer build -parallel-builds``
+            when the config contains several sources or build blocks.
+        checkpoints: Optional :class:`~packerpy.checkpoints.CheckpointStore`.
+            When set, the build runs in stages split at the primary build
+            block's stage boundaries (or every *checkpoint_every*
+            provisioners), each stage's artifact is recorded as a checkpoint,
+            and later builds resume from the deepest matching checkpoint.
+        checkpoint_every: Number of provisioners per checkpointed stage when
+            no stage boundaries are set.
+        profile: Profile the ``configure``, ``load`` (config parsing),
+            ``serialize`` and ``run`` phases: ``True``, ``"cpu"``,
+            ``"memory"``, a :class:`~packerpy.profiling.PhaseProfiler` or
+            ``False``.  Defaults to the ``PACKERPY_PROFILE`` environment
+            variable.  Reports are written to ``<config_file root>.profile/``.
     """
 
+    DEFAULT_CONFIG_FILE: str = "packer-builder.pkr.json"
+    DEFAULT_MANIFEST_FILE: str = "packer-manifest.json"
+
     def __init__(
         self,
         name: str,
-        config_file: str = "packer-builder.pkr.json",
-        manifest_file: str = "packer-manifest.json",
+        config_file: str = DEFAULT_CONFIG_FILE,
+        manifest_file: str = DEFAULT_MANIFEST_FILE,
+        env: dict[str, str] | None = None,
+        parallel_builds: int | None = None,
+        checkpoints: CheckpointStore | None = None,
+        checkpoint_every: int = 1,
+        profile: bool | str | NullProfiler | None = None,
     ) -> None:
         self.log: logging.Logger = logging.getLogger(PackerBuilder.__name__)
         self.config: PackerConfig = PackerConfig(name, self.log)
+        self.config.set_env(**(env or {}))
         self.config_file: str = config_file
         self.manifest_file: str = manifest_file
-        self.client: PackerClient = PackerClient(self.config_file, log=self.log)
+        self.parallel_builds: int | None = parallel_builds
+        self.configured: bool = False
+        self.upstream: list[tuple[PackerBuilder, list[str]]] = []
+        self.checkpoints: CheckpointStore | None = checkpoints
+        self.checkpoint_every: int = checkpoint_every
+        self.profiler: NullProfiler = PhaseProfiler.from_setting(profile, self.sibling_file("profile"), self.log)
+
+    @classmethod
+    def from_wire(cls, data: bytes | str, **kwargs: Any) -> PackerBuilder:
+        """Return a builder for a config serialized with :meth:`PackerConfig.to_wire`, e.g. in a worker process.
+
+        The builder counts as configured, so :meth:`configure` is not called.
+
+        Args:
+            data: The wire payload.
+            **kwargs: Further constructor arguments (``config_file``,
+                ``manifest_file``, ``env``, ...).
+        """
+        config = PackerConfig.from_wire(data)
+        builder = cls(config.config_name, **kwargs)
+        config.set_env(**builder.config.env)
+        config.log = builder.log
+        builder.config = config
+        builder.configured = True
+        return builder
+
+    @cached_property
+    def client(self) -> PackerClient:
+        """The :class:`PackerClient` for this build, created (and Packer located) on first use."""
+        return PackerClient(self.config_file, log=self.log)
+
+    def set_files(self, config_file: str | None = None, manifest_file: str | None = None) -> None:
+        """Move :attr:`config_file` and/or :attr:`manifest_file`, along with the client and profile directory."""
+        if config_file is not None:
+            profile_directory = self.sibling_file("profile")
+            self.config_file = config_file
+            if isinstance(self.profiler, PhaseProfiler) and self.profiler.directory == profile_directory:
+                self.profiler.directory = self.sibling_file("profile")
+            if "client" in self.__dict__:
+                self.client.file = config_file
+        if manifest_file is not None:
+            self.manifest_file = manifest_file
 
     def artifact_exists(self) -> bool:
         """Check whether the manifest file contains a valid artifact ID."""
-        if os.path.exists(self.manifest_file):
-            with open(self.manifest_file, "r") as fp:
-                manifest = json.load(fp)
-            return manifest["builds"][0].get("artifact_id", None) is not None
-        return False
+        return self.artifact_id() is not None
+
+    def artifact_id(self) -> str | None:
+        """Return the artifact ID of the most recent run recorded in the manifest file."""
+        build = self.last_manifest_build()
+        return build.get("artifact_id") if build else None
+
+    def last_manifest_build(self, manifest_file: str | None = None) -> dict[str, Any] | None:
+        """Return the first manifest entry of the most recent run, or ``None`` without a manifest.
+
+        Packer appends to an existing manifest, so only builds belonging to
+        the manifest's ``last_run_uuid`` are considered when it is present.
+
+        Args:
+            manifest_file: The manifest to read.  Defaults to :attr:`manifest_file`.
+        """
+        manifest_file = manifest_file or self.manifest_file
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, "r") as fp:
+            manifest = json.load(fp)
+        builds = manifest.get("builds", [])
+        if manifest.get("last_run_uuid"):
+            builds = [build for build in builds if build.get("packer_run_uuid") == manifest["last_run_uuid"]]
+        return builds[0] if builds else None
+
+    def cached_artifact_id(self, fingerprint: str | None = None) -> str | None:
+        """Return the manifest's artifact ID if it was built from the current template.
+
+        :meth:`add_manifest_post_processor` stores the config fingerprint in
+        the manifest's ``custom_data``, so an artifact only counts as cached
+        when that fingerprint matches :meth:`PackerConfig.fingerprint`.
+        """
+        build = self.last_manifest_build()
+        if not build or not build.get("artifact_id"):
+            return None
+        if build.get("custom_data", {}).get("fingerprint") != (fingerprint or self.config.fingerprint()):
+            return None
+        return build["artifact_id"]
 
     def add_manifest_post_processor(self) -> str:
-        """Ensure a :class:`Manifest` post-processor is present in the build.
+        """Ensure a :class:`Manifest` post-processor is present in every build block.
 
         Returns:
             The path to the manifest output file.
         """
+        for builder in self.config.builders:
+            if not any(isinstance(post_processor, Manifest) for post_processor in builder.post_processors):
+                builder.add_post_processor(Manifest(self.manifest_file))
+        fingerprint = self.config.fingerprint()
+        for builder in self.config.builders:
+            for index, post_processor in enumerate(builder.post_processors):
+                if isinstance(post_processor, Manifest):
+                    # Copy rather than modify: the manifest may be shared with other configs (see PackerConfig.clone).
+                    post_processor = builder.post_processors[index] = copy.copy(post_processor)
+                    post_processor.custom_data = {**(post_processor.custom_data or {}), "fingerprint": fingerprint}
         for post_processor in self.config.builder.post_processors:
             if isinstance(post_processor, Manifest):
                 return post_processor.output
-        self.config.builder.add_post_processor(Manifest(self.manifest_file))
         return self.manifest_file
 
+    def add_upstream(self, builder: PackerBuilder, *sources: str) -> None:
+        """Declare that this build consumes the artifact produced by *builder*.
+
+        A :class:`~packerpy.fleet.Fleet` builds *builder* first and then
+        passes its artifact ID to :meth:`inject_upstream_artifact`.
+
+        Args:
+            builder: The upstream build.
+            *sources: Names of this config's sources that build on the
+                upstream artifact.  Defaults to all sources.
+        """
+        self.upstream.append((builder, list(sources)))
+
+    def inject_upstream_artifact(self, builder: PackerBuilder, artifact_id: str) -> None:
+        """Use the artifact of the upstream *builder* as base image of the sources declared in :meth:`add_upstream`."""
+        self.ensure_configured()
+        for upstream, sources in self.upstream:
+            if upstream is builder:
+                for name in sources or list(self.config.builder_sources):
+                    # Sources may be shared with other configs (see PackerConfig.clone).
+                    source = copy.copy(self.config.builder_sources[name])
+                    source.inject_artifact(artifact_id)
+                    self.config.builder_sources[name] = source
+
+    def write_config(self, config: PackerConfig | None = None, config_file: str | None = None) -> None:
+        """Serialize *config* (default :attr:`config`) to *config_file* (default :attr:`config_file`)."""
+        config_file = config_file or self.config_file
+        config_dir = os.path.dirname(config_file)
+        if config_dir:
+            os.makedirs(config_dir, exist_ok=True)
+        with self.profiler.phase("serialize"), open(config_file, "w") as fp:
+            json.dump((config or self.config).json(), fp, indent=2)
+
+    def build_args(self) -> list[str]:
+        """Return the extra CLI arguments passed to ``packer build``."""
+        return [f"-parallel-builds={self.parallel_builds}"] if self.parallel_builds else []
+
     def configure(self) -> None:
         """Define the Packer build configuration.
 
@@ -73,26 +231,209 @@ class PackerBuilder:
         """
         raise NotImplementedError
 
+    def ensure_configured(self) -> None:
+        """Call :meth:`configure` unless it already ran for this builder."""
+        if not self.configured:
+            with self.profiler.phase("configure"):
+                self.configure()
+            self.configured = True
+
+    def plan(self, history: DurationHistory | None = None) -> dict[str, Any]:
+        """Describe what :meth:`run` would build, without running Packer.
+
+        Configures the builder (once), serializes the template and
+        fingerprints it.  Nothing is written and no process is spawned
+        (template optimizers that cache artifacts, such as
+        :class:`~packerpy.optimizers.FileBundleOptimizer`, may still fill their
+        cache).
+
+        Args:
+            history: Optional duration store used for ``estimated_seconds``.
+
+        Returns:
+            A JSON-serializable plan: ``name``, ``config_file``,
+            ``manifest_file``, ``fingerprint``, ``sources``, ``builds`` (name
+            and sources of each build block), ``cached`` with the cached
+            ``artifact_id``, ``estimated_seconds``, ``stages`` and the
+            checkpointed ``resume_stage`` of staged builds, ``template_bytes``
+            and ``plan_seconds``.
+        """
+        start = time.perf_counter()
+        self.ensure_configured()
+        template = self.config.json()
+        fingerprint = self.config.fingerprint(template)
+        artifact_id = self.cached_artifact_id(fingerprint)
+        stages = self.stages() if self.checkpoints else []
+        resume_stage = 0
+        if self.checkpoints and len(self.config.builder_sources) == 1:
+            _, _, keys = self.resolved_stages()
+            resume_stage = max((i + 1 for i, key in enumerate(keys[:-1]) if key in self.checkpoints.entries), default=0)
+        return {
+            "name": self.config.config_name,
+            "config_file": self.config_file,
+            "manifest_file": self.manifest_file,
+            "fingerprint": fingerprint,
+            "sources": sorted({source for builder in self.config.builders for source in builder.sources}),
+            "builds": [{"name": builder.name, "sources": list(builder.sources)} for builder in self.config.builders],
+            "cached": artifact_id is not None,
+            "artifact_id": artifact_id,
+            "estimated_seconds": history.estimate(self) if history else None,
+            "stages": len(stages) or 1,
+            "resume_stage": resume_stage,
+            "template_bytes": len(json.dumps(template, separators=(",", ":"), default=str)),
+            "plan_seconds": time.perf_counter() - start,
+        }
+
     def build(self) -> None:
         """Run the full Packer lifecycle: init, validate, and build.
 
+        With :attr:`checkpoints` set, the build runs in stages (see
+        :meth:`build_stages`).
+
         Raises:
             PackerBuildError: If validation fails or no artifact is produced.
         """
         self.add_manifest_post_processor()
-        if self.client.run("init").returncode != 0:
-            raise PackerBuildError("Packer init failed")
-        if self.client.run("validate").returncode != 0:
-            raise PackerBuildError("Invalid packer template")
-        if self.client.run("build").returncode != 0:
-            raise PackerBuildError("Packer build failed")
+        self.client.env.update(self.config.environment())
+        self.client.redactor = SecretRedactor(self.config.secrets())
+        if self.checkpoints and len(self.stages()) > 1:
+            self.build_stages()
+        else:
+            self.write_config()
+            self.run_packer()
         self.log.info(f"Checking manifest {self.manifest_file} for created artifact(s)")
         if not self.artifact_exists():
             raise PackerBuildError(
                 f"Artifact does not exist. Validate file {self.config_file} and rerun with debug for more details."
             )
 
+    def run_packer(self) -> None:
+        """Run ``packer init``, ``validate`` and ``build`` on the client's template file.
+
+        Raises:
+            PackerBuildError: If any of the commands fails.
+        """
+        with self.profiler.phase("run"):
+            if self.client.run("init").returncode != 0:
+                raise PackerBuildError("Packer init failed", output=list(self.client.output_tail))
+            if self.client.run("validate").returncode != 0:
+                raise PackerBuildError("Invalid packer template", output=list(self.client.output_tail))
+            if self.client.run("build", *self.build_args()).returncode != 0:
+                raise PackerBuildError("Packer build failed", output=list(self.client.output_tail))
+
+    def stages(self) -> list[list[Provisioner]]:
+        """Split the provisioners of the primary build block into checkpointed stages.
+
+        Stages end at the block's :meth:`~packerpy.models.Builder.add_stage_boundary`
+        marks, or every :attr:`checkpoint_every` provisioners without marks.
+        """
+        provisioners = self.config.builder.provisioners
+        boundaries = sorted(b for b in self.config.builder.stage_boundaries if 0 < b < len(provisioners))
+        if not boundaries:
+            every = max(1, self.checkpoint_every)
+            boundaries = list(range(every, len(provisioners), every))
+        edges = [0, *boundaries, len(provisioners)]
+        return [provisioners[start:end] for start, end in zip(edges, edges[1:])]
+
+    def sibling_file(self, suffix: str) -> str:
+        """Return the path of a file named after :attr:`config_file` with *suffix* (e.g. ``build.profile``)."""
+        root = os.path.splitext(self.config_file)[0].removesuffix(".pkr")
+        return f"{root}.{suffix}"
+
+    def stage_file(self, index: int, suffix: str) -> str:
+        """Return the path of a per-stage file next to :attr:`config_file`."""
+        return self.sibling_file(f"stage-{index}.{suffix}")
+
+    def stage_config(
+        self, source: BuilderSourceConfig, provisioners: list[Provisioner], *post_processors: PostProcessor
+    ) -> PackerConfig:
+        """Return a copy of :attr:`config` building *source* with only *provisioners* and *post_processors*."""
+        config = PackerConfig(self.config.config_name, self.log)
+        config.resolver = self.config.resolver
+        config.builder = Builder(self.config.builder.name)
+        config.builder.add_optimizer(*self.config.builder.optimizers)
+        config.set_requirements(self.config.requirements)
+        config.env = self.config.env
+        config.add_optimizer(*self.config.optimizers)
+        config.add_builder_source(source)
+        config.builder.add_provisioner(*provisioners)
+        config.builder.add_post_processor(*post_processors)
+        return config
+
+    def resolved_stages(self) -> tuple[BuilderSourceConfig, list[list[Provisioner]], list[str]]:
+        """Return the single source and the stages of a staged build with deferred values resolved, and their keys.
+
+        Deferred values are resolved before keying: awaitables cannot be
+        deep-copied, and keys must not depend on the identity of a callable.
+        :meth:`plan` and :meth:`build_stages` therefore compute the same
+        :func:`~packerpy.checkpoints.stage_keys`.
+        """
+        resolver = self.config.resolver
+        source = resolver.resolved_copy(next(iter(self.config.builder_sources.values())))
+        stages = [[resolver.resolved_copy(provisioner) for provisioner in stage] for stage in self.stages()]
+        return source, stages, stage_keys(source, stages)
+
+    def build_stages(self) -> None:
+        """Build in stages, resuming from the deepest checkpoint matching the current template.
+
+        Every stage but the last runs from the previous stage's artifact and
+        produces a checkpoint artifact (a ``packerpy-checkpoint:<key>`` Docker
+        image, an intermediate AMI or Google Compute image), recorded in
+        :attr:`checkpoints` under a key derived from the base source and the
+        provisioners up to that stage.  A build that failed in stage *n*
+        therefore reruns from the artifact of stage *n - 1*.  The last
+        stage runs the remaining provisioners with the real post-processors
+        and writes :attr:`config_file`.
+
+        Raises:
+            PackerBuildError: If the config has more than one build block or
+                source, the source does not support checkpoints, or a stage
+                fails.
+        """
+        if self.checkpoints is None:
+            raise PackerBuildError("Staged builds need a checkpoint store")
+        if len(self.config.builders) != 1 or len(self.config.builder_sources) != 1:
+            raise PackerBuildError("Staged builds need exactly one build block and one source")
+        source, stages, keys = self.resolved_stages()
+        start, base = 0, None
+        for index in reversed(range(len(stages) - 1)):
+            base = self.checkpoints.get(keys[index])
+            if base:
+                start = index + 1
+                self.log.info(f"Resuming {self.config.config_name} from checkpoint {base} after stage {index}")
+                break
+        for index in range(start, len(stages) - 1):
+            stage_source = copy.deepcopy(source)
+            if base:
+                stage_source.inject_artifact(base)
+            stage_source, post_processors, artifact = stage_source.checkpoint(keys[index])
+            manifest_file = self.stage_file(index, "manifest.json")
+            config = self.stage_config(stage_source, stages[index], *post_processors, Manifest(manifest_file))
+            self.log.info(f"Building stage {index} of {self.config.config_name}")
+            self.execute(config, self.stage_file(index, "pkr.json"))
+            build = self.last_manifest_build(manifest_file)
+            artifact = artifact or (build.get("artifact_id") if build else None)
+            if not artifact:
+                raise PackerBuildError(f"Stage {index} of {self.config.config_name} produced no artifact")
+            self.checkpoints.put(keys[index], artifact, source.type)
+            base = artifact
+        final_source = copy.deepcopy(source)
+        if base:
+            final_source.inject_artifact(base)
+        self.execute(
+            self.stage_config(final_source, stages[-1], *self.config.builder.post_processors), self.config_file
+        )
+
+    def execute(self, config: PackerConfig, config_file: str) -> None:
+        """Write *config* to *config_file* and run Packer on it."""
+        self.write_config(config, config_file)
+        previous, self.client.file = self.client.file, config_file
+        try:
+            self.run_packer()
+        finally:
+            self.client.file = previous
+
     def run(self) -> None:
         """Configure and execute the build."""
-        self.configure()
+        self.ensure_configured()
         self.build()
@@ -0,0 +1,244 @@
+"""Checkpoint cache for staged builds."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+from .models import BuilderSourceConfig, PackerConfig, Provisioner
+from .util import SCRIPT_RESOLVER
+
+
+def docker_image_exists(image: str) -> bool:
+    """Return ``True`` if the local Docker daemon has *image*."""
+    try:
+        return subprocess.run(["docker", "image", "inspect", image], capture_output=True).returncode == 0
+    except FileNotFoundError:
+        return False
+
+
+def remove_docker_image(image: str) -> None:
+    """Remove *image* from the local Docker daemon, ignoring errors."""
+    try:
+        subprocess.run(["docker", "rmi", image], capture_output=True)
+    except FileNotFoundError:
+        pass
+
+
+def amazon_images(artifact: str) -> list[tuple[str, str]]:
+    """Return the ``(region, ami-id)`` pairs of an Amazon artifact ID such as ``us-east-1:ami-123``."""
+    return [(region, image) for region, image in (pair.split(":", 1) for pair in artifact.split(",") if ":" in pair)]
+
+
+def amazon_image_exists(artifact: str) -> bool:
+    """Return ``False`` if the AWS CLI reports an AMI of *artifact* missing or no longer ``available``.
+
+    AMIs that cannot be checked (no ``aws`` CLI, missing permissions) are
+    assumed to exist; a build starting from a deleted AMI fails in Packer.
+    """
+    for region, image in amazon_images(artifact):
+        command = ["aws", "ec2", "--region", region, "describe-images", "--image-ids", image]
+        try:
+            result = subprocess.run(
+                [*command, "--query", "Images[0].State", "--output", "text"], capture_output=True, text=True
+            )
+        except FileNotFoundError:
+            return True
+        if result.returncode == 0 and result.stdout.strip() != "available":
+            return False
+        if result.returncode != 0 and "InvalidAMIID" in result.stderr:
+            return False
+    return True
+
+
+def remove_amazon_image(artifact: str) -> None:
+    """Deregister the AMIs of *artifact* and delete their EBS snapshots with the AWS CLI.
+
+    Raises:
+        FileNotFoundError: If the ``aws`` CLI is not installed.
+        subprocess.CalledProcessError: If a call fails.
+    """
+    for region, image in amazon_images(artifact):
+        aws = ["aws", "ec2", "--region", region]
+        query = "Images[].BlockDeviceMappings[].Ebs.SnapshotId"
+        snapshots = subprocess.run(
+            [*aws, "describe-images", "--image-ids", image, "--query", query, "--output", "text"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        subprocess.run([*aws, "deregister-image", "--image-id", image], capture_output=True, check=True)
+        for snapshot in snapshots:
+            if snapshot != "None":
+                subprocess.run([*aws, "delete-snapshot", "--snapshot-id", snapshot], capture_output=True, check=True)
+
+
+def google_image_exists(image: str) -> bool:
+    """Return ``False`` if ``gcloud`` reports *image* missing, failed or being deleted.
+
+    The image is looked up in ``gcloud``'s configured project.  Images that
+    cannot be checked (no ``gcloud`` CLI, missing permissions) are assumed
+    to exist.
+    """
+    try:
+        result = subprocess.run(
+            ["gcloud", "compute", "images", "describe", image, "--format=value(status)"],
+            capture_output=True,
+            text=True,
+        )
+    except FileNotFoundError:
+        return True
+    if result.returncode != 0:
+        return "was not found" not in result.stderr
+    return result.stdout.strip() not in ("FAILED", "DELETING")
+
+
+def remove_google_image(image: str) -> None:
+    """Delete *image* from ``gcloud``'s configured project.
+
+    Raises:
+        FileNotFoundError: If the ``gcloud`` CLI is not installed.
+        subprocess.CalledProcessError: If the deletion fails.
+    """
+    subprocess.run(["gcloud", "compute", "images", "delete", image, "--quiet"], capture_output=True, check=True)
+
+
+class CheckpointStore:
+    """Local JSON index of stage checkpoint artifacts, evicted least recently used first.
+
+    Entries map a checkpoint key (see :func:`stage_keys`) to the artifact
+    holding the state of the build after that stage.  Artifacts of source
+    types listed in :attr:`VALIDATORS` are checked before being reused, and
+    those listed in :attr:`DISCARDERS` are deleted when evicted.  Docker
+    checkpoints go through the ``docker`` CLI, AMIs (and their snapshots)
+    through the ``aws`` CLI and Google Compute images through ``gcloud``,
+    each with its default credentials.  Pass *validators* / *discarders*
+    to use other clients (e.g. a ``boto3`` session).  An evicted artifact
+    that could not be deleted is logged as a warning and must be removed
+    by hand.
+
+    Args:
+        path: JSON file holding the index.
+        max_entries: Number of checkpoints kept before evicting the least
+            recently used.
+        log: Optional logger instance.
+        validators: Per-source-type functions overriding :attr:`VALIDATORS`.
+        discarders: Per-source-type functions overriding :attr:`DISCARDERS`.
+    """
+
+    VALIDATORS: dict[str, Callable[[str], bool]] = {
+        "docker": docker_image_exists,
+        "amazon-ebs": amazon_image_exists,
+        "googlecompute": google_image_exists,
+    }
+    DISCARDERS: dict[str, Callable[[str], None]] = {
+        "docker": remove_docker_image,
+        "amazon-ebs": remove_amazon_image,
+        "googlecompute": remove_google_image,
+    }
+
+    def __init__(
+        self,
+        path: str = ".packerpy/checkpoints.json",
+        max_entries: int = 20,
+        log: logging.Logger | None = None,
+        validators: dict[str, Callable[[str], bool]] | None = None,
+        discarders: dict[str, Callable[[str], None]] | None = None,
+    ) -> None:
+        self.path: str = path
+        self.max_entries: int = max_entries
+        self.log: logging.Logger = log or logging.getLogger(CheckpointStore.__name__)
+        self.validators: dict[str, Callable[[str], bool]] = dict(validators or {})
+        self.discarders: dict[str, Callable[[str], None]] = dict(discarders or {})
+        self.lock: threading.Lock = threading.Lock()
+        self.entries: dict[str, dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                self.entries = json.load(fp)
+
+    def get(self, key: str) -> str | None:
+        """Return the artifact of checkpoint *key* and mark it as used, or ``None`` if missing or gone."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        validator = {**CheckpointStore.VALIDATORS, **self.validators}.get(entry["type"])
+        valid = validator is None or validator(entry["artifact"])
+        with self.lock:
+            if not valid:
+                self.log.info(f"Checkpoint {entry['artifact']} no longer exists")
+                self.entries.pop(key, None)
+            else:
+                entry["used"] = time.time()
+            self.save()
+        return entry["artifact"] if valid else None
+
+    def put(self, key: str, artifact: str, _type: str) -> None:
+        """Record *artifact* (built by a source of type *_type*) as checkpoint *key* and evict old entries."""
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {"artifact": artifact, "type": _type, "created": now, "used": now}
+            evicted = sorted(self.entries.items(), key=lambda item: item[1]["used"])[
+                : max(0, len(self.entries) - self.max_entries)
+            ]
+            for evicted_key, _ in evicted:
+                del self.entries[evicted_key]
+            self.save()
+        for _, entry in evicted:
+            self.log.info(f"Evicting checkpoint {entry['artifact']}")
+            discarder = {**CheckpointStore.DISCARDERS, **self.discarders}.get(entry["type"])
+            if discarder is None:
+                self.log.warning(f"Evicted {entry['type']} checkpoint {entry['artifact']} must be deleted by hand")
+                continue
+            try:
+                discarder(entry["artifact"])
+            except Exception as e:
+                self.log.warning(
+                    f"Evicted checkpoint {entry['artifact']} could not be deleted and must be deleted by hand: {e}"
+                )
+
+    def save(self) -> None:
+        """Atomically write the index to :attr:`path`.  The caller holds :attr:`lock`."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(self.entries, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def stage_keys(source: BuilderSourceConfig, stages: list[list[Provisioner]]) -> list[str]:
+    """Return the checkpoint key of every stage.
+
+    Each key chains the previous one with the serialized provisioners of the
+    stage and the content digests of the local files they reference, so it
+    identifies the base source plus the ordered provisioner prefix.  The
+    source's :attr:`~packerpy.models.PackerResource.SECRET_FIELDS` are left
+    out, so rotating credentials keeps the checkpoints.  Deferred values
+    must be resolved beforehand (see
+    :meth:`~packerpy.deferred.DeferredResolver.resolved_copy`).
+    """
+    keys: list[str] = []
+    serialized = {
+        _type: {name: PackerConfig.without_secrets(attrs, type(source)) for name, attrs in named.items()}
+        for _type, named in source.json().items()
+    }
+    previous = json.dumps(serialized, sort_keys=True, default=str)
+    for stage in stages:
+        digest = hashlib.sha256(previous.encode())
+        for provisioner in stage:
+            digest.update(json.dumps(provisioner.json(), sort_keys=True, default=str).encode())
+            paths = provisioner.local_files()
+            if paths:
+                digest.update(SCRIPT_RESOLVER.fingerprint(*paths).encode())
+        previous = digest.hexdigest()
+        keys.append(previous)
+    return keys
@@ -5,9 +5,13 @@ from __future__ import annotations
 import logging
 import os
 import subprocess
-from typing import IO
+from collections import deque
+from collections.abc import Callable
+from typing import Any
 
-from .exceptions import PackerClientError
+from .exceptions import PackerBuildError, PackerClientError
+from .output import CancellationGroup, FatalPatternDetector, LogFileSink, LoggingPolicy, OutputSink, SecretRedactor
+from .resources import PROC, ProcessTreeMonitor
 
 
 class PackerClient:
@@ -15,12 +19,45 @@ class PackerClient:
 
     Validates that Packer is installed, then provides a ``run`` method to
     execute Packer commands against a given configuration file. Output is
-    streamed to the logger and optionally written to log files on disk.
+    streamed to the logger and optionally written to log files on disk,
+    after secrets known to :attr:`redactor` have been masked.  The last
+    *tail_lines* lines of the most recent command are kept in memory in
+    :attr:`output_tail` so failures can be reported without re-reading logs.
+    Which lines reach the logger is decided by *logging_policy*; lines it
+    suppresses are counted per command in :attr:`suppressed_lines` but are
+    still written to every sink.
+
+    When *fatal_patterns* is set, a line matching one of its patterns
+    terminates the Packer process immediately and, if *cancellation_group*
+    is set, every sibling process in that group as well.
+
+    Callables in :attr:`on_start` are called with the command and the pid of
+    every Packer process as soon as it has been spawned.
+
+    With *resource_interval* set, the CPU time, memory and disk I/O of each
+    Packer process tree are sampled from ``/proc`` (see
+    :class:`~packerpy.resources.ProcessTreeMonitor`) and the usage of the
+    last run of every command is kept in :attr:`resource_usage`.
 
     Args:
         file: Path to the Packer configuration file.
         stream_file_dir: Optional directory to write command log files into.
         log: Optional logger instance. A default logger is created if not provided.
+        env: Optional environment overlay applied on top of ``os.environ`` for
+            every Packer process started by this client.
+        log_compression: Compression for the command log files (``"gzip"`` or
+            ``"zstd"``).  Uncompressed by default.
+        log_max_bytes: Rotate command log files after this many bytes.  Needs
+            *log_backup_count*.
+        log_backup_count: Number of rotated command log files to keep.
+        tail_lines: Number of output lines kept in :attr:`output_tail`.
+        logging_policy: Optional :class:`~packerpy.output.LoggingPolicy`.  Every
+            line is logged by default.
+        fatal_patterns: Optional :class:`~packerpy.output.FatalPatternDetector`.
+        cancellation_group: Optional :class:`~packerpy.output.CancellationGroup`
+            shared with sibling builds.
+        resource_interval: Seconds between resource usage samples.  Sampling
+            is disabled by default and on hosts without ``/proc``.
     """
 
     VALID_COMMANDS = [
@@ -41,11 +78,34 @@ class PackerClient:
         file: str,
         stream_file_dir: str | None = None,
         log: logging.Logger | None = None,
+        env: dict[str, str] | None = None,
+        log_compression: str | None = None,
+        log_max_bytes: int | None = None,
+        log_backup_count: int = 0,
+        tail_lines: int = 200,
+        logging_policy: LoggingPolicy | None = None,
+        fatal_patterns: FatalPatternDetector | None = None,
+        cancellation_group: CancellationGroup | None = None,
+        resource_interval: float | None = None,
     ) -> None:
         PackerClient.verify_packer_installation()
         self.file: str = file
         self.stream_file_dir: str | None = stream_file_dir
         self.log: logging.Logger = log or logging.getLogger(PackerClient.__name__)
+        self.env: dict[str, str] = dict(env or {})
+        self.redactor: SecretRedactor = SecretRedactor()
+        self.log_compression: str | None = log_compression
+        self.log_max_bytes: int | None = log_max_bytes
+        self.log_backup_count: int = log_backup_count
+        self.sinks: list[OutputSink] = []
+        self.output_tail: deque[str] = deque(maxlen=tail_lines)
+        self.logging_policy: LoggingPolicy = logging_policy or LoggingPolicy()
+        self.suppressed_lines: dict[str, int] = {}
+        self.fatal_patterns: FatalPatternDetector | None = fatal_patterns
+        self.cancellation_group: CancellationGroup | None = cancellation_group
+        self.on_start: list[Callable[[str, int], None]] = []
+        self.resource_interval: float | None = resource_interval
+        self.resource_usage: dict[str, dict[str, Any]] = {}
 
     def run(self, command: str, *args: str) -> subprocess.Popen[str]:
         """Execute a Packer CLI command.
@@ -59,10 +119,15 @@ class PackerClient:
 
         Raises:
             PackerClientError: If *command* is not a recognised Packer command.
+            PackerBuildError: If the output matched a fatal pattern, or the
+                cancellation group was cancelled by a sibling build.
         """
         command = command.strip()
         if command not in self.VALID_COMMANDS:
             raise PackerClientError(f"Invalid command: {command}. Valid commands: {', '.join(self.VALID_COMMANDS)}")
+        group = self.cancellation_group
+        if group and group.cancelled:
+            raise PackerBuildError(f"Cancelled before packer {command} started: {group.reason}")
         cmd = [
             "packer",
             command,
@@ -70,25 +135,82 @@ class PackerClient:
             self.file,
         ]
         self.log.debug(f"Running command: {', '.join(cmd)}")
-        stream_file: IO[str] | None = None
-        if self.stream_file_dir:
-            os.makedirs(self.stream_file_dir, exist_ok=True)
-            stream_file = open(f"{self.stream_file_dir}/packer-{command}.log", "w")
-        proc = subprocess.Popen(
-            cmd,
-            universal_newlines=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        for line in proc.stdout:
-            line_str = str(line).strip("\n")
-            self.log.info(line_str)
-            if stream_file:
-                stream_file.write(line_str + "\n")
-        if stream_file:
-            stream_file.close()
+        sinks = self.active_sinks()
+        for sink in sinks:
+            sink.open(command)
+        self.output_tail.clear()
+        total, suppressed = 0, 0
+        fatal: str | None = None
+        proc: subprocess.Popen[str] | None = None
+        monitor: ProcessTreeMonitor | None = None
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                universal_newlines=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=self.environment(),
+            )
+            if group:
+                group.register(proc)
+            for callback in self.on_start:
+                callback(command, proc.pid)
+            if self.resource_interval and os.path.isdir(PROC):
+                monitor = ProcessTreeMonitor(proc.pid, self.resource_interval, log=self.log)
+                monitor.start()
+            for line in proc.stdout:
+                line_str = self.redactor.redact(str(line).strip("\n"))
+                total += 1
+                if self.logging_policy.allow(line_str):
+                    self.log.info(line_str)
+                else:
+                    suppressed += 1
+                self.output_tail.append(line_str)
+                for sink in sinks:
+                    sink.write(line_str)
+                if fatal is None and self.fatal_patterns and (pattern := self.fatal_patterns.match(line_str)):
+                    fatal = f"Output matched fatal pattern '{pattern}': {line_str}"
+                    self.log.error(f"{fatal}. Terminating packer {command}")
+                    proc.terminate()
+                    if group:
+                        group.cancel(f"{self.file}: {fatal}", origin=proc)
+            proc.wait()
+        finally:
+            if monitor is not None:
+                monitor.stop()
+                self.resource_usage[command] = monitor.usage()
+            if group and proc is not None:
+                group.unregister(proc)
+            for sink in sinks:
+                sink.close(proc.returncode if proc is not None else None)
+            self.suppressed_lines[command] = suppressed
+            if suppressed:
+                self.log.info(f"Suppressed {suppressed} of {total} output lines of packer {command}")
+        if fatal:
+            raise PackerBuildError(fatal, output=list(self.output_tail))
+        if group and group.cancelled and proc.returncode != 0:
+            raise PackerBuildError(f"Cancelled by sibling build: {group.reason}", output=list(self.output_tail))
         return proc
 
+    def active_sinks(self) -> list[OutputSink]:
+        """Return the sinks for the next command: the command log file (if enabled) and :attr:`sinks`."""
+        sinks = list(self.sinks)
+        if self.stream_file_dir:
+            sinks.insert(
+                0,
+                LogFileSink(
+                    self.stream_file_dir,
+                    compression=self.log_compression,
+                    max_bytes=self.log_max_bytes,
+                    backup_count=self.log_backup_count,
+                ),
+            )
+        return sinks
+
+    def environment(self) -> dict[str, str]:
+        """Return the full environment for a Packer process: ``os.environ`` plus :attr:`env`."""
+        return {**os.environ, **self.env}
+
     @staticmethod
     def verify_packer_installation() -> None:
         """Check that the ``packer`` binary is available on ``$PATH``.
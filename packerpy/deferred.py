@@ -0,0 +1,163 @@
+"""Deferred field values, resolved concurrently when a template is serialized."""
+
+from __future__ import annotations
+
+import copy
+import threading
+from collections.abc import Awaitable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, TypeVar
+
+from .exceptions import PackerBuildError
+
+T = TypeVar("T")
+
+
+def is_deferred(value: Any) -> bool:
+    """Return ``True`` if *value* is a callable, a :class:`~concurrent.futures.Future` or an awaitable."""
+    return isinstance(value, (Future, Awaitable)) or (callable(value) and not isinstance(value, type))
+
+
+def find_deferred(data: Any) -> list[Any]:
+    """Return the deferred values nested in the dicts and lists of *data*."""
+    if isinstance(data, dict):
+        return [value for item in data.values() for value in find_deferred(item)]
+    if isinstance(data, (list, tuple)):
+        return [value for item in data for value in find_deferred(item)]
+    return [data] if is_deferred(data) else []
+
+
+class DeferredResolver:
+    """Resolve deferred field values in batches and cache the results.
+
+    Model fields may hold a zero-argument callable (e.g. a secret or image
+    lookup), a :class:`~concurrent.futures.Future` or an awaitable instead of
+    a concrete value.  :meth:`substitute` resolves every deferred value of a
+    serialized template at once: callables and futures on a thread pool,
+    awaitables with :func:`asyncio.gather` on a private event loop.  Each
+    deferred value is resolved once per resolver; configs created with
+    :meth:`PackerConfig.clone() <packerpy.models.PackerConfig.clone>` and the
+    configs of a :class:`~packerpy.fleet.Fleet` share a resolver.
+
+    Args:
+        max_workers: Maximum number of lookups running at the same time.
+    """
+
+    def __init__(self, max_workers: int = 16) -> None:
+        self.max_workers: int = max_workers
+        self.lock: threading.Lock = threading.Lock()
+        # id of the deferred value -> (deferred value, resolved value).  Keeping the
+        # deferred value referenced prevents its id from being reused.
+        self.cache: dict[int, tuple[Any, Any]] = {}
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> DeferredResolver:
+        # Copies of a config keep sharing resolved values (and the lock guarding them).
+        return self
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Locks and resolved awaitables cannot be pickled; an unpickled resolver starts empty.
+        return {"max_workers": self.max_workers}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(**state)  # type: ignore[misc]
+
+    def resolve(self, values: Iterable[Any]) -> None:
+        """Resolve the deferred *values* not resolved yet, concurrently.
+
+        Raises:
+            PackerBuildError: If a lookup raised.
+        """
+        with self.lock:
+            pending = {id(value): value for value in values if id(value) not in self.cache}
+            if not pending:
+                return
+            awaitables = [value for value in pending.values() if isinstance(value, Awaitable)]
+            workers = max(1, min(self.max_workers, len(pending) - len(awaitables) + bool(awaitables)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    key: executor.submit(DeferredResolver.call, value)
+                    for key, value in pending.items()
+                    if not isinstance(value, Awaitable)
+                }
+                gathered = executor.submit(DeferredResolver.gather, awaitables) if awaitables else None
+                try:
+                    resolved = {key: future.result() for key, future in futures.items()}
+                    if gathered is not None:
+                        resolved.update(zip(map(id, awaitables), gathered.result()))
+                except Exception as e:
+                    raise PackerBuildError(f"Could not resolve deferred value: {e}") from e
+            self.cache.update({key: (pending[key], value) for key, value in resolved.items()})
+
+    @staticmethod
+    def call(value: Any) -> Any:
+        """Return the result of a future or callable."""
+        return value.result() if isinstance(value, Future) else value()
+
+    @staticmethod
+    def gather(awaitables: list[Awaitable[Any]]) -> list[Any]:
+        """Await *awaitables* concurrently on a new event loop."""
+        import asyncio
+
+        async def gather() -> list[Any]:
+            return await asyncio.gather(*awaitables)
+
+        return asyncio.run(gather())
+
+    def value(self, value: Any) -> Any:
+        """Return the resolved value of *value*, resolving it if needed; other values are returned as is."""
+        if not is_deferred(value):
+            return value
+        self.resolve([value])
+        return self.cache[id(value)][1]
+
+    def substitute(self, data: Any) -> Any:
+        """Return *data* with every nested deferred value replaced by its resolved value.
+
+        *data* itself is returned when it holds no deferred values.
+        """
+        deferred = find_deferred(data)
+        if not deferred:
+            return data
+        self.resolve(deferred)
+        return self.replace(data)
+
+    def replace(self, data: Any) -> Any:
+        """Return a copy of *data* with resolved values in place of deferred ones."""
+        if isinstance(data, dict):
+            return {key: self.replace(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [self.replace(item) for item in data]
+        return self.cache[id(data)][1] if is_deferred(data) else data
+
+    def resolved_copy(self, resource: T) -> T:
+        """Return a shallow copy of *resource* with its deferred attributes replaced by their resolved values.
+
+        *resource* itself is returned when none of its attributes hold a
+        deferred value.  The copy can be deep-copied and serialized with
+        :func:`json.dumps` like any resource with concrete values.
+        """
+        attributes = vars(resource)
+        deferred = find_deferred(list(attributes.values()))
+        if not deferred:
+            return resource
+        self.resolve(deferred)
+        resolved = copy.copy(resource)
+        for name, value in attributes.items():
+            if find_deferred(value):
+                setattr(resolved, name, self.replace(value))
+        return resolved
+
+    def merge(self, other: DeferredResolver) -> None:
+        """Adopt the values already resolved by *other*, so they are not looked up, or awaited, again."""
+        if other is self:
+            return
+        with other.lock:
+            cache = dict(other.cache)
+        with self.lock:
+            for key, entry in cache.items():
+                self.cache.setdefault(key, entry)
+
+    def clear(self) -> None:
+        """Forget all resolved values, e.g. before the next run."""
+        with self.lock:
+            self.cache.clear()
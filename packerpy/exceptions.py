@@ -9,11 +9,18 @@ def raise_(ex: Exception) -> None:
 
 
 class PackerBuildError(Exception):
-    """Raised when a Packer build fails or produces an invalid configuration."""
+    """Raised when a Packer build fails or produces an invalid configuration.
 
-    def __init__(self, message: str | None = None, _type: type | None = None) -> None:
+    Args:
+        message: Description of the failure.
+        _type: Optional type the failure relates to, prefixed to the message.
+        output: The last lines of Packer output before the failure, if any.
+    """
+
+    def __init__(self, message: str | None = None, _type: type | None = None, output: list[str] | None = None) -> None:
         error_message = f"- {_type.__name__}: {message}" if _type else f"- {message}"
         super().__init__("PackerBuildError " + error_message)
+        self.output: list[str] = output or []
 
 
 class PackerClientError(Exception):
@@ -0,0 +1,733 @@
+"""Concurrent orchestration of many :class:`~packerpy.builder.PackerBuilder` runs."""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+from .builder import PackerBuilder
+from .deferred import DeferredResolver, find_deferred
+from .exceptions import PackerBuildError
+from .journal import BuildJournal
+from .models import ShellLocalProvisioner
+from .output import CancellationGroup, ThrottleSink
+from .resources import memory_available
+from .validation import ValidationBatch
+
+
+class DurationHistory:
+    """Local JSON store of measured build durations.
+
+    Durations are keyed by config name, sources and config fingerprint, and
+    smoothed with an exponentially weighted moving average.  When the exact
+    key has never been measured (e.g. the template changed), the latest
+    measurement for the same name and sources is used, then
+    *default_estimate*.
+
+    Args:
+        path: JSON file holding the history.  Created on first :meth:`record`.
+        default_estimate: Estimate in seconds for builds never seen before.
+        smoothing: Weight of the newest measurement in the moving average.
+    """
+
+    def __init__(
+        self, path: str = ".packerpy/durations.json", default_estimate: float = 1800.0, smoothing: float = 0.5
+    ) -> None:
+        self.path: str = path
+        self.default_estimate: float = default_estimate
+        self.smoothing: float = smoothing
+        self.lock: threading.Lock = threading.Lock()
+        self.records: dict[str, dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                self.records = json.load(fp)
+
+    @staticmethod
+    def sources(builder: PackerBuilder) -> list[str]:
+        """Return the sorted source references of every build block of *builder*."""
+        return sorted({source for block in builder.config.builders for source in block.sources})
+
+    @staticmethod
+    def key(builder: PackerBuilder) -> str:
+        """Return the history key of *builder*: name, sources and fingerprint."""
+        sources = ",".join(DurationHistory.sources(builder))
+        return f"{builder.config.config_name}|{sources}|{builder.config.fingerprint()}"
+
+    def lookup(self, builder: PackerBuilder) -> dict[str, Any] | None:
+        """Return the record of *builder*, falling back to the latest one with the same name and sources."""
+        with self.lock:
+            record = self.records.get(DurationHistory.key(builder))
+            if record is None:
+                sources = DurationHistory.sources(builder)
+                similar = [
+                    r
+                    for r in self.records.values()
+                    if r["name"] == builder.config.config_name and r["sources"] == sources
+                ]
+                record = max(similar, key=lambda r: r["updated"], default=None)
+        return record
+
+    def estimate(self, builder: PackerBuilder) -> float:
+        """Return the expected duration of *builder* in seconds."""
+        record = self.lookup(builder)
+        return record["seconds"] if record else self.default_estimate
+
+    def expected_memory(self, builder: PackerBuilder) -> int:
+        """Return the expected peak resident memory of *builder*'s Packer processes in bytes (``0`` if unknown)."""
+        record = self.lookup(builder)
+        return int(record.get("rss_bytes_peak", 0)) if record else 0
+
+    def record(self, builder: PackerBuilder, seconds: float, rss_bytes_peak: int | None = None) -> None:
+        """Add a measured duration (and optionally peak memory) for *builder* and persist the history."""
+        key = DurationHistory.key(builder)
+        with self.lock:
+            record = self.records.get(key)
+            if record:
+                seconds = self.smoothing * seconds + (1 - self.smoothing) * record["seconds"]
+            self.records[key] = {
+                "name": builder.config.config_name,
+                "sources": DurationHistory.sources(builder),
+                "seconds": seconds,
+                "runs": (record["runs"] if record else 0) + 1,
+                "updated": time.time(),
+            }
+            if rss_bytes_peak is not None:
+                self.records[key]["rss_bytes_peak"] = rss_bytes_peak
+            elif record and "rss_bytes_peak" in record:
+                self.records[key]["rss_bytes_peak"] = record["rss_bytes_peak"]
+            self.save()
+
+    def save(self) -> None:
+        """Atomically write the history to :attr:`path`."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(self.records, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class ConcurrencyController:
+    """Additive-increase/multiplicative-decrease (AIMD) limit on concurrent builds.
+
+    Each successful build raises the limit by ``increase / limit`` (about one
+    slot per limit's worth of successes).  Throttling, or *failure_threshold*
+    failures among the last *failure_window* builds, multiplies the limit by
+    *decrease*, at most once per *cooldown* seconds so that a single burst of
+    errors only counts once.
+
+    Args:
+        key: The provider/location key this controller limits.
+        initial: Starting limit.
+        minimum: Lowest limit.  At least one build may always run.
+        maximum: Highest limit.
+        increase: Additive increase per limit's worth of successes.
+        decrease: Multiplicative decrease factor.
+        failure_window: Number of recent outcomes considered for failure spikes.
+        failure_threshold: Failures within the window that trigger a decrease.
+        cooldown: Minimum seconds between two decreases.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        initial: float = 2,
+        minimum: float = 1,
+        maximum: float = 16,
+        increase: float = 1,
+        decrease: float = 0.5,
+        failure_window: int = 10,
+        failure_threshold: int = 3,
+        cooldown: float = 60.0,
+    ) -> None:
+        self.key: str = key
+        self.limit: float = initial
+        self.minimum: float = max(1, minimum)
+        self.maximum: float = maximum
+        self.increase: float = increase
+        self.decrease: float = decrease
+        self.failure_threshold: int = failure_threshold
+        self.cooldown: float = cooldown
+        self.outcomes: deque[bool] = deque(maxlen=failure_window)
+        self.active: int = 0
+        self.decreased: float | None = None
+        self.lock: threading.Lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """Take a slot if fewer than :attr:`limit` builds are active."""
+        with self.lock:
+            if self.active < max(self.minimum, int(self.limit)):
+                self.active += 1
+                return True
+            return False
+
+    def cancel(self) -> None:
+        """Return a slot taken by :meth:`try_acquire` for a build that never started."""
+        with self.lock:
+            self.active -= 1
+
+    def release(self, success: bool, throttled: bool = False) -> None:
+        """Return a slot and adjust the limit from the build's outcome."""
+        with self.lock:
+            self.active -= 1
+            self.outcomes.append(success)
+            if throttled or self.outcomes.count(False) >= self.failure_threshold:
+                self.back_off()
+            elif success:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def throttle(self) -> None:
+        """Cut the limit back immediately after a throttling signal."""
+        with self.lock:
+            self.back_off()
+
+    def back_off(self) -> None:
+        """Apply the multiplicative decrease, honouring :attr:`cooldown`.  The caller holds :attr:`lock`."""
+        now = time.monotonic()
+        if self.decreased is not None and now - self.decreased < self.cooldown:
+            return
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.decreased = now
+        self.outcomes.clear()
+
+
+class AdaptiveConcurrency:
+    """Per provider/location :class:`ConcurrencyController` instances for a :class:`Fleet`.
+
+    A build's keys are the :meth:`~packerpy.models.BuilderSourceConfig.concurrency_key`
+    of its sources (e.g. ``"amazon-ebs:us-east-1"``), so throttling in one
+    region does not slow down builds elsewhere.  A build needs a slot from
+    every one of its keys to start.
+
+    Args:
+        **settings: Keyword arguments for each new :class:`ConcurrencyController`.
+    """
+
+    def __init__(self, **settings: Any) -> None:
+        self.settings: dict[str, Any] = settings
+        self.controllers: dict[str, ConcurrencyController] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def keys(builder: PackerBuilder) -> list[str]:
+        """Return the sorted concurrency keys of *builder*'s sources."""
+        return sorted({source.concurrency_key() for source in builder.config.builder_sources.values()})
+
+    def controller(self, key: str) -> ConcurrencyController:
+        """Return the controller for *key*, creating it if needed."""
+        with self.lock:
+            if key not in self.controllers:
+                self.controllers[key] = ConcurrencyController(key, **self.settings)
+            return self.controllers[key]
+
+    def try_acquire(self, builder: PackerBuilder) -> bool:
+        """Take a slot from every controller of *builder*, or none at all."""
+        acquired: list[ConcurrencyController] = []
+        for key in AdaptiveConcurrency.keys(builder):
+            controller = self.controller(key)
+            if not controller.try_acquire():
+                for held in acquired:
+                    held.cancel()
+                return False
+            acquired.append(controller)
+        return True
+
+    def release(self, builder: PackerBuilder, success: bool, throttled: bool = False) -> None:
+        """Return *builder*'s slots and report its outcome."""
+        for key in AdaptiveConcurrency.keys(builder):
+            self.controller(key).release(success, throttled)
+
+    def throttle(self, builder: PackerBuilder) -> None:
+        """Report a throttling signal seen in *builder*'s output."""
+        for key in AdaptiveConcurrency.keys(builder):
+            self.controller(key).throttle()
+
+
+class Fleet:
+    """Run many :class:`~packerpy.builder.PackerBuilder` instances concurrently.
+
+    Builds are started longest-expected-first (LPT scheduling) on
+    *max_workers* worker slots, using a :class:`DurationHistory` for the
+    estimates, so long builds do not end up starting last and stretching the
+    fleet's makespan.
+
+    Builders may depend on each other through
+    :meth:`~packerpy.builder.PackerBuilder.add_upstream`.  A build starts as
+    soon as all its upstream builds succeeded, with their artifact IDs
+    injected into its sources; builds on the longest remaining chain
+    (critical path) start first.  Builds downstream of a failure are
+    skipped.  Durations of successful builds are recorded back into the
+    history.
+
+    With *concurrency* set, the number of builds per provider/location is
+    additionally limited by an :class:`AdaptiveConcurrency` that grows while
+    builds succeed and backs off on throttling or failure spikes; the
+    longest pending build that fits is started whenever a slot frees up.
+
+    With *journal* set, every build's progress is recorded in a
+    :class:`~packerpy.journal.BuildJournal`; rerunning the same fleet with
+    the same journal after a crash skips builds that already succeeded and
+    reattaches to builds still running.
+
+    All configs share :attr:`resolver`, so the deferred field values of the
+    whole fleet (secrets, image lookups, ...) are resolved in one concurrent
+    batch after configuration instead of one build at a time.
+
+    With *resource_interval* set, the Packer processes of every build are
+    sampled (see :attr:`PackerClient.resource_usage
+    <packerpy.client.PackerClient.resource_usage>`), their peak memory is
+    recorded in the history and their usage in the journal.  With
+    *memory_headroom* set, a build running locally (a source without a
+    location, such as Docker, or a ``shell-local`` provisioner) only starts
+    while another build is running if the host's available memory minus the
+    build's recorded peak memory stays above the headroom.
+
+    Builders must not share a template or manifest file; see
+    :meth:`separate_files`.
+
+    Example::
+
+        fleet = Fleet([WindowsAmi("win"), LinuxAmi("linux")], max_workers=4)
+        errors = fleet.run()  # templates packer-win.pkr.json and packer-linux.pkr.json
+
+    Args:
+        builders: The builders to run.
+        max_workers: Maximum number of builds running at the same time.
+        history: Duration store.  Defaults to :class:`DurationHistory` with
+            its default path.
+        concurrency: Optional adaptive per-key limits.
+        journal: Optional crash-safe journal used to resume interrupted runs.
+        resource_interval: Seconds between resource usage samples of each
+            build's Packer processes.  Disabled by default.
+        memory_headroom: Bytes of available host memory to keep free when
+            starting local builds.
+        log: Optional logger instance.
+    """
+
+    # Seconds between memory checks while local builds are held back.
+    ADMISSION_POLL_INTERVAL: float = 5.0
+
+    def __init__(
+        self,
+        builders: Iterable[PackerBuilder] = (),
+        max_workers: int = 4,
+        history: DurationHistory | None = None,
+        concurrency: AdaptiveConcurrency | None = None,
+        journal: BuildJournal | None = None,
+        resource_interval: float | None = None,
+        memory_headroom: int | None = None,
+        log: logging.Logger | None = None,
+    ) -> None:
+        self.builders: list[PackerBuilder] = list(builders)
+        self.max_workers: int = max_workers
+        self.history: DurationHistory = history or DurationHistory()
+        self.concurrency: AdaptiveConcurrency | None = concurrency
+        self.journal: BuildJournal | None = journal
+        self.resource_interval: float | None = resource_interval
+        self.memory_headroom: int | None = memory_headroom
+        self.resolver: DeferredResolver = DeferredResolver()
+        self.log: logging.Logger = log or logging.getLogger(Fleet.__name__)
+        self.separate_files()
+
+    def add(self, *builders: PackerBuilder) -> None:
+        """Add builders to the fleet.
+
+        Raises:
+            PackerBuildError: If two builders would write the same file (see :meth:`separate_files`).
+        """
+        self.builders.extend(builders)
+        self.separate_files()
+
+    def separate_files(self) -> None:
+        """Make sure no two builders write the same template or manifest file.
+
+        Builds run concurrently, so builders sharing a file would overwrite
+        each other's template and read each other's artifact from the
+        manifest.  Builders left at the default
+        :attr:`~packerpy.builder.PackerBuilder.DEFAULT_CONFIG_FILE` or
+        :attr:`~packerpy.builder.PackerBuilder.DEFAULT_MANIFEST_FILE` get
+        ``packer-<name>.pkr.json`` and ``packer-<name>-manifest.json``
+        instead.
+
+        Raises:
+            PackerBuildError: If two builders still share a file, e.g. one set explicitly.
+        """
+        for attr, default, named in (
+            ("config_file", PackerBuilder.DEFAULT_CONFIG_FILE, "packer-{}.pkr.json"),
+            ("manifest_file", PackerBuilder.DEFAULT_MANIFEST_FILE, "packer-{}-manifest.json"),
+        ):
+            defaults = [builder for builder in self.builders if getattr(builder, attr) == default]
+            if len(defaults) > 1:
+                for builder in defaults:
+                    builder.set_files(**{attr: named.format(builder.config.config_name)})
+            owners: dict[str, PackerBuilder] = {}
+            for builder in self.builders:
+                path = os.path.abspath(getattr(builder, attr))
+                owner = owners.setdefault(path, builder)
+                if owner is not builder:
+                    raise PackerBuildError(
+                        f"Builds {owner.config.config_name} and {builder.config.config_name} both write {path}"
+                    )
+
+    def configure(self) -> None:
+        """Add missing upstream builders and call :meth:`~packerpy.builder.PackerBuilder.configure` once on each.
+
+        Raises:
+            PackerBuildError: If the upstream dependencies contain a cycle.
+        """
+        index = 0
+        while index < len(self.builders):
+            for upstream, _ in self.builders[index].upstream:
+                if not any(upstream is builder for builder in self.builders):
+                    self.builders.append(upstream)
+            index += 1
+        self.separate_files()
+        for builder in Fleet.topological_order(self.builders):
+            builder.ensure_configured()
+        self.resolve()
+
+    def resolve(self) -> None:
+        """Share :attr:`resolver` between all configs and resolve every deferred value of the fleet in one batch.
+
+        Values a config's own resolver already holds are merged into
+        :attr:`resolver` rather than looked up again; an awaitable can only be
+        awaited once.
+
+        Raises:
+            PackerBuildError: If a lookup raised.
+        """
+        deferred = []
+        for builder in self.builders:
+            self.resolver.merge(builder.config.resolver)
+            builder.config.resolver = self.resolver
+            deferred.extend(find_deferred(builder.config.unresolved_json()))
+        self.resolver.resolve(deferred)
+
+    @staticmethod
+    def topological_order(builders: list[PackerBuilder]) -> list[PackerBuilder]:
+        """Return *builders* ordered so that every build comes after its upstream builds.
+
+        Raises:
+            PackerBuildError: If the upstream dependencies contain a cycle.
+        """
+        ordered: list[PackerBuilder] = []
+        state: dict[int, bool] = {}
+
+        def visit(builder: PackerBuilder, path: list[str]) -> None:
+            if state.get(id(builder)) is False:
+                cycle = " -> ".join([*path, builder.config.config_name])
+                raise PackerBuildError(f"Dependency cycle between builds: {cycle}")
+            if id(builder) in state:
+                return
+            state[id(builder)] = False
+            for upstream, _ in builder.upstream:
+                visit(upstream, [*path, builder.config.config_name])
+            state[id(builder)] = True
+            ordered.append(builder)
+
+        for builder in builders:
+            visit(builder, [])
+        return ordered
+
+    def schedule(self) -> list[tuple[PackerBuilder, float]]:
+        """Return ``(builder, estimate)`` pairs in priority order.
+
+        Builds are ranked by the length of the longest chain of estimated
+        durations from the build to the end of the dependency graph (its
+        critical path), which for independent builds is simply longest
+        estimate first.  Every build is ranked after its upstream builds.
+        """
+        self.configure()
+        ordered = Fleet.topological_order(self.builders)
+        estimates = {id(builder): self.history.estimate(builder) for builder in ordered}
+        critical: dict[int, float] = {}
+        for builder in reversed(ordered):
+            downstream = [critical[id(b)] for b in ordered if any(u is builder for u, _ in b.upstream)]
+            critical[id(builder)] = estimates[id(builder)] + max(downstream, default=0.0)
+        position = {id(builder): index for index, builder in enumerate(ordered)}
+        ranked = sorted(ordered, key=lambda b: (-critical[id(b)], position[id(b)]))
+        return [(builder, estimates[id(builder)]) for builder in ranked]
+
+    def simulate(self) -> list[tuple[PackerBuilder, int, float, float]]:
+        """Simulate :meth:`run` on :attr:`max_workers` slots using the estimated durations.
+
+        Each step starts the highest-priority build whose upstream builds are
+        scheduled, on the slot that frees up first, no earlier than its
+        upstream builds finish.
+
+        Returns:
+            ``(builder, slot, start_seconds, estimated_seconds)`` for every build.
+        """
+        remaining = self.schedule()
+        slots = [0.0] * max(1, self.max_workers)
+        finish: dict[int, float] = {}
+        ret: list[tuple[PackerBuilder, int, float, float]] = []
+        while remaining:
+            for builder, estimate in remaining:
+                if all(id(upstream) in finish for upstream, _ in builder.upstream):
+                    break
+            remaining.remove((builder, estimate))
+            slot = slots.index(min(slots))
+            start = max([slots[slot], *(finish[id(upstream)] for upstream, _ in builder.upstream)])
+            finish[id(builder)] = slots[slot] = start + estimate
+            ret.append((builder, slot, start, estimate))
+        self.log.debug(f"Expected fleet makespan: {max(slots):.0f}s")
+        return ret
+
+    def assign(self) -> list[list[PackerBuilder]]:
+        """Return the builders of each worker slot, in start order, as placed by :meth:`simulate`."""
+        slots: list[list[PackerBuilder]] = [[] for _ in range(max(1, self.max_workers))]
+        for builder, slot, _, _ in self.simulate():
+            slots[slot].append(builder)
+        return slots
+
+    def plan(self) -> dict[str, Any]:
+        """Describe what :meth:`run` would build and when, without running Packer.
+
+        Returns:
+            A JSON-serializable plan with ``max_workers``, the expected
+            ``makespan_seconds`` and one :meth:`PackerBuilder.plan` per build
+            in start order, extended with its ``upstream`` builds, worker
+            ``slot`` and expected ``start_seconds``.  Downstream builds are
+            fingerprinted before upstream artifacts are injected.
+        """
+        plans = [
+            {
+                **builder.plan(self.history),
+                "upstream": [upstream.config.config_name for upstream, _ in builder.upstream],
+                "slot": slot,
+                "start_seconds": start,
+            }
+            for builder, slot, start, _ in self.simulate()
+        ]
+        plans.sort(key=lambda plan: (plan["start_seconds"], plan["slot"]))
+        return {
+            "max_workers": self.max_workers,
+            "makespan_seconds": max((plan["start_seconds"] + plan["estimated_seconds"] for plan in plans), default=0.0),
+            "builds": plans,
+        }
+
+    def validate(
+        self, batch_size: int = 50, workspace: str = ".packerpy/validate"
+    ) -> dict[str, PackerBuildError | None]:
+        """Validate every build's template with as few Packer invocations as possible.
+
+        Templates are grouped into :class:`~packerpy.validation.ValidationBatch`
+        directories of up to *batch_size* builds, and each directory is
+        checked by a single ``packer init`` and ``packer validate``.  Up to
+        :attr:`max_workers` batches run at the same time.  Errors are mapped
+        back to the build whose file or blocks they mention.  Builds of a
+        failed batch without errors of their own are validated again in a
+        new batch.  When none of a failed batch's errors can be attributed,
+        its builds are validated one by one.
+
+        Args:
+            batch_size: Maximum number of builds per ``packer validate``.
+            workspace: Directory for the temporary batch directories.
+
+        Returns:
+            The validation error of each build, keyed by config name (``None``
+            for valid templates).
+        """
+        self.configure()
+        templates = {id(builder): builder.config.json() for builder in self.builders}
+        results: dict[str, PackerBuildError | None] = {}
+        pending, alone = list(self.builders), set()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            while pending:
+                batches: list[ValidationBatch] = []
+                for builder in pending:
+                    template = templates[id(builder)]
+                    batch = None
+                    if id(builder) not in alone:
+                        batch = next((b for b in batches if b.accepts(builder, template)), None)
+                    if batch is None:
+                        batch = ValidationBatch(1 if id(builder) in alone else batch_size)
+                        batches.append(batch)
+                    batch.add(builder, template)
+                self.log.info(f"Validating {len(pending)} templates in {len(batches)} batches")
+                pending = []
+                for batch, output in zip(batches, executor.map(lambda b: b.run(workspace, self.log), batches)):
+                    if output is None:
+                        results.update({builder.config.config_name: None for builder in batch.builders})
+                        continue
+                    attributed, unattributed = batch.attribute(output)
+                    if len(batch.builders) == 1:
+                        attributed = {0: (attributed.get(0, []) + unattributed) or output}
+                    for index, builder in enumerate(batch.builders):
+                        if index in attributed:
+                            results[builder.config.config_name] = PackerBuildError(
+                                f"Invalid packer template {builder.config_file}", output=attributed[index]
+                            )
+                            continue
+                        pending.append(builder)
+                        if not attributed:
+                            alone.add(id(builder))
+        return results
+
+    def build(self, builder: PackerBuilder) -> None:
+        """Build a configured *builder* and record its duration on success.
+
+        With a :attr:`journal`, a build interrupted by a previous crash is
+        reattached first, and its progress is journaled.
+        """
+        if self.resource_interval and not builder.client.resource_interval:
+            builder.client.resource_interval = self.resource_interval
+        journal = self.journal
+        if journal is None:
+            start = time.monotonic()
+            builder.build()
+            self.history.record(builder, time.monotonic() - start, Fleet.peak_memory(builder))
+            return
+        if journal.reattach(builder):
+            self.log.info(f"Reattached to interrupted build {builder.config.config_name}")
+            return
+
+        def started(command: str, pid: int) -> None:
+            if command == "build":
+                journal.record(
+                    "started", builder, pid=pid, process_start=BuildJournal.process_start(pid), workspace=os.getcwd()
+                )
+
+        builder.client.on_start.append(started)
+        start = time.monotonic()
+        try:
+            builder.build()
+        except BaseException as e:
+            journal.record("failed", builder, error=str(e))
+            raise
+        finally:
+            builder.client.on_start.remove(started)
+        self.history.record(builder, time.monotonic() - start, Fleet.peak_memory(builder))
+        resources = builder.client.resource_usage.get("build")
+        journal.record("succeeded", builder, artifact_id=builder.artifact_id(), resources=resources)
+
+    def run(self) -> dict[str, BaseException | None]:
+        """Configure and build every builder.
+
+        Cancellation groups (see :class:`~packerpy.output.CancellationGroup`)
+        cancelled by a fatal error during the run are reset when it ends, so
+        a rerun in the same process starts Packer again.
+
+        Returns:
+            The error raised by each build, keyed by config name (``None``
+            for builds that succeeded).
+        """
+        groups: dict[int, CancellationGroup] = {}
+        try:
+            return self.run_builds(groups)
+        finally:
+            # A group cancelled by a fatal error only fails the rest of this run.
+            for group in groups.values():
+                if group.cancelled:
+                    self.log.info(f"Resetting cancellation group {group.key}")
+                    group.reset()
+
+    def run_builds(self, groups: dict[int, CancellationGroup]) -> dict[str, BaseException | None]:
+        """Run the builds for :meth:`run`, adding the cancellation groups of started builds to *groups*."""
+        results: dict[str, BaseException | None] = {}
+        artifacts: dict[int, str | None] = {}
+        pending = [builder for builder, _ in self.schedule()]
+        if self.journal:
+            for builder in pending:
+                if builder.config.config_name not in self.journal.entries:
+                    self.journal.record("planned", builder)
+        running: dict[Future[None], tuple[PackerBuilder, ThrottleSink]] = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            while pending or running:
+                waiting, deferred = len(pending), False
+                for builder in list(pending):
+                    name = builder.config.config_name
+                    upstream = [u for u, _ in builder.upstream]
+                    failed = [u.config.config_name for u in upstream if results.get(u.config.config_name)]
+                    if failed:
+                        pending.remove(builder)
+                        results[name] = PackerBuildError(f"Upstream build {', '.join(failed)} failed")
+                        self.log.error(f"Skipping {name}: {results[name]}")
+                        continue
+                    if not all(id(u) in artifacts for u in upstream):
+                        continue
+                    if len(running) >= max(1, self.max_workers):
+                        break
+                    for u in upstream:
+                        if artifacts[id(u)]:
+                            builder.inject_upstream_artifact(u, artifacts[id(u)])
+                    if self.journal and self.journal.completed(builder):
+                        self.log.info(f"Skipping {name}: already built")
+                        pending.remove(builder)
+                        results[name] = None
+                        artifacts[id(builder)] = self.journal.last(builder).get("artifact_id")
+                        continue
+                    if running and not self.admit(builder):
+                        deferred = True
+                        continue
+                    if self.concurrency and not self.concurrency.try_acquire(builder):
+                        continue
+                    pending.remove(builder)
+                    running[executor.submit(self.build, builder)] = (builder, self.watch(builder))
+                    if builder.client.cancellation_group is not None:
+                        groups[id(builder.client.cancellation_group)] = builder.client.cancellation_group
+                if not running:
+                    if len(pending) == waiting:
+                        names = ", ".join(builder.config.config_name for builder in pending)
+                        raise PackerBuildError(f"Cannot schedule builds: {names}")
+                    continue
+                timeout = Fleet.ADMISSION_POLL_INTERVAL if deferred else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    builder, sink = running.pop(future)
+                    builder.client.sinks.remove(sink)
+                    name = builder.config.config_name
+                    results[name] = future.exception()
+                    if self.concurrency:
+                        self.concurrency.release(builder, results[name] is None, sink.throttled > 0)
+                    if results[name] is not None:
+                        self.log.error(f"Build {name} failed: {results[name]}")
+                    else:
+                        artifacts[id(builder)] = builder.artifact_id()
+        return results
+
+    def admit(self, builder: PackerBuilder) -> bool:
+        """Return ``True`` unless *builder* runs locally and would eat into :attr:`memory_headroom`."""
+        if self.memory_headroom is None or not Fleet.runs_locally(builder):
+            return True
+        available = memory_available()
+        if available is None:
+            return True
+        expected = self.history.expected_memory(builder)
+        if available - expected >= self.memory_headroom:
+            return True
+        self.log.debug(
+            f"Holding back {builder.config.config_name}: {available} bytes available, {expected} bytes expected"
+        )
+        return False
+
+    @staticmethod
+    def runs_locally(builder: PackerBuilder) -> bool:
+        """Return ``True`` if *builder* has a source without a location (e.g. Docker) or a ``shell-local`` step."""
+        return any(source.LOCATION_FIELD is None for source in builder.config.builder_sources.values()) or any(
+            isinstance(provisioner, ShellLocalProvisioner)
+            for block in builder.config.builders
+            for provisioner in block.provisioners
+        )
+
+    @staticmethod
+    def peak_memory(builder: PackerBuilder) -> int | None:
+        """Return the peak resident memory sampled during *builder*'s ``packer build``, if it was sampled."""
+        usage = builder.client.resource_usage.get("build")
+        return usage["rss_bytes_peak"] if usage and usage["samples"] else None
+
+    def watch(self, builder: PackerBuilder) -> ThrottleSink:
+        """Attach a :class:`~packerpy.output.ThrottleSink` reporting to :attr:`concurrency` to *builder*'s client."""
+        concurrency = self.concurrency
+        sink = ThrottleSink(lambda line: concurrency.throttle(builder) if concurrency else None)
+        builder.client.sinks.append(sink)
+        return sink
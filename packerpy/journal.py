@@ -0,0 +1,143 @@
+"""Crash-safe journal of fleet builds."""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Any
+
+from .builder import PackerBuilder
+from .resources import PROC
+
+
+class BuildJournal:
+    """Append-only, fsync'd JSON Lines journal of the builds of a fleet run.
+
+    Every state change of a build is appended as one line and flushed to
+    disk before the call returns:
+
+    - ``planned``: the build is part of the run.
+    - ``started``: ``packer build`` was spawned (``pid``, ``process_start``:
+      its start time from ``/proc`` if available, ``workspace``: the directory
+      Packer runs in).
+    - ``succeeded``: the build finished (``artifact_id`` from the manifest,
+      and the ``resources`` used by ``packer build`` if they were sampled).
+    - ``failed``: the build raised (``error``).
+
+    Each entry also carries the config ``fingerprint``, so a journal only
+    vouches for builds of an unchanged template.  If the orchestrating
+    process dies, a new :class:`~packerpy.fleet.Fleet` given the same
+    journal skips succeeded builds, waits for builds whose Packer process
+    is still running and reruns everything else.  Use a new journal path for
+    every release.
+
+    Args:
+        path: The journal file.  Appended to if it exists.
+        poll_interval: Seconds between liveness checks of a reattached process.
+    """
+
+    def __init__(self, path: str = ".packerpy/journal.jsonl", poll_interval: float = 5.0) -> None:
+        self.path: str = path
+        self.poll_interval: float = poll_interval
+        self.lock: threading.Lock = threading.Lock()
+        self.entries: dict[str, dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write.
+                        continue
+                    self.entries[entry["build"]] = entry
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.fp = open(path, "a")
+
+    def record(self, event: str, builder: PackerBuilder, **fields: Any) -> dict[str, Any]:
+        """Append an *event* for *builder* and fsync it.
+
+        Returns:
+            The journal entry that was written.
+        """
+        entry = {
+            "build": builder.config.config_name,
+            "event": event,
+            "fingerprint": builder.config.fingerprint(),
+            "time": time.time(),
+            **fields,
+        }
+        with self.lock:
+            self.fp.write(json.dumps(entry) + "\n")
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.entries[entry["build"]] = entry
+        return entry
+
+    def last(self, builder: PackerBuilder) -> dict[str, Any] | None:
+        """Return the latest entry for *builder* if it was written for the current fingerprint."""
+        entry = self.entries.get(builder.config.config_name)
+        if entry and entry["fingerprint"] == builder.config.fingerprint():
+            return entry
+        return None
+
+    def completed(self, builder: PackerBuilder) -> bool:
+        """Return ``True`` if *builder* already succeeded with its current template."""
+        entry = self.last(builder)
+        return entry is not None and entry["event"] == "succeeded"
+
+    def reattach(self, builder: PackerBuilder) -> bool:
+        """Resume tracking a build that was running when the journal was last written.
+
+        If the recorded Packer process is still alive, this blocks until it
+        exits.  A process is only considered the recorded one if its start
+        time matches, so a pid reused after a reboot or agent restart is not
+        waited for.  The build counts as succeeded when the manifest was written
+        after the build started.
+
+        Returns:
+            ``True`` if the interrupted build succeeded and was recorded as such.
+        """
+        entry = self.last(builder)
+        if entry is None or entry["event"] != "started":
+            return False
+        while BuildJournal.process_alive(entry["pid"], entry.get("process_start")):
+            time.sleep(self.poll_interval)
+        manifest = builder.manifest_file
+        if not os.path.exists(manifest) or os.path.getmtime(manifest) < entry["time"]:
+            return False
+        artifact_id = builder.artifact_id()
+        if artifact_id is None:
+            return False
+        self.record("succeeded", builder, artifact_id=artifact_id, reattached=True)
+        return True
+
+    @staticmethod
+    def process_alive(pid: int, start: str | None = None) -> bool:
+        """Return ``True`` if a process with *pid* exists and, if *start* is given, started at *start*."""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return start is None or BuildJournal.process_start(pid) == start
+
+    @staticmethod
+    def process_start(pid: int, proc: str = PROC) -> str | None:
+        """Return the start time of *pid* in clock ticks after boot (``/proc/<pid>/stat`` field 22), or ``None``."""
+        try:
+            with open(os.path.join(proc, str(pid), "stat"), "r") as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        # The command name may contain spaces and parentheses; it ends at the last ")".
+        return data[data.rindex(")") + 2 :].split()[19]
+
+    def close(self) -> None:
+        """Close the journal file."""
+        with self.lock:
+            self.fp.close()
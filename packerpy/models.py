@@ -7,18 +7,37 @@ file and can serialize itself to the JSON structure that Packer expects.
 
 from __future__ import annotations
 
+import copy
+import hashlib
 import json
 import logging
 import os
 import re
 from platform import machine
-from typing import Any
+from typing import IO, Any
 
-import hcl2
 from typing_extensions import override
 
+from .deferred import DeferredResolver, is_deferred
 from .exceptions import PackerBuildError, raise_
-from .util import parse_list
+from .optimizers import TemplateOptimizer
+from .profiling import profiled_phase
+from .util import SCRIPT_RESOLVER, parse_list
+
+
+def load_hcl(fp: IO[str]) -> dict[str, Any]:
+    """Parse an HCL file object.  ``hcl2`` (and its Lark parser) is only imported on first use."""
+    import hcl2
+
+    return hcl2.load(fp)
+
+
+def loads_hcl(text: str) -> dict[str, Any]:
+    """Parse an HCL string.  ``hcl2`` (and its Lark parser) is only imported on first use."""
+    import hcl2
+
+    return hcl2.loads(text)
+
 
 # ---------------------------------------------------------------------------
 # Base classes
@@ -48,6 +67,9 @@ class PackerResource:
         name: The user-defined name for this resource.
     """
 
+    # Attributes holding credentials that must never appear in build output.
+    SECRET_FIELDS: tuple[str, ...] = ()
+
     def __init__(self, _type: str | None = None, name: str | None = None) -> None:
         self.type: str | None = _type
         self.name: str | None = name
@@ -65,6 +87,10 @@ class PackerResource:
         """Return ``True`` if both *type* and *name* are unset."""
         return not any((self.type, self.name))
 
+    def secrets(self) -> list[str]:
+        """Return the values of this resource's :attr:`SECRET_FIELDS` that are set."""
+        return [value for field in self.SECRET_FIELDS if isinstance(value := getattr(self, field, None), str) and value]
+
     @staticmethod
     def check_exclusive_inputs(**inputs: Any) -> None:
         """Validate that exactly one of the given inputs is truthy (XOR).
@@ -248,6 +274,10 @@ class BuilderSourceConfig(PackerResource):
         name: A unique name for this source within the template.
     """
 
+    # Attribute naming the region/zone this source launches in, used to group
+    # builds that share provider API limits.
+    LOCATION_FIELD: str | None = None
+
     def __init__(self, _type: str, name: str) -> None:
         super().__init__(_type=_type, name=name)
 
@@ -265,11 +295,83 @@ class BuilderSourceConfig(PackerResource):
     def is_empty(self) -> bool:
         return not any((self.type, self.name))
 
+    def concurrency_key(self) -> str:
+        """Return the provider/location key of this source, e.g. ``"amazon-ebs:us-east-1"`` or ``"docker:local"``."""
+        location = getattr(self, self.LOCATION_FIELD, None) if self.LOCATION_FIELD else None
+        return f"{self.type}:{location or 'local'}"
+
+    def inject_artifact(self, artifact_id: str) -> None:
+        """Use the artifact of an upstream build (from its manifest) as this source's base image.
+
+        Raises:
+            PackerBuildError: If this source type cannot build on another artifact.
+        """
+        raise PackerBuildError(f"{self.type} sources cannot consume upstream artifact {artifact_id}")
+
+    def checkpoint(self, key: str) -> tuple[BuilderSourceConfig, list[PostProcessor], str | None]:
+        """Return how to build an intermediate checkpoint of this source for a staged build.
+
+        Args:
+            key: The checkpoint key of the stage.
+
+        Returns:
+            A copy of this source configured to produce a reusable artifact,
+            the post-processors to add to the stage, and the checkpoint's
+            artifact ID if it is known in advance (otherwise it is read from
+            the stage's manifest).
+
+        Raises:
+            PackerBuildError: If this source type does not support checkpoints.
+        """
+        raise PackerBuildError(f"{self.type} sources do not support checkpoints")
+
+    @staticmethod
+    def checkpoint_name(name: str, key: str) -> str:
+        """Return a unique artifact name for the checkpoint *key* of an artifact named *name*."""
+        suffix = "" if "{{timestamp}}" in name else "-{{timestamp}}"
+        return f"{name}-stage-{key[:12]}{suffix}"
+
     @staticmethod
     def merge_builder_source_json(*builder_sources: BuilderSourceConfig) -> dict[str, Any]:
         """Merge multiple builder sources into a single ``"source"`` block."""
         return {"source": [builder_source.json() for builder_source in builder_sources]}
 
+    @staticmethod
+    def expand_source_overrides(content: dict[str, Any]) -> list[dict[str, Any]]:
+        """Return the ``"source"`` entries of a parsed config with build-level overrides expanded.
+
+        A build block may reference a base source through Packer's override
+        syntax (``"source": [{"amazon-ebs.base": {"name": "variant", ...}}]``).
+        Each override is expanded into a full source definition by merging it
+        over its base.  Base sources that are only used through overrides are
+        dropped, since they are usually incomplete on their own.
+        """
+        raw_sources = {
+            f"{_type}.{name}": (_type, name, attrs)
+            for source in content.get("source", [])
+            for _type, named in source.items()
+            for name, attrs in named.items()
+        }
+        referenced = {source for build in content.get("build", []) for source in build.get("sources", [])}
+        expanded: dict[str, dict[str, Any]] = {}
+        override_bases: set[str] = set()
+        for build in content.get("build", []):
+            for override_block in build.get("source", []):
+                for label, source_override in override_block.items():
+                    if label not in raw_sources:
+                        raise PackerBuildError(f"Source override references unknown source {label}")
+                    _type, base_name, base_attrs = raw_sources[label]
+                    override_bases.add(label)
+                    name = source_override.get("name", base_name)
+                    attrs = {**base_attrs, **{k: v for k, v in source_override.items() if k != "name"}}
+                    expanded[f"{_type}.{name}"] = {_type: {name: attrs}}
+        ret = [
+            {_type: {name: attrs}}
+            for label, (_type, name, attrs) in raw_sources.items()
+            if label not in expanded and (label not in override_bases or f"source.{label}" in referenced)
+        ]
+        return ret + list(expanded.values())
+
     @classmethod
     def load_builder_source_config(cls, content: dict[str, Any]) -> BuilderSourceConfig:
         """Construct a :class:`BuilderSourceConfig` from a raw JSON/HCL source block."""
@@ -315,6 +417,9 @@ class AmazonEbs(BuilderSourceConfig):
         **kwargs: Optional parameters — see Packer docs for the full list.
     """
 
+    LOCATION_FIELD = "region"
+    SECRET_FIELDS = ("access_key", "secret_key", "token")
+
     def __init__(
         self,
         name: str,
@@ -358,6 +463,27 @@ class AmazonEbs(BuilderSourceConfig):
         self.snapshot_tags: dict[str, str] = kwargs.get("snapshot_tags", {})
         self.snapshot_users: list[str] = kwargs.get("snapshot_users", [])
 
+    @override
+    def inject_artifact(self, artifact_id: str) -> None:
+        """Build on an upstream AMI.
+
+        Amazon artifact IDs list one ``region:ami-id`` pair per region the AMI
+        was copied to; the AMI in this source's region is used.
+        """
+        amis = dict(pair.split(":", 1) for pair in artifact_id.split(",") if ":" in pair)
+        if amis and self.region not in amis:
+            raise PackerBuildError(f"Upstream artifact {artifact_id} has no AMI in region {self.region}")
+        self.source_ami = amis[self.region] if amis else artifact_id
+        self.source_ami_filter = None
+
+    @override
+    def checkpoint(self, key: str) -> tuple[BuilderSourceConfig, list[PostProcessor], str | None]:
+        """Create an intermediate AMI in this source's region only, without sharing it."""
+        source = copy.deepcopy(self)
+        source.ami_name = BuilderSourceConfig.checkpoint_name(self.ami_name, key)
+        source.ami_regions, source.ami_users, source.snapshot_users = [], [], []
+        return source, [], None
+
     class LaunchBlockDeviceMappings(SupportingType):
         """EBS volume configuration for the launch instance.
 
@@ -430,6 +556,9 @@ class GoogleComputeBuilder(BuilderSourceConfig):
         **kwargs: Optional parameters — see Packer docs for the full list.
     """
 
+    LOCATION_FIELD = "zone"
+    SECRET_FIELDS = ("access_token",)
+
     def __init__(
         self,
         name: str,
@@ -470,6 +599,20 @@ class GoogleComputeBuilder(BuilderSourceConfig):
         self.use_iap: bool = kwargs.get("use_iap", False)
         self.use_os_login: bool = kwargs.get("use_os_login", False)
 
+    @override
+    def inject_artifact(self, artifact_id: str) -> None:
+        """Build on an upstream image, replacing any ``source_image_family``."""
+        self.source_image = artifact_id
+        self.source_image_family = None
+
+    @override
+    def checkpoint(self, key: str) -> tuple[BuilderSourceConfig, list[PostProcessor], str | None]:
+        """Create an intermediate image outside of any image family."""
+        source = copy.deepcopy(self)
+        source.image_name = BuilderSourceConfig.checkpoint_name(self.image_name or "packer", key)
+        source.image_family = None
+        return source, [], None
+
 
 class DockerBuilder(BuilderSourceConfig):
     """Docker image builder source.
@@ -486,9 +629,13 @@ class DockerBuilder(BuilderSourceConfig):
         discard: If ``True``, discard the container after provisioning.
         export_path: Path to export the container filesystem as a tarball.
         **kwargs: Optional parameters including ``changes``, ``platform``,
-            and ``local_build_vars``.
+            ``pull`` and ``local_build_vars``.  ``local_build_vars`` are not written to
+            the template; they are exported to the Packer process through the
+            owning :class:`PackerConfig`'s environment overlay.
     """
 
+    CHECKPOINT_REPOSITORY = "packerpy-checkpoint"
+
     def __init__(
         self,
         name: str,
@@ -508,17 +655,46 @@ class DockerBuilder(BuilderSourceConfig):
         self.export_path: str | None = export_path
         self.changes: list[str] = kwargs.get("changes", [])
         self.platform: str = kwargs.get("platform", DockerBuilder.default_platform())
-        DockerBuilder.set_local_build_vars(**kwargs.get("local_build_vars", {}))
+        self.pull: bool | None = kwargs.get("pull", None)
+        self.local_build_vars: dict[str, str] = {}
+        self.set_local_build_vars(**kwargs.get("local_build_vars", {}))
+
+    @override
+    def json(self) -> dict[str, Any]:
+        attrs = PackerResource.all_defined_items(self.__dict__, "type", "name", "local_build_vars")
+        if self.pull is not None:
+            attrs["pull"] = self.pull
+        return {self.type: {self.name: attrs}}
 
     @staticmethod
     def default_platform() -> str:
         """Return ``"linux/amd64"`` on ARM64 hosts, empty string otherwise."""
         return "linux/amd64" if machine().endswith("arm64") else ""
 
-    @staticmethod
-    def set_local_build_vars(**flags: Any) -> None:
-        """Set environment variables for the local Docker build."""
-        os.environ.update({k: str(v) for k, v in flags.items()})
+    def set_local_build_vars(self, **flags: Any) -> None:
+        """Set environment variables for the local Docker build.
+
+        The variables are scoped to this source and only reach the Packer
+        process that builds it; ``os.environ`` is left untouched.
+        """
+        self.local_build_vars.update({k: str(v) for k, v in flags.items()})
+
+    @override
+    def inject_artifact(self, artifact_id: str) -> None:
+        """Build on an upstream image (an image ID or ``repository:tag``) from the local daemon."""
+        self.image = artifact_id
+        self.pull = False
+
+    @override
+    def checkpoint(self, key: str) -> tuple[BuilderSourceConfig, list[PostProcessor], str | None]:
+        """Commit the container and tag it ``packerpy-checkpoint:<key>`` in the local daemon."""
+        source = copy.deepcopy(self)
+        source.commit, source.discard, source.export_path = True, None, None
+        return (
+            source,
+            [DockerTag(DockerBuilder.CHECKPOINT_REPOSITORY, tags=[key])],
+            f"{DockerBuilder.CHECKPOINT_REPOSITORY}:{key}",
+        )
 
 
 class AzureArmBuilder(BuilderSourceConfig):
@@ -539,6 +715,9 @@ class AzureArmBuilder(BuilderSourceConfig):
         **kwargs: Optional parameters — see Packer docs for the full list.
     """
 
+    LOCATION_FIELD = "location"
+    SECRET_FIELDS = ("client_secret",)
+
     def __init__(
         self,
         name: str,
@@ -629,10 +808,22 @@ class Provisioner(BuilderResource):
         **kwargs: Additional provisioner-specific options.
     """
 
+    # Attributes that may name local files uploaded or run by the provisioner.
+    LOCAL_FILE_FIELDS: tuple[str, ...] = ("source", "sources", "script", "scripts")
+
     def __init__(self, _type: str, **kwargs: Any) -> None:
         super().__init__(_type)
         self.only: list[str] = kwargs.get("only", [])
 
+    def local_files(self) -> list[str]:
+        """Return the paths in :attr:`LOCAL_FILE_FIELDS` that exist on this machine."""
+        paths: list[str] = []
+        for field in self.LOCAL_FILE_FIELDS:
+            value = getattr(self, field, None)
+            values = [value] if isinstance(value, str) else value if isinstance(value, list) else []
+            paths.extend(path for path in values if isinstance(path, str) and os.path.exists(path))
+        return paths
+
     def add_only_sources(self, *sources: BuilderSourceConfig) -> None:
         """Restrict this provisioner to run only for the specified sources."""
         for source in sources:
@@ -695,7 +886,17 @@ class ShellProvisioner(Provisioner):
         PackerResource.check_exclusive_inputs(inline=inline, script=script, scripts=scripts)
         self.inline: list[str] | None = inline
         self.script: str | None = script
-        self.scripts: list[str] | None = scripts
+        # Local directories are expanded into their scripts; other paths are
+        # kept as given since they may only exist where Packer runs.
+        self.scripts: list[str] | None = (
+            [
+                path
+                for script_path in scripts
+                for path in (SCRIPT_RESOLVER.resolve(script_path) if os.path.isdir(script_path) else [script_path])
+            ]
+            if scripts
+            else None
+        )
         self.execute_command: str | None = kwargs.get("execute_command", None)
         self.env: dict[str, str] = kwargs.get("env", {})
         self.environment_vars: list[str] = kwargs.get("environment_vars", [])
@@ -729,23 +930,27 @@ class ShellLocalProvisioner(Provisioner):
         PackerResource.check_exclusive_inputs(command=command, inline=inline, script=script, scripts=scripts)
         self.command: str | None = command
         self.inline: list[str] | None = inline
-        self.script: str | None = next(ShellLocalProvisioner.set_scripts(script)) if script else None
-        self.scripts: list[str] | None = list(ShellLocalProvisioner.set_scripts(scripts)) if scripts else None
+        self.script: str | None = ShellLocalProvisioner.set_scripts(script)[0] if script else None
+        self.scripts: list[str] | None = ShellLocalProvisioner.set_scripts(*scripts) if scripts else None
         self.env: dict[str, str] = kwargs.get("env", {})
         self.environment_vars: list[str] = kwargs.get("environment_vars", [])
         self.execute_command: str | None = kwargs.get("execute_command", None)
 
     @staticmethod
-    def set_scripts(*scripts: str) -> Any:
-        """Validate and yield script paths, recursing into directories."""
-        for script in scripts:
-            if os.path.exists(script):
-                if os.path.isdir(script):
-                    yield ShellLocalProvisioner.set_scripts(*os.listdir(script))
-                elif os.path.isfile(script):
-                    yield script
-            else:
-                raise FileExistsError(f"Invalid path {script}")
+    def set_scripts(*scripts: str) -> list[str]:
+        """Validate script paths and expand them into real file paths, recursing into directories.
+
+        Resolution goes through the process-wide
+        :data:`~packerpy.util.SCRIPT_RESOLVER`, so directories shared by many
+        provisioners are only walked once per run.
+
+        Raises:
+            FileExistsError: If a path does not exist or a directory contains no scripts.
+        """
+        resolved = SCRIPT_RESOLVER.resolve(*scripts)
+        if not resolved:
+            raise FileExistsError(f"No scripts found in {', '.join(scripts)}")
+        return resolved
 
 
 class FileProvisioner(Provisioner):
@@ -850,11 +1055,13 @@ class Manifest(PostProcessor):
 
     Args:
         output: Path to write the manifest JSON file.
+        custom_data: Optional key/value pairs stored with every build in the manifest.
     """
 
-    def __init__(self, output: str) -> None:
+    def __init__(self, output: str, custom_data: dict[str, str] | None = None) -> None:
         super().__init__("manifest")
         self.output: str = output
+        self.custom_data: dict[str, str] | None = custom_data
 
 
 class DockerImport(PostProcessor):
@@ -903,6 +1110,8 @@ class DockerPush(PostProcessor):
             ``login_password``, ``login_server``).
     """
 
+    SECRET_FIELDS = ("aws_access_key", "aws_secret_key", "aws_token", "login_password")
+
     def __init__(self, **kwargs: Any) -> None:
         super().__init__("docker-push", **kwargs)
         self.ecr_login: bool | None = kwargs.get("ecr_login", None)
@@ -953,6 +1162,8 @@ class Builder(PackerResource):
         self.sources: list[str] = []
         self.provisioners: list[Provisioner] = []
         self.post_processors: list[PostProcessor] = []
+        self.optimizers: list[TemplateOptimizer] = []
+        self.stage_boundaries: list[int] = []
 
     @override
     def __eq__(self, other: object) -> bool:
@@ -972,6 +1183,39 @@ class Builder(PackerResource):
         """Append post-processors to the build's post-processor list."""
         self.post_processors.extend(post_processors)
 
+    def add_stage_boundary(self) -> None:
+        """End a stage after the provisioners added so far.
+
+        Stage boundaries are used by checkpointed builds (see
+        :meth:`PackerBuilder.build_stages`): every stage becomes its own
+        template whose artifact is the next stage's source.
+        """
+        if self.provisioners and len(self.provisioners) not in self.stage_boundaries:
+            self.stage_boundaries.append(len(self.provisioners))
+
+    def add_optimizer(self, *optimizers: TemplateOptimizer) -> None:
+        """Register template optimizers applied, in order, to this build block by :meth:`json`."""
+        self.optimizers.extend(optimizers)
+
+    def clone(self, name: str | None = None) -> Builder:
+        """Return a copy of this build block that shares its provisioners and post-processors.
+
+        The lists are copied, so adding, removing or replacing resources of
+        the clone leaves this build block unchanged.  The resources themselves
+        are shared and must be replaced rather than modified in place.
+
+        Args:
+            name: Name of the copy.  Defaults to this build block's name.
+        """
+        builder = copy.copy(self)
+        builder.name = self.name if name is None else name
+        builder.sources = list(self.sources)
+        builder.provisioners = list(self.provisioners)
+        builder.post_processors = list(self.post_processors)
+        builder.optimizers = list(self.optimizers)
+        builder.stage_boundaries = list(self.stage_boundaries)
+        return builder
+
     @override
     def json(self) -> dict[str, Any]:
         ret: dict[str, Any] = {
@@ -986,7 +1230,7 @@ class Builder(PackerResource):
             ret["build"][0].update(Provisioner.merge_provisioner_json(*self.provisioners))
         if self.post_processors:
             ret["build"][0].update(PostProcessor.merge_post_processor_json(*self.post_processors))
-        return ret
+        return TemplateOptimizer.apply(ret, *self.optimizers)
 
     @override
     def is_empty(self) -> bool:
@@ -996,10 +1240,31 @@ class Builder(PackerResource):
         """Return sources whose string representation contains *source_name*."""
         return list(filter(lambda source_str: source_name in source_str, self.sources))
 
+    @staticmethod
+    def merge_builder_json(*builders: Builder) -> dict[str, Any]:
+        """Merge multiple builders into a single ``"build"`` block list."""
+        return {"build": [build for builder in builders for build in builder.json()["build"]]}
+
     @classmethod
     def load_builder(cls, content: dict[str, Any], name: str | None = None) -> Builder:
         """Construct a :class:`Builder` from a parsed Packer config dict.
 
+        Only the first build block is loaded; use :meth:`load_builders` to
+        load every build block in the config.
+
+        Args:
+            content: The full parsed config (expects a ``"build"`` key).
+            name: Fallback name if the config has no build block.
+
+        Raises:
+            PackerBuildError: If no build block is found and no *name* is given.
+        """
+        return cls.load_builders(content, name=name)[0]
+
+    @classmethod
+    def load_builders(cls, content: dict[str, Any], name: str | None = None) -> list[Builder]:
+        """Construct a :class:`Builder` for every build block in a parsed Packer config dict.
+
         Args:
             content: The full parsed config (expects a ``"build"`` key).
             name: Fallback name if the config has no build block.
@@ -1008,54 +1273,85 @@ class Builder(PackerResource):
             PackerBuildError: If no build block is found and no *name* is given.
         """
         try:
-            builder_data = content.get("build", [])[0]
-            builder = cls(builder_data["name"])
+            builds = content.get("build", [])
+            if not builds:
+                raise IndexError
+            return [cls.load_build_block(builder_data) for builder_data in builds]
         except (KeyError, IndexError):
             if name:
-                builder = cls(name)
-            else:
-                raise PackerBuildError("No build block found in content and no name specified for empty builder.")
-        except TypeError:
+                return [cls(name)]
+            raise PackerBuildError("No build block found in content and no name specified for empty builder.")
+        except (TypeError, AttributeError):
             raise PackerBuildError("Invalid packer config file.")
-        else:
-            builder.sources = builder_data.get("sources", [])
-            builder.add_provisioner(
-                *(
-                    PROVISIONER_LOOKUP[provisioner_type].load_provisioner(provisioner_data)
-                    for provisioner in builder_data.get("provisioner", [])
-                    for provisioner_type, provisioner_data in provisioner.items()
-                )
+
+    @classmethod
+    def load_build_block(cls, builder_data: dict[str, Any]) -> Builder:
+        """Construct a :class:`Builder` from a single raw JSON/HCL build block."""
+        builder = cls(builder_data["name"])
+        builder.sources = list(builder_data.get("sources", []))
+        for override_block in builder_data.get("source", []):
+            for label, source_override in override_block.items():
+                _type, base_name = label.split(".", 1)
+                builder.sources.append(f"source.{_type}.{source_override.get('name', base_name)}")
+        builder.add_provisioner(
+            *(
+                PROVISIONER_LOOKUP[provisioner_type].load_provisioner(provisioner_data)
+                for provisioner in builder_data.get("provisioner", [])
+                for provisioner_type, provisioner_data in provisioner.items()
             )
-            for post_processor_list_item in builder_data.get("post-processors", []):
-                for pp_type, pp_data_list in post_processor_list_item.get("post-processor", {}).items():
-                    builder.add_post_processor(
-                        POST_PROCESSOR_LOOKUP[pp_type].load_post_processor(next(iter(pp_data_list)))
-                    )
+        )
+        for post_processor_list_item in builder_data.get("post-processors", []):
+            for pp_type, pp_data_list in post_processor_list_item.get("post-processor", {}).items():
+                builder.add_post_processor(POST_PROCESSOR_LOOKUP[pp_type].load_post_processor(next(iter(pp_data_list))))
         return builder
 
 
 class PackerConfig:
     """Top-level Packer configuration that produces a complete ``.pkr.json`` template.
 
-    A ``PackerConfig`` aggregates requirements, builder sources, and a
-    :class:`Builder` (with its provisioners and post-processors) into a
-    single serializable structure.
+    A ``PackerConfig`` aggregates requirements, builder sources, and one or
+    more :class:`Builder` blocks (each with its own provisioners and
+    post-processors) into a single serializable structure.  Grouping related
+    builds into one config lets a single ``packer build -parallel-builds=N``
+    invocation run all of them, paying process start-up and plugin loading
+    only once.
+
+    Fields of sources, provisioners and post-processors may hold deferred
+    values (a zero-argument callable, a :class:`~concurrent.futures.Future`
+    or an awaitable, e.g. ``access_key=lambda: vault.read("aws")``).  They
+    are resolved concurrently, and cached, by :attr:`resolver` when the
+    template is serialized.
 
     Args:
         config_name: A human-readable name for this configuration.
         log: Optional logger instance.
     """
 
+    # Version of the :meth:`to_wire` payload layout.
+    WIRE_FORMAT: int = 1
+
     def __init__(self, config_name: str, log: logging.Logger | None = None) -> None:
         self.config_name: str = config_name
-        self.builder: Builder = Builder(self.config_name)
+        self.builders: list[Builder] = [Builder(self.config_name)]
         self.requirements: Requirements = Requirements()
         self.builder_sources: dict[str, BuilderSourceConfig] = {}
+        self.env: dict[str, str] = {}
+        self.optimizers: list[TemplateOptimizer] = []
+        self.resolver: DeferredResolver = DeferredResolver()
         self.log: logging.Logger = log or logging.getLogger(PackerConfig.__name__)
 
     def __str__(self) -> str:
         return self.config_name
 
+    @property
+    def builder(self) -> Builder:
+        """The primary (first) build block of this config."""
+        return self.builders[0]
+
+    @builder.setter
+    def builder(self, builder: Builder) -> None:
+        self.builders[0] = builder
+
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, PackerConfig):
             return NotImplemented
@@ -1063,7 +1359,7 @@ class PackerConfig:
             return all(
                 (
                     self.config_name == other.config_name,
-                    self.builder == other.builder,
+                    self.builders == other.builders,
                     self.requirements == other.requirements,
                     set(self.builder_sources.keys()) == set(other.builder_sources.keys()),
                     all(self.builder_sources[k] == other.builder_sources[k] for k in self.builder_sources),
@@ -1076,29 +1372,317 @@ class PackerConfig:
         """Replace the current requirements with *requirements*."""
         self.requirements = requirements
 
-    def add_builder_source(self, *builder_sources: BuilderSourceConfig) -> None:
-        """Register builder sources and add them to the build block."""
+    def add_builder(self, *builders: Builder) -> None:
+        """Append additional build blocks to this config.
+
+        Raises:
+            PackerBuildError: If a build block with the same name already exists.
+        """
+        for builder in builders:
+            if any(builder.name == existing.name for existing in self.builders):
+                raise PackerBuildError(f"Duplicate build block name '{builder.name}' in config {self.config_name}")
+            self.builders.append(builder)
+
+    def add_builder_source(self, *builder_sources: BuilderSourceConfig, builder: Builder | None = None) -> None:
+        """Register builder sources and add them to a build block.
+
+        Args:
+            *builder_sources: The sources to register.
+            builder: The build block to attach the sources to.  Defaults to
+                the primary :attr:`builder`.
+        """
         self.builder_sources.update({builder_source.name: builder_source for builder_source in builder_sources})
-        self.builder.add_source(*builder_sources)
+        (builder or self.builder).add_source(*builder_sources)
+
+    def add_optimizer(self, *optimizers: TemplateOptimizer) -> None:
+        """Register template optimizers applied, in order, by :meth:`json`."""
+        self.optimizers.extend(optimizers)
+
+    def clone(self, config_name: str | None = None) -> PackerConfig:
+        """Return a copy-on-write copy of this config.
+
+        Only the containers are copied: build blocks (see :meth:`Builder.clone`),
+        the source registry, :attr:`env` and :attr:`optimizers`.  Sources,
+        provisioners, post-processors, requirements and the logger are shared
+        with this config, so cloning costs the same however large the inline
+        scripts or block device mappings are.  Change a clone through its
+        ``add_*``/``set_*`` methods or :meth:`derive`; modifying a shared
+        resource in place changes every config holding it.
+
+        Args:
+            config_name: Name of the copy.  Defaults to this config's name.
+                Build blocks named after this config are renamed along.
+        """
+        config_name = self.config_name if config_name is None else config_name
+        config = copy.copy(self)
+        config.config_name = config_name
+        config.builders = [
+            builder.clone(config_name if builder.name == self.config_name else None) for builder in self.builders
+        ]
+        config.builder_sources = dict(self.builder_sources)
+        config.env = dict(self.env)
+        config.optimizers = list(self.optimizers)
+        return config
+
+    def derive(
+        self, config_name: str, source_overrides: dict[str, dict[str, Any]] | None = None, **overrides: Any
+    ) -> PackerConfig:
+        """Return a variant of this config with some source attributes overridden.
+
+        The variant is a :meth:`clone`; only the sources that are overridden
+        are copied (shallowly), everything else stays shared::
+
+            variants = [base.derive(f"web-{region}", region=region) for region in regions]
+
+        Args:
+            config_name: Name of the variant.
+            source_overrides: Attributes to set per source, keyed by source name.
+            **overrides: Attributes to set on every source that has them.
+                Applied before *source_overrides*.
+
+        Raises:
+            PackerBuildError: If *source_overrides* names an unknown source,
+                an override in *overrides* matches no source, or an override
+                would rename a source.
+        """
+        source_overrides = source_overrides or {}
+        unknown = set(source_overrides) - set(self.builder_sources)
+        if unknown:
+            raise PackerBuildError(f"Unknown sources {', '.join(sorted(unknown))} in config {self.config_name}")
+        config = self.clone(config_name)
+        applied: set[str] = set()
+        for name, source in self.builder_sources.items():
+            changes = {key: value for key, value in overrides.items() if hasattr(source, key)}
+            applied.update(changes)
+            changes.update(source_overrides.get(name, {}))
+            if not changes:
+                continue
+            if {"name", "type"} & set(changes):
+                raise PackerBuildError(f"Cannot rename source {name} of config {self.config_name}")
+            source = copy.copy(source)
+            for key, value in changes.items():
+                setattr(source, key, value)
+            config.builder_sources[name] = source
+        unused = set(overrides) - applied
+        if unused:
+            raise PackerBuildError(f"No source of config {self.config_name} has {', '.join(sorted(unused))}")
+        return config
+
+    def set_env(self, **variables: Any) -> None:
+        """Add variables to this config's environment overlay.
+
+        The overlay is applied on top of ``os.environ`` for every Packer
+        process spawned for this config (e.g. ``PACKER_LOG``,
+        ``PACKER_PLUGIN_PATH``, ``PACKER_CACHE_DIR``).
+        """
+        self.env.update({k: str(v) for k, v in variables.items()})
+
+    def secrets(self) -> list[str]:
+        """Return every secret value held by this config's sources, provisioners and post-processors."""
+        resources: list[PackerResource] = list(self.builder_sources.values())
+        for builder in self.builders:
+            resources.extend(builder.provisioners)
+            resources.extend(builder.post_processors)
+        deferred = [
+            value
+            for resource in resources
+            for field in resource.SECRET_FIELDS
+            if is_deferred(value := getattr(resource, field, None))
+        ]
+        resolved = [value for value in map(self.resolver.value, deferred) if isinstance(value, str) and value]
+        return [secret for resource in resources for secret in resource.secrets()] + resolved
+
+    def environment(self) -> dict[str, str]:
+        """Return the environment overlay for this config.
+
+        Combines :attr:`env` with the ``local_build_vars`` of any
+        :class:`DockerBuilder` sources.  Values set on the config take
+        precedence over source-level variables.
+        """
+        ret: dict[str, str] = {}
+        for builder_source in self.builder_sources.values():
+            if isinstance(builder_source, DockerBuilder):
+                ret.update(builder_source.local_build_vars)
+        ret.update(self.env)
+        return ret
 
     def json(self) -> dict[str, Any]:
-        """Serialize the full configuration to a Packer-compatible dict."""
+        """Serialize the full configuration to a Packer-compatible dict.
+
+        Deferred values are resolved in one batch before the config's
+        template optimizers run.
+        """
+        ret = self.resolver.substitute(self.unresolved_json())
+        return TemplateOptimizer.apply(ret, *self.optimizers)
+
+    def unresolved_json(self) -> dict[str, Any]:
+        """Serialize the configuration without resolving deferred values or applying config-level optimizers."""
         ret: dict[str, Any] = {}
         ret.update(self.requirements.json())
         ret.update(BuilderSourceConfig.merge_builder_source_json(*self.builder_sources.values()))
-        ret.update(self.builder.json())
+        ret.update(Builder.merge_builder_json(*self.builders))
         return ret
 
+    def fingerprint(self, template: dict[str, Any] | None = None) -> str:
+        """Return a SHA-256 digest of the serialized template and the local files it uploads or runs.
+
+        The digest is computed over canonical JSON (sorted keys, no
+        whitespace) and ignores ``manifest`` post-processors, whose output
+        path does not affect the built artifact, as well as the
+        :attr:`~PackerResource.SECRET_FIELDS` of sources and post-processors,
+        so rotating credentials keeps the fingerprint.  The contents of the
+        provisioners' :meth:`~Provisioner.local_files` are folded in through
+        :data:`~packerpy.util.SCRIPT_RESOLVER`, so editing a script changes
+        the fingerprint.
+
+        Args:
+            template: The result of :meth:`json`, if already computed.
+        """
+        template = template if template is not None else self.json()
+        sources = [
+            {
+                _type: {
+                    name: PackerConfig.without_secrets(attrs, BUILDER_SOURCE_CONFIG_LOOKUP.get(_type))
+                    for name, attrs in named.items()
+                }
+                for _type, named in source.items()
+            }
+            for source in template.get("source", [])
+        ]
+        builds = []
+        for build in template.get("build", []):
+            build = dict(build)
+            if "source" in build:
+                # Build-level source overrides are keyed "<type>.<name>".
+                build["source"] = [
+                    {
+                        reference: PackerConfig.without_secrets(
+                            attrs, BUILDER_SOURCE_CONFIG_LOOKUP.get(reference.split(".")[0])
+                        )
+                        for reference, attrs in block.items()
+                    }
+                    for block in build["source"]
+                ]
+            post_processors = []
+            for post_processor in build.pop("post-processors", []):
+                post_processor = {
+                    key: {
+                        kind: [PackerConfig.without_secrets(item, POST_PROCESSOR_LOOKUP.get(kind)) for item in attrs]
+                        if isinstance(attrs, list)
+                        else attrs
+                        for kind, attrs in value.items()
+                        if kind != "manifest"
+                    }
+                    for key, value in post_processor.items()
+                }
+                if any(post_processor.values()):
+                    post_processors.append(post_processor)
+            if post_processors:
+                build["post-processors"] = post_processors
+            builds.append(build)
+        canonical = json.dumps(
+            {**template, "source": sources, "build": builds}, sort_keys=True, separators=(",", ":"), default=str
+        )
+        digest = hashlib.sha256(canonical.encode())
+        paths = self.local_files()
+        if paths:
+            digest.update(SCRIPT_RESOLVER.fingerprint(*paths).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def without_secrets(attrs: Any, resource: type[PackerResource] | None) -> Any:
+        """Return the serialized *attrs* of a *resource* type without its :attr:`~PackerResource.SECRET_FIELDS`."""
+        if resource is None or not resource.SECRET_FIELDS or not isinstance(attrs, dict):
+            return attrs
+        return {key: value for key, value in attrs.items() if key not in resource.SECRET_FIELDS}
+
+    def local_files(self) -> list[str]:
+        """Return the local files referenced by the provisioners of every build block."""
+        return [
+            path
+            for builder in self.builders
+            for provisioner in builder.provisioners
+            for path in provisioner.local_files()
+        ]
+
+    def to_wire(self) -> bytes:
+        """Serialize this config to compact, canonical JSON bytes for another process.
+
+        The payload holds the resolved template (before config-level template
+        optimizers, which are code and must be added again by the receiver),
+        :attr:`env`, the ``local_build_vars`` of the sources (so
+        :meth:`environment` survives the round trip) and the stage boundaries
+        of every build block.  Loggers, resolvers and other per-process state
+        are left behind.  Rebuild the config with :meth:`from_wire`; large
+        payloads can be shared with :class:`~packerpy.wire.SharedPayload`.
+        Pickling a config is unaffected and keeps the whole object.
+
+        Raises:
+            PackerBuildError: If a resource type cannot be loaded back by
+                :meth:`load_config`.
+        """
+        template = self.resolver.substitute(self.unresolved_json())
+        for source in template.get("source", []):
+            PackerConfig.check_wire_types(source, BUILDER_SOURCE_CONFIG_LOOKUP, "source")
+        for build in template.get("build", []):
+            for provisioner in build.get("provisioner", []):
+                PackerConfig.check_wire_types(provisioner, PROVISIONER_LOOKUP, "provisioner")
+            for post_processor in build.get("post-processors", []):
+                PackerConfig.check_wire_types(
+                    post_processor.get("post-processor", {}), POST_PROCESSOR_LOOKUP, "post-processor"
+                )
+        payload = {
+            "format": PackerConfig.WIRE_FORMAT,
+            "name": self.config_name,
+            "env": self.env,
+            "local_build_vars": {
+                name: source.local_build_vars
+                for name, source in self.builder_sources.items()
+                if getattr(source, "local_build_vars", None)
+            },
+            "template": template,
+            "stage_boundaries": {
+                builder.name: builder.stage_boundaries for builder in self.builders if builder.stage_boundaries
+            },
+        }
+        return json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode()
+
+    @staticmethod
+    def check_wire_types(block: dict[str, Any], lookup: dict[str, Any], kind: str) -> None:
+        """Raise :class:`PackerBuildError` if a type in *block* is missing from *lookup*."""
+        unknown = set(block) - set(lookup)
+        if unknown:
+            raise PackerBuildError(f"Cannot load {kind} type {', '.join(sorted(unknown))} from the wire format")
+
+    @classmethod
+    def from_wire(cls, data: bytes | str) -> PackerConfig:
+        """Rebuild a config serialized by :meth:`to_wire` through :meth:`load_config`.
+
+        Raises:
+            PackerBuildError: If *data* is not a supported wire payload.
+        """
+        payload = json.loads(data)
+        if not isinstance(payload, dict) or payload.get("format") != PackerConfig.WIRE_FORMAT:
+            raise PackerBuildError("Unsupported packerpy wire payload")
+        config = cls.load_config(payload["name"], config_content=payload["template"])
+        config.set_env(**payload["env"])
+        for name, local_build_vars in payload.get("local_build_vars", {}).items():
+            config.builder_sources[name].set_local_build_vars(**local_build_vars)
+        for builder in config.builders:
+            builder.stage_boundaries = list(payload["stage_boundaries"].get(builder.name, []))
+        return config
+
     def is_empty(self) -> bool:
         return not any(
             (
                 not self.requirements.is_empty(),
-                not self.builder.is_empty(),
+                not all(builder.is_empty() for builder in self.builders),
                 not any((builder_source.is_empty() for builder_source in self.builder_sources.values())),
             )
         )
 
     @classmethod
+    @profiled_phase("load")
     def load_config(
         cls,
         config_name: str,
@@ -1131,11 +1715,11 @@ class PackerConfig:
         """
         file_loader = {
             "json": json.load,
-            "hcl": hcl2.load,
+            "hcl": load_hcl,
         }
         content_loader = {
             "json": json.loads,
-            "hcl": hcl2.loads,
+            "hcl": loads_hcl,
         }
         config = cls(config_name)
         if config_path:
@@ -1163,12 +1747,13 @@ class PackerConfig:
                 "[config_path|config_content (type: dict)|config_content (type: str) and config_type]"
             )
         config.set_requirements(Requirements.load_requirements(data))
-        config.builder = Builder.load_builder(data, name=config_name)
-        [
-            [
-                config.add_builder_source(BUILDER_SOURCE_CONFIG_LOOKUP[_type].load_builder_source_config(source[_type]))
-                for _type in source.keys()
-            ]
-            for source in data.get("source", [])
-        ]
+        config.builders = Builder.load_builders(data, name=config_name)
+        for source in BuilderSourceConfig.expand_source_overrides(data):
+            for _type in source.keys():
+                builder_source = BUILDER_SOURCE_CONFIG_LOOKUP[_type].load_builder_source_config(source[_type])
+                config.builder_sources[builder_source.name] = builder_source
+                # Build blocks already list the sources they use; only a config
+                # without build blocks attaches its sources to the primary block.
+                if not data.get("build"):
+                    config.builder.add_source(builder_source)
         return config
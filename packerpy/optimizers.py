@@ -0,0 +1,414 @@
+"""Template optimizer passes.
+
+Optimizers rewrite a serialized Packer template (the dict produced by
+:meth:`~packerpy.models.PackerConfig.json`) into an equivalent template that
+is cheaper for Packer to parse or execute.  They operate on plain JSON data,
+so they can be applied to generated and loaded configs alike.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import tarfile
+from typing import Any
+
+from .util import SCRIPT_RESOLVER
+
+
+class TemplateOptimizer:
+    """Base class for template rewriting passes.
+
+    Args:
+        log: Optional logger instance used to report what the pass changed.
+    """
+
+    def __init__(self, log: logging.Logger | None = None) -> None:
+        self.log: logging.Logger = log or logging.getLogger(type(self).__name__)
+
+    def optimize(self, template: dict[str, Any]) -> dict[str, Any]:
+        """Return an optimized copy of *template*.  The input is never mutated."""
+        raise NotImplementedError
+
+    @staticmethod
+    def apply(template: dict[str, Any], *optimizers: TemplateOptimizer) -> dict[str, Any]:
+        """Run *optimizers* over *template* in order."""
+        for optimizer in optimizers:
+            template = optimizer.optimize(template)
+        return template
+
+
+class SourceOverrideOptimizer(TemplateOptimizer):
+    """Factor near-identical sources into shared base sources with build-level overrides.
+
+    Sources of the same type are grouped and the attributes they all share
+    are emitted once as a base ``source`` block.  Every build that used one
+    of the grouped sources instead references the base through Packer's
+    build-block ``source`` override syntax, carrying only the attributes that
+    differ::
+
+        "build": [{"source": [{"amazon-ebs.amazon_ebs_base": {"name": "us-east-1", "region": "us-east-1"}}]}]
+
+    The override keeps the original source name, so ``only`` filters and
+    artifact names are unaffected.  Each group is only rewritten when doing
+    so makes the serialized template smaller, so the pass can be left on for
+    configs of any shape.
+
+    Args:
+        min_group_size: Minimum number of same-type sources required before a
+            group is considered for factoring.
+        log: Optional logger instance.
+    """
+
+    BASE_SUFFIX = "base"
+
+    def __init__(self, min_group_size: int = 2, log: logging.Logger | None = None) -> None:
+        super().__init__(log)
+        self.min_group_size: int = min_group_size
+
+    def optimize(self, template: dict[str, Any]) -> dict[str, Any]:
+        sources = [
+            (_type, name, attrs)
+            for source in template.get("source", [])
+            for _type, named in source.items()
+            for name, attrs in named.items()
+        ]
+        builds = template.get("build", [])
+        referenced = {source for build in builds for source in build.get("sources", [])}
+        groups: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        for _type, name, attrs in sources:
+            if f"source.{_type}.{name}" in referenced:
+                groups.setdefault(_type, []).append((name, attrs))
+
+        bases: dict[str, tuple[str, dict[str, Any]]] = {}
+        overrides: dict[str, tuple[str, dict[str, Any]]] = {}
+        taken = {f"{_type}.{name}" for _type, name, _ in sources}
+        for _type, members in groups.items():
+            if len(members) < self.min_group_size:
+                continue
+            common = SourceOverrideOptimizer.common_attributes([attrs for _, attrs in members])
+            if not common:
+                continue
+            variants = {
+                name: {"name": name, **{k: v for k, v in attrs.items() if k not in common}} for name, attrs in members
+            }
+            before = sum(SourceOverrideOptimizer.size(attrs) for _, attrs in members)
+            after = SourceOverrideOptimizer.size(common) + sum(map(SourceOverrideOptimizer.size, variants.values()))
+            if after >= before:
+                continue
+            base_name = SourceOverrideOptimizer.unique_name(_type, taken)
+            taken.add(f"{_type}.{base_name}")
+            bases[_type] = (base_name, common)
+            for name, variant in variants.items():
+                overrides[f"source.{_type}.{name}"] = (f"{_type}.{base_name}", variant)
+            self.log.debug(f"Factored {len(members)} {_type} sources into base source {_type}.{base_name}")
+
+        if not overrides:
+            return template
+        ret = {k: v for k, v in template.items() if k not in ("source", "build")}
+        ret["source"] = [
+            {_type: {name: attrs}} for _type, name, attrs in sources if f"source.{_type}.{name}" not in overrides
+        ] + [{_type: {base_name: common}} for _type, (base_name, common) in bases.items()]
+        ret["build"] = [SourceOverrideOptimizer.rewrite_build(build, overrides) for build in builds]
+        return ret
+
+    @staticmethod
+    def rewrite_build(build: dict[str, Any], overrides: dict[str, tuple[str, dict[str, Any]]]) -> dict[str, Any]:
+        """Replace references to factored sources in *build* with override blocks."""
+        ret: dict[str, Any] = {}
+        for key, value in build.items():
+            if key == "source" and key in ret:
+                continue
+            if key != "sources":
+                ret[key] = value
+                continue
+            ret["sources"] = [source for source in value if source not in overrides]
+            source_blocks = [{overrides[source][0]: overrides[source][1]} for source in value if source in overrides]
+            if source_blocks:
+                ret["source"] = build.get("source", []) + source_blocks
+        return ret
+
+    @staticmethod
+    def common_attributes(members: list[dict[str, Any]]) -> dict[str, Any]:
+        """Return the attributes that have an identical value in every member."""
+        first, *rest = members
+        return {k: v for k, v in first.items() if all(k in other and other[k] == v for other in rest)}
+
+    @staticmethod
+    def unique_name(_type: str, taken: set[str]) -> str:
+        """Return a base source name for *_type* that does not clash with *taken*."""
+        base_name = f"{_type.replace('-', '_')}_{SourceOverrideOptimizer.BASE_SUFFIX}"
+        name, counter = base_name, 1
+        while f"{_type}.{name}" in taken:
+            counter += 1
+            name = f"{base_name}_{counter}"
+        return name
+
+    @staticmethod
+    def size(data: Any) -> int:
+        """Return the serialized size of *data* in bytes."""
+        return len(json.dumps(data, separators=(",", ":")))
+
+
+class ShellFusionOptimizer(TemplateOptimizer):
+    """Merge adjacent, compatible inline ``shell`` provisioners into one.
+
+    Packer opens a remote session, uploads a script and prepares the
+    environment for every provisioner.  Runs of inline ``shell`` provisioners
+    that share every other setting (``only``/``except`` scope, environment,
+    ``execute_command``, ...) are fused into a single provisioner whose
+    ``inline`` list is the concatenation of theirs.  Only neighbours are
+    fused, so ordering relative to ``file`` and other provisioners is kept.
+
+    Provisioners using settings whose meaning depends on the step boundary
+    (retries, pauses, timeouts, expected disconnects, custom exit codes) are
+    never fused.  Note that fused commands share one shell, so ``cd``,
+    ``export`` or ``exit`` in an earlier command affect the later ones.
+
+    After each :meth:`optimize` call, :attr:`fused` lists every fusion as a
+    ``(build name, first provisioner index, number of provisioners)`` tuple.
+
+    Args:
+        log: Optional logger instance.
+    """
+
+    UNFUSABLE_KEYS = (
+        "expect_disconnect",
+        "max_retries",
+        "pause_after",
+        "pause_before",
+        "script",
+        "scripts",
+        "start_retry_timeout",
+        "timeout",
+        "valid_exit_codes",
+    )
+
+    def __init__(self, log: logging.Logger | None = None) -> None:
+        super().__init__(log)
+        self.fused: list[tuple[str, int, int]] = []
+
+    def optimize(self, template: dict[str, Any]) -> dict[str, Any]:
+        self.fused = []
+        builds = template.get("build", [])
+        if not any("provisioner" in build for build in builds):
+            return template
+        ret = dict(template)
+        ret["build"] = [self.fuse_build(build) for build in builds]
+        return ret
+
+    def fuse_build(self, build: dict[str, Any]) -> dict[str, Any]:
+        """Return a copy of *build* with adjacent compatible shell provisioners fused."""
+        if "provisioner" not in build:
+            return build
+        provisioners: list[dict[str, Any]] = []
+        run_start, run_length = 0, 0
+        for index, provisioner in enumerate(build["provisioner"]):
+            if run_length and ShellFusionOptimizer.compatible(provisioners[-1], provisioner):
+                fused = dict(provisioners[-1]["shell"])
+                fused["inline"] = fused["inline"] + provisioner["shell"]["inline"]
+                provisioners[-1] = {"shell": fused}
+                run_length += 1
+                continue
+            self.record(build, run_start, run_length)
+            provisioners.append(provisioner)
+            run_start, run_length = index, 1 if ShellFusionOptimizer.fusable(provisioner) else 0
+        self.record(build, run_start, run_length)
+        return {**build, "provisioner": provisioners}
+
+    def record(self, build: dict[str, Any], start: int, length: int) -> None:
+        """Record and log a fusion of *length* provisioners starting at *start*."""
+        if length > 1:
+            self.fused.append((build.get("name", ""), start, length))
+            self.log.info(f"Fused shell provisioners {start}-{start + length - 1} of build {build.get('name', '')}")
+
+    @staticmethod
+    def fusable(provisioner: dict[str, Any]) -> bool:
+        """Return ``True`` if *provisioner* is an inline shell provisioner that may be fused."""
+        if list(provisioner.keys()) != ["shell"]:
+            return False
+        settings = provisioner["shell"]
+        return bool(settings.get("inline")) and not any(key in settings for key in ShellFusionOptimizer.UNFUSABLE_KEYS)
+
+    @staticmethod
+    def compatible(previous: dict[str, Any], provisioner: dict[str, Any]) -> bool:
+        """Return ``True`` if *provisioner* can be appended to the fused *previous* provisioner."""
+        if not (ShellFusionOptimizer.fusable(previous) and ShellFusionOptimizer.fusable(provisioner)):
+            return False
+        previous_settings = {k: v for k, v in previous["shell"].items() if k != "inline"}
+        settings = {k: v for k, v in provisioner["shell"].items() if k != "inline"}
+        return previous_settings == settings
+
+
+class FileBundleOptimizer(TemplateOptimizer):
+    """Pack runs of ``file`` uploads into a single cached archive.
+
+    Every ``file`` provisioner (and every file inside an uploaded directory)
+    costs at least one round trip over SSH/WinRM.  Adjacent upload
+    provisioners with the same ``only``/``except`` scope are packed into one
+    gzip-compressed tarball, which is uploaded with a single ``file``
+    provisioner and unpacked with a ``shell`` provisioner.
+
+    Archives are content-addressed: the name is derived from a hash of every
+    member's destination, mode and content, so unchanged uploads reuse the
+    archive already in *cache_dir* between builds.
+
+    Only uploads with absolute destinations and local sources that exist at
+    serialization time are bundled; ``content``, ``generated`` and
+    ``download`` provisioners are left untouched.  The extract step needs
+    ``tar`` on the build instance.
+
+    After each :meth:`optimize` call, :attr:`bundled` lists every bundle as a
+    ``(build name, first provisioner index, number of provisioners, archive path)``
+    tuple.
+
+    Args:
+        cache_dir: Local directory to write archives to.
+        remote_dir: Remote directory the archive is uploaded to before extraction.
+        min_files: Minimum number of files in a run before it is bundled.
+        log: Optional logger instance.
+    """
+
+    BUNDLABLE_KEYS = {"source", "sources", "destination", "direction", "only", "except"}
+
+    def __init__(
+        self,
+        cache_dir: str = ".packerpy/bundles",
+        remote_dir: str = "/tmp",
+        min_files: int = 2,
+        log: logging.Logger | None = None,
+    ) -> None:
+        super().__init__(log)
+        self.cache_dir: str = cache_dir
+        self.remote_dir: str = remote_dir
+        self.min_files: int = min_files
+        self.bundled: list[tuple[str, int, int, str]] = []
+
+    def optimize(self, template: dict[str, Any]) -> dict[str, Any]:
+        self.bundled = []
+        builds = template.get("build", [])
+        if not any("provisioner" in build for build in builds):
+            return template
+        ret = dict(template)
+        ret["build"] = [self.bundle_build(build) for build in builds]
+        return ret
+
+    def bundle_build(self, build: dict[str, Any]) -> dict[str, Any]:
+        """Return a copy of *build* with runs of bundlable uploads replaced by an archive upload."""
+        if "provisioner" not in build:
+            return build
+        provisioners: list[dict[str, Any]] = []
+        run: list[tuple[int, dict[str, Any]]] = []
+        for index, provisioner in enumerate(build["provisioner"] + [{}]):
+            if FileBundleOptimizer.bundlable(provisioner) and (
+                not run or FileBundleOptimizer.scope(run[0][1]) == FileBundleOptimizer.scope(provisioner["file"])
+            ):
+                run.append((index, provisioner["file"]))
+                continue
+            provisioners.extend(self.bundle_run(build.get("name", ""), run))
+            run = []
+            if FileBundleOptimizer.bundlable(provisioner):
+                run.append((index, provisioner["file"]))
+            elif provisioner:
+                provisioners.append(provisioner)
+        return {**build, "provisioner": provisioners}
+
+    def bundle_run(self, build_name: str, run: list[tuple[int, dict[str, Any]]]) -> list[dict[str, Any]]:
+        """Return the provisioners replacing *run*: the original ones, or an archive upload plus extract step."""
+        members = [member for _, settings in run for member in FileBundleOptimizer.members(settings)]
+        if len(members) < self.min_files:
+            return [{"file": settings} for _, settings in run]
+        archive = self.write_archive(members)
+        remote_archive = posixpath.join(self.remote_dir, os.path.basename(archive))
+        scope = FileBundleOptimizer.scope(run[0][1])
+        self.bundled.append((build_name, run[0][0], len(run), archive))
+        self.log.info(
+            f"Bundled {len(members)} file(s) from provisioners {run[0][0]}-{run[-1][0]} of build {build_name} "
+            f"into {archive}"
+        )
+        return [
+            {"file": {"source": archive, "destination": remote_archive, **scope}},
+            {"shell": {"inline": [f"tar -xzf {remote_archive} -C /", f"rm -f {remote_archive}"], **scope}},
+        ]
+
+    def write_archive(self, members: list[tuple[str, str]]) -> str:
+        """Write a deterministic tarball of *members* unless an identical one is cached.
+
+        Args:
+            members: ``(local path, absolute remote path)`` pairs.
+
+        Returns:
+            The absolute path of the archive.
+        """
+        digest = hashlib.sha256()
+        for local_path, remote_path in sorted(members, key=lambda member: member[1]):
+            digest.update(f"{remote_path}\0{os.stat(local_path).st_mode & 0o7777}\0".encode())
+            digest.update(SCRIPT_RESOLVER.file_digest(local_path).encode())
+        archive = os.path.abspath(os.path.join(self.cache_dir, f"bundle-{digest.hexdigest()[:16]}.tar.gz"))
+        if os.path.exists(archive):
+            self.log.debug(f"Reusing cached bundle {archive}")
+            return archive
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write through a temporary file so concurrent builds never see a partial archive.
+        tmp_archive = f"{archive}.{os.getpid()}.tmp"
+        with open(tmp_archive, "wb") as fp, gzip.GzipFile(filename="", mode="wb", fileobj=fp, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                for local_path, remote_path in sorted(members, key=lambda member: member[1]):
+                    info = tar.gettarinfo(local_path, arcname=remote_path.lstrip("/"))
+                    info.mtime, info.uid, info.gid, info.uname, info.gname = 0, 0, 0, "", ""
+                    with open(local_path, "rb") as member_fp:
+                        tar.addfile(info, member_fp)
+        os.replace(tmp_archive, archive)
+        return archive
+
+    @staticmethod
+    def bundlable(provisioner: dict[str, Any]) -> bool:
+        """Return ``True`` if *provisioner* is a ``file`` upload that can go into an archive."""
+        if list(provisioner.keys()) != ["file"]:
+            return False
+        settings = provisioner["file"]
+        sources = settings.get("sources") or [settings.get("source")]
+        return (
+            set(settings) <= FileBundleOptimizer.BUNDLABLE_KEYS
+            and settings.get("direction", "upload") == "upload"
+            and str(settings.get("destination", "")).startswith("/")
+            and all(source and os.path.exists(source) for source in sources)
+        )
+
+    @staticmethod
+    def scope(settings: dict[str, Any]) -> dict[str, Any]:
+        """Return the ``only``/``except`` scope of a provisioner's settings."""
+        return {k: v for k, v in settings.items() if k in ("only", "except")}
+
+    @staticmethod
+    def members(settings: dict[str, Any]) -> list[tuple[str, str]]:
+        """Expand a ``file`` upload into ``(local path, remote path)`` pairs, following Packer's semantics.
+
+        A file source is written to the destination, or into it when the
+        destination ends with ``/``.  A directory source is copied into the
+        destination as a sub-directory, or merged into it when the source
+        ends with ``/``.  Multiple ``sources`` always go into the destination
+        directory.
+        """
+        destination = settings["destination"]
+        sources = settings.get("sources") or [settings["source"]]
+        into_directory = destination.endswith("/") or "sources" in settings
+        ret: list[tuple[str, str]] = []
+        for source in sources:
+            if os.path.isdir(source):
+                root = destination if source.endswith("/") else posixpath.join(destination, os.path.basename(source))
+                for dirpath, dirnames, filenames in os.walk(source):
+                    dirnames.sort()
+                    relative = os.path.relpath(dirpath, source)
+                    for filename in sorted(filenames):
+                        remote = posixpath.join(root, *([] if relative == "." else relative.split(os.sep)), filename)
+                        ret.append((os.path.join(dirpath, filename), posixpath.normpath(remote)))
+            elif into_directory:
+                ret.append((source, posixpath.join(destination, os.path.basename(source))))
+            else:
+                ret.append((source, destination))
+        return ret
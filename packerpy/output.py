@@ -0,0 +1,532 @@
+"""Packer output pipeline stages.
+
+:class:`~packerpy.client.PackerClient` streams every line Packer prints
+through the stages in this module before it reaches the logger or any file
+on disk.
+"""
+
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+from collections.abc import Callable, Iterable
+from datetime import datetime, timezone
+from typing import IO, Any
+
+
+class SecretRedactor:
+    """Mask secret values in Packer output.
+
+    All secrets are compiled into a single regular expression shaped like a
+    prefix trie, so each chunk of output is scanned once no matter how many
+    secrets are registered, and overlapping secrets always mask the longest
+    match.
+
+    Args:
+        secrets: The secret values to mask.
+        min_length: Secrets shorter than this are ignored, since masking them
+            would mangle unrelated output.
+        mask: The replacement text.
+    """
+
+    MASK = "<redacted>"
+
+    def __init__(self, secrets: Iterable[str] = (), min_length: int = 4, mask: str = MASK) -> None:
+        self.secrets: frozenset[str] = frozenset(
+            secret for secret in secrets if isinstance(secret, str) and len(secret) >= min_length
+        )
+        self.mask: str = mask
+        self.pattern: re.Pattern[str] | None = (
+            re.compile(SecretRedactor.trie_pattern(self.secrets)) if self.secrets else None
+        )
+
+    def redact(self, text: str) -> str:
+        """Return *text* with every secret replaced by the mask."""
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.mask, text)
+
+    @staticmethod
+    def trie_pattern(words: Iterable[str]) -> str:
+        """Compile *words* into a regular expression that mirrors their prefix trie.
+
+        Each branch point of the trie becomes an alternation whose options
+        start with distinct characters, so the regex engine discards
+        non-matching positions after a single character comparison.  The trie
+        is walked with an explicit stack, since secrets such as session
+        tokens can be longer than the recursion limit.
+        """
+        trie: dict[str, Any] = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        # Post-order walk: a node's pattern is built once all its children's are.
+        patterns: dict[int, str] = {}
+        stack: list[tuple[dict[str, Any], bool]] = [(trie, False)]
+        while stack:
+            node, visited = stack.pop()
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for char, child in node.items() if char)
+                continue
+            branches = [re.escape(char) + patterns.pop(id(child)) for char, child in sorted(node.items()) if char]
+            if not branches:
+                patterns[id(node)] = ""
+                continue
+            body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            patterns[id(node)] = f"(?:{body})?" if "" in node else body
+        return patterns[id(trie)]
+
+
+class LoggingPolicy:
+    """Decide which Packer output lines are forwarded to the logger.
+
+    The base policy forwards every line.  Subclasses sample or rate-limit
+    ordinary lines, while lines that look like errors or warnings always
+    pass.  Suppressed lines still reach every :class:`OutputSink`, so the
+    full stream remains available on disk.  One policy may be shared by
+    several clients, e.g. to cap the combined volume of concurrent builds.
+    """
+
+    IMPORTANT_PATTERN = re.compile(r"error|warn|fail|panic", re.IGNORECASE)
+
+    def allow(self, line: str) -> bool:
+        """Return ``True`` if *line* should be logged."""
+        return bool(LoggingPolicy.IMPORTANT_PATTERN.search(line)) or self.sample(line)
+
+    def sample(self, line: str) -> bool:
+        """Return ``True`` if an ordinary (non-error, non-warning) *line* should be logged."""
+        return True
+
+
+class ErrorsOnlyLoggingPolicy(LoggingPolicy):
+    """Only forward errors and warnings."""
+
+    def sample(self, line: str) -> bool:
+        return False
+
+
+class SampledLoggingPolicy(LoggingPolicy):
+    """Forward every *every*-th ordinary line, plus all errors and warnings.
+
+    Args:
+        every: Sampling interval; ``1`` forwards everything.
+    """
+
+    def __init__(self, every: int) -> None:
+        if every < 1:
+            raise ValueError(f"Invalid sampling interval {every}. Must be at least 1.")
+        self.every: int = every
+        self.count: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def sample(self, line: str) -> bool:
+        with self.lock:
+            self.count += 1
+            return (self.count - 1) % self.every == 0
+
+
+class RateLimitedLoggingPolicy(LoggingPolicy):
+    """Forward ordinary lines at up to *lines_per_second*, using a token bucket.
+
+    Args:
+        lines_per_second: Sustained rate at which tokens are added.
+        burst: Bucket capacity, i.e. the number of lines that may be forwarded
+            at once after a quiet period.  Defaults to *lines_per_second*.
+    """
+
+    def __init__(self, lines_per_second: float, burst: int | None = None) -> None:
+        self.lines_per_second: float = lines_per_second
+        self.burst: float = float(burst if burst is not None else max(1, int(lines_per_second)))
+        self.tokens: float = self.burst
+        self.updated: float = time.monotonic()
+        self.lock: threading.Lock = threading.Lock()
+
+    def sample(self, line: str) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.lines_per_second)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FatalPatternDetector:
+    """Detect output lines that mean a build cannot succeed.
+
+    All patterns are compiled into a single regular expression with one
+    named group per pattern, so each line is scanned once.
+
+    Args:
+        patterns: Mapping of pattern name to regular expression.  Defaults to
+            :attr:`DEFAULT_PATTERNS` (invalid credentials, missing source
+            images and exceeded quotas).
+    """
+
+    DEFAULT_PATTERNS: dict[str, str] = {
+        "invalid-credentials": (
+            r"AuthFailure|InvalidClientTokenId|SignatureDoesNotMatch|UnrecognizedClientException"
+            r"|ExpiredToken|invalid_client|invalid_grant|AADSTS\d+"
+        ),
+        "missing-source-image": (
+            r"InvalidAMIID\.(?:NotFound|Malformed)|No AMI was found matching filters"
+            r"|Could not find image|PlatformImageNotFound"
+        ),
+        "quota-exceeded": (
+            r"VcpuLimitExceeded|InstanceLimitExceeded|QUOTA_EXCEEDED|Quota '\w+' exceeded|QuotaExceeded"
+        ),
+    }
+
+    def __init__(self, patterns: dict[str, str] | None = None) -> None:
+        self.patterns: dict[str, str] = dict(
+            patterns if patterns is not None else FatalPatternDetector.DEFAULT_PATTERNS
+        )
+        self.group_names: dict[str, str] = {f"p{index}": name for index, name in enumerate(self.patterns)}
+        self.pattern: re.Pattern[str] | None = (
+            re.compile("|".join(f"(?P<p{index}>{regex})" for index, regex in enumerate(self.patterns.values())))
+            if self.patterns
+            else None
+        )
+
+    def match(self, line: str) -> str | None:
+        """Return the name of the first pattern matching *line*, or ``None``."""
+        if self.pattern is None:
+            return None
+        match = self.pattern.search(line)
+        return self.group_names[match.lastgroup] if match else None
+
+
+class CancellationGroup:
+    """A set of concurrently running Packer processes that are cancelled together.
+
+    Builds that share credentials, a region or a config usually fail in the
+    same way; once one of them hits a fatal error, :meth:`cancel` terminates
+    every other registered process and makes subsequent runs in the group
+    fail immediately.  :meth:`for_key` returns a process-wide group per key.
+
+    Args:
+        key: Identifier of the shared resource (e.g. a region or account).
+    """
+
+    groups: dict[str, CancellationGroup] = {}
+    groups_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, key: str = "") -> None:
+        self.key: str = key
+        self.reason: str | None = None
+        self.processes: set[Any] = set()
+        self.lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def for_key(cls, key: str) -> CancellationGroup:
+        """Return the shared group for *key*, creating it if needed."""
+        with cls.groups_lock:
+            if key not in cls.groups:
+                cls.groups[key] = cls(key)
+            return cls.groups[key]
+
+    @property
+    def cancelled(self) -> bool:
+        """``True`` once :meth:`cancel` has been called."""
+        return self.reason is not None
+
+    def register(self, process: Any) -> None:
+        """Track *process* so it is terminated if the group is cancelled."""
+        with self.lock:
+            self.processes.add(process)
+            cancelled = self.cancelled
+        if cancelled:
+            process.terminate()
+
+    def unregister(self, process: Any) -> None:
+        """Stop tracking *process*."""
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self, reason: str, origin: Any = None) -> None:
+        """Cancel the group, terminating every registered process except *origin*."""
+        with self.lock:
+            if self.reason is None:
+                self.reason = reason
+            processes = [process for process in self.processes if process is not origin]
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def reset(self) -> None:
+        """Clear the cancellation so the group can be reused."""
+        with self.lock:
+            self.reason = None
+
+
+class OutputSink:
+    """Base class for destinations that receive every (redacted) line of Packer output.
+
+    :meth:`open` is called before a Packer command starts, :meth:`write` once
+    per output line and :meth:`close` after the process exits.
+    """
+
+    def open(self, command: str) -> None:
+        """Prepare the sink for the output of *command*."""
+
+    def write(self, line: str) -> None:
+        """Consume one line of output, without its trailing newline."""
+        raise NotImplementedError
+
+    def close(self, returncode: int | None = None) -> None:
+        """Flush and release any resources held for the current command.
+
+        Args:
+            returncode: The exit code of the Packer process, if it exited.
+        """
+
+
+class ThrottleSink(OutputSink):
+    """Watch Packer output for cloud API throttling and rate-limit errors.
+
+    Args:
+        on_throttle: Optional callback invoked with each matching line.
+        pattern: Regular expression identifying throttling.  Defaults to
+            :attr:`THROTTLE_PATTERN`.
+    """
+
+    THROTTLE_PATTERN: str = (
+        r"Throttling|ThrottlingException|RequestLimitExceeded|Rate exceeded|TooManyRequests|SlowDown"
+        r"|rateLimitExceeded|userRateLimitExceeded|Too Many Requests|\b429\b"
+    )
+
+    def __init__(self, on_throttle: Callable[[str], None] | None = None, pattern: str | None = None) -> None:
+        self.on_throttle: Callable[[str], None] | None = on_throttle
+        self.pattern: re.Pattern[str] = re.compile(pattern or ThrottleSink.THROTTLE_PATTERN)
+        self.throttled: int = 0
+
+    def write(self, line: str) -> None:
+        if self.pattern.search(line):
+            self.throttled += 1
+            if self.on_throttle:
+                self.on_throttle(line)
+
+
+class LogFileSink(OutputSink):
+    """Write Packer output to ``packer-<command>.log`` files, optionally compressed and rotated.
+
+    Compressed logs are written as a stream, so memory use does not grow with
+    the log size.  When *max_bytes* is set, the current file is rotated to
+    ``<name>.1`` (shifting older backups up to *backup_count*) once that many
+    uncompressed bytes have been written.  With *backup_count* set, the log of
+    the previous run is also kept as a backup instead of being truncated.
+
+    Args:
+        directory: Directory to write log files into.
+        compression: ``None``, ``"gzip"`` or ``"zstd"``.  Zstandard needs
+            Python 3.14+ or the ``zstandard`` package.
+        max_bytes: Rotate after this many uncompressed bytes.  ``None`` disables
+            size-based rotation.  As with
+            :class:`logging.handlers.RotatingFileHandler`, nothing is rotated
+            while *backup_count* is 0.
+        backup_count: Number of rotated files to keep.
+
+    Raises:
+        ValueError: If *compression* is unsupported.
+    """
+
+    EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(
+        self,
+        directory: str,
+        compression: str | None = None,
+        max_bytes: int | None = None,
+        backup_count: int = 0,
+    ) -> None:
+        if compression not in LogFileSink.EXTENSIONS:
+            supported = ", ".join(str(k) for k in LogFileSink.EXTENSIONS)
+            raise ValueError(f"Unsupported log compression {compression}. Supported: {supported}")
+        self.directory: str = directory
+        self.compression: str | None = compression
+        self.max_bytes: int | None = max_bytes
+        self.backup_count: int = backup_count
+        self.path: str | None = None
+        self.stream: IO[str] | None = None
+        self.bytes_written: int = 0
+
+    def open(self, command: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"packer-{command}.log{LogFileSink.EXTENSIONS[self.compression]}")
+        if self.backup_count and os.path.exists(self.path):
+            self.rotate()
+        self.stream = self.open_stream(self.path)
+        self.bytes_written = 0
+
+    def write(self, line: str) -> None:
+        if self.stream is None:
+            return
+        self.stream.write(line + "\n")
+        self.bytes_written += len(line) + 1
+        if self.max_bytes and self.backup_count and self.bytes_written >= self.max_bytes:
+            self.stream.close()
+            self.rotate()
+            self.stream = self.open_stream(self.path)
+            self.bytes_written = 0
+
+    def close(self, returncode: int | None = None) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def rotate(self) -> None:
+        """Shift ``<path>.N`` to ``<path>.N+1`` and move the current file to ``<path>.1``."""
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def open_stream(self, path: str) -> IO[str]:
+        """Open a text stream at *path* using the configured compression."""
+        if self.compression == "gzip":
+            return gzip.open(path, "wt", compresslevel=6)
+        if self.compression == "zstd":
+            try:
+                from compression import zstd  # type: ignore[import-not-found]
+
+                return zstd.open(path, "wt")
+            except ImportError:
+                pass
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd log compression requires Python 3.14+ or the zstandard package")
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True))
+        return open(path, "w")
+
+
+class NdjsonLogWriter:
+    """Thread-safe, buffered writer of newline-delimited JSON records.
+
+    Records are serialized immediately but only written to *path* once
+    *flush_bytes* are buffered or *flush_interval* seconds have passed since
+    the last flush, whichever comes first.  A background thread enforces the
+    interval while output is quiet.  One writer is meant to be shared by all
+    builds logging to the same file; use :meth:`sink` to get a per-build
+    :class:`OutputSink`.
+
+    Args:
+        path: File to append records to.
+        flush_bytes: Buffer size that triggers a flush.
+        flush_interval: Maximum number of seconds a record stays buffered.
+    """
+
+    def __init__(self, path: str, flush_bytes: int = 1 << 16, flush_interval: float = 1.0) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path: str = path
+        self.flush_bytes: int = flush_bytes
+        self.flush_interval: float = flush_interval
+        self.stream: IO[str] = open(path, "a", encoding="utf-8")
+        self.buffer: list[str] = []
+        self.buffered_bytes: int = 0
+        self.last_flush: float = time.monotonic()
+        self.lock: threading.Lock = threading.Lock()
+        self.closed: threading.Event = threading.Event()
+        self.flusher: threading.Thread = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def emit(self, record: dict[str, Any]) -> None:
+        """Buffer one record, flushing if a threshold has been reached."""
+        data = json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self.lock:
+            self.buffer.append(data)
+            self.buffered_bytes += len(data)
+            if self.buffered_bytes >= self.flush_bytes or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush_locked()
+
+    def flush(self) -> None:
+        """Write all buffered records to disk."""
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self) -> None:
+        """Write all buffered records; the caller must hold :attr:`lock`."""
+        if self.buffer and not self.stream.closed:
+            self.stream.write("".join(self.buffer))
+            self.stream.flush()
+        self.buffer.clear()
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def flush_periodically(self) -> None:
+        """Background loop that flushes stale buffers until the writer is closed."""
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if self.buffer and time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.flush_locked()
+
+    def close(self) -> None:
+        """Flush remaining records and close the file."""
+        self.closed.set()
+        with self.lock:
+            self.flush_locked()
+            self.stream.close()
+
+    def sink(self, build: str) -> NdjsonSink:
+        """Return an :class:`OutputSink` that writes records for *build* to this writer."""
+        return NdjsonSink(self, build)
+
+
+class NdjsonSink(OutputSink):
+    """Emit one JSON object per Packer output line (plus start/end events) to an :class:`NdjsonLogWriter`.
+
+    Every record carries the build name, Packer command, the builder source
+    the line belongs to (parsed from Packer's ``==> type.name:`` prefix, or
+    ``null``), a UTC ISO-8601 timestamp and the monotonic offset in seconds
+    since the command started.
+
+    Args:
+        writer: The shared writer to emit records to.
+        build: Name of the build, usually the :class:`~packerpy.models.PackerConfig` name.
+    """
+
+    SOURCE_PATTERN = re.compile(r"^(?:==> |    )?([a-z0-9-]+\.[\w-]+): ")
+
+    def __init__(self, writer: NdjsonLogWriter, build: str) -> None:
+        self.writer: NdjsonLogWriter = writer
+        self.build: str = build
+        self.command: str | None = None
+        self.started: float = time.monotonic()
+
+    def open(self, command: str) -> None:
+        self.command = command
+        self.started = time.monotonic()
+        self.emit("start")
+
+    def write(self, line: str) -> None:
+        match = NdjsonSink.SOURCE_PATTERN.match(line)
+        self.emit("line", source=match.group(1) if match else None, line=line)
+
+    def close(self, returncode: int | None = None) -> None:
+        self.emit("end", returncode=returncode)
+
+    def emit(self, event: str, source: str | None = None, **fields: Any) -> None:
+        """Emit a record for *event* with the common build fields."""
+        self.writer.emit(
+            {
+                "build": self.build,
+                "command": self.command,
+                "source": source,
+                "event": event,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "offset": round(time.monotonic() - self.started, 6),
+                **fields,
+            }
+        )
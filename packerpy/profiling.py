@@ -0,0 +1,224 @@
+"""Opt-in profiling of build phases with ``cProfile`` and ``tracemalloc``."""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import logging
+import os
+import threading
+from collections.abc import Callable, Iterator
+from contextvars import ContextVar
+from typing import Any, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class NullProfiler:
+    """Profiler used when profiling is disabled.
+
+    :meth:`phase` returns a shared no-op context manager, so instrumented code
+    pays one method call per phase.
+    """
+
+    NULL_PHASE: contextlib.nullcontext[None] = contextlib.nullcontext()
+
+    def phase(self, name: str) -> contextlib.AbstractContextManager[None]:
+        """Return a no-op context manager."""
+        return NullProfiler.NULL_PHASE
+
+
+NULL_PROFILER = NullProfiler()
+CURRENT_PROFILER: ContextVar[NullProfiler] = ContextVar("packerpy_profiler", default=NULL_PROFILER)
+
+
+def current_profiler() -> NullProfiler:
+    """Return the profiler of the phase running in this context.
+
+    Lets code without access to a builder (such as
+    :meth:`PackerConfig.load_config <packerpy.models.PackerConfig.load_config>`
+    called from ``configure()``) report a nested phase.
+    """
+    return CURRENT_PROFILER.get()
+
+
+def profiled_phase(name: str) -> Callable[[F], F]:
+    """Decorate a function to run as phase *name* of the :func:`current_profiler`."""
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with current_profiler().phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+class PhaseProfiler(NullProfiler):
+    """Profile named build phases and write a report per phase to *directory*.
+
+    Each time a phase runs, ``<phase>.pstats`` (load with :mod:`pstats` or
+    ``snakeviz``) and ``<phase>.allocations.txt`` (the *top* source lines by
+    memory allocated during the phase, and the peak traced memory) are
+    written.  Repeated phases get a counter suffix (``run.2``).
+
+    CPU profiles are exclusive: a nested phase pauses the enclosing phase's
+    profile.  Only one ``cProfile`` profile can be active per process on
+    Python 3.12+, so a phase that starts while another thread is profiling
+    is measured for memory only.  ``tracemalloc`` runs while any phase is
+    active, and is only imported when profiling is enabled.
+
+    Args:
+        directory: Directory the reports are written to.
+        cpu: Profile with ``cProfile``.
+        memory: Trace allocations with ``tracemalloc``.
+        top: Number of allocation sites in memory reports.
+        log: Optional logger instance.
+    """
+
+    # Environment variable read by :meth:`from_setting` when no setting is given.
+    ENV_VAR: str = "PACKERPY_PROFILE"
+    MODES: tuple[str, ...] = ("cpu", "memory")
+
+    def __init__(
+        self,
+        directory: str,
+        cpu: bool = True,
+        memory: bool = True,
+        top: int = 25,
+        log: logging.Logger | None = None,
+    ) -> None:
+        self.directory: str = directory
+        self.cpu: bool = cpu
+        self.memory: bool = memory
+        self.top: int = top
+        self.log: logging.Logger = log or logging.getLogger(PhaseProfiler.__name__)
+        self.lock: threading.Lock = threading.Lock()
+        self.local: threading.local = threading.local()
+        self.counts: dict[str, int] = {}
+        self.active: int = 0
+        self.tracing: bool = False
+        self.reports: list[str] = []
+
+    @classmethod
+    def from_setting(
+        cls, setting: bool | str | NullProfiler | None, directory: str, log: logging.Logger | None = None
+    ) -> NullProfiler:
+        """Return the profiler selected by *setting*.
+
+        Args:
+            setting: A profiler (returned as is), ``True`` for CPU and memory
+                profiling, ``False`` to disable profiling, a comma-separated
+                list of :attr:`MODES` (``"cpu"``, ``"memory"``, or ``"1"``
+                for both), or ``None`` to read :attr:`ENV_VAR`.
+            directory: Report directory of a new profiler.
+            log: Optional logger instance.
+
+        Raises:
+            ValueError: If *setting* names an unknown mode.
+        """
+        if isinstance(setting, NullProfiler):
+            return setting
+        if setting is None:
+            setting = os.environ.get(cls.ENV_VAR, "")
+        if setting is False or str(setting).strip().lower() in ("", "0", "false", "no", "off"):
+            return NULL_PROFILER
+        modes = {mode.strip() for mode in str(setting).lower().split(",")}
+        if setting is True or modes & {"1", "true", "yes", "on", "all"}:
+            modes = set(cls.MODES)
+        unknown = modes - set(cls.MODES)
+        if unknown:
+            raise ValueError(f"Unknown profile modes {', '.join(sorted(unknown))}. Supported: {', '.join(cls.MODES)}")
+        return cls(directory, cpu="cpu" in modes, memory="memory" in modes, log=log)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Profile the enclosed block as phase *name*."""
+        with self.lock:
+            self.counts[name] = count = self.counts.get(name, 0) + 1
+        label = name if count == 1 else f"{name}.{count}"
+        stack: list[Any] = self.local.__dict__.setdefault("stack", [])
+        profile = self.start_cpu(label, stack[-1] if stack else None) if self.cpu else None
+        stack.append(profile)
+        snapshot = self.start_memory() if self.memory else None
+        token = CURRENT_PROFILER.set(self)
+        try:
+            yield
+        finally:
+            CURRENT_PROFILER.reset(token)
+            stack.pop()
+            os.makedirs(self.directory, exist_ok=True)
+            if profile is not None:
+                profile.disable()
+                self.write_cpu(label, profile)
+                if stack and stack[-1] is not None:
+                    stack[-1].enable()
+            if snapshot is not None:
+                self.write_memory(label, snapshot)
+                self.stop_memory()
+
+    def start_cpu(self, label: str, enclosing: Any) -> Any:
+        """Pause the *enclosing* phase's profile and start one for *label*, or return ``None`` if unavailable."""
+        import cProfile
+
+        if enclosing is not None:
+            enclosing.disable()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            self.log.warning(f"Not profiling CPU of phase {label}: {e}")
+            if enclosing is not None:
+                enclosing.enable()
+            return None
+        return profile
+
+    def start_memory(self) -> Any:
+        """Start tracing allocations if needed and return a snapshot of the current state."""
+        import tracemalloc
+
+        with self.lock:
+            self.active += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+        tracemalloc.reset_peak()
+        return tracemalloc.take_snapshot()
+
+    def stop_memory(self) -> None:
+        """Stop tracing allocations when the last active phase that started it ends."""
+        import tracemalloc
+
+        with self.lock:
+            self.active -= 1
+            if self.active == 0 and self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+    def write_cpu(self, label: str, profile: Any) -> None:
+        """Dump *profile* to ``<label>.pstats``."""
+        path = os.path.join(self.directory, f"{label}.pstats")
+        profile.dump_stats(path)
+        self.record(label, path)
+
+    def write_memory(self, label: str, before: Any) -> None:
+        """Write the top allocations since the *before* snapshot to ``<label>.allocations.txt``."""
+        import tracemalloc
+
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib.*"))
+        after = tracemalloc.take_snapshot().filter_traces(ignored)
+        _, peak = tracemalloc.get_traced_memory()
+        path = os.path.join(self.directory, f"{label}.allocations.txt")
+        with open(path, "w") as fp:
+            fp.write(f"# {label}: peak traced memory {peak / 1024:.1f} KiB\n")
+            for stat in after.compare_to(before.filter_traces(ignored), "lineno")[: self.top]:
+                fp.write(f"{stat}\n")
+        self.record(label, path)
+
+    def record(self, label: str, path: str) -> None:
+        """Add *path* to :attr:`reports`."""
+        with self.lock:
+            self.reports.append(path)
+        self.log.debug(f"Wrote profile of phase {label} to {path}")
@@ -0,0 +1,174 @@
+"""Resource usage sampling of Packer process trees from ``/proc``."""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Any
+
+PROC = "/proc"
+CLOCK_TICKS: int = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE: int = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def memory_available(proc: str = PROC) -> int | None:
+    """Return the host's ``MemAvailable`` in bytes, or ``None`` without ``/proc/meminfo``."""
+    try:
+        with open(os.path.join(proc, "meminfo"), "r") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class ProcessTreeMonitor:
+    """Sample the CPU time, resident memory and disk I/O of a process and all its descendants.
+
+    A background thread reads ``/proc/<pid>/stat`` and ``/proc/<pid>/io`` of
+    every process in the tree every *interval* seconds.  CPU time and I/O
+    bytes are cumulative per process, so the last value seen for each pid is
+    summed, including processes that have exited since; processes that live
+    shorter than *interval* may be missed.  Work done by daemons on the
+    build's behalf (e.g. containers started by ``dockerd``) is not part of
+    the tree.
+
+    Args:
+        pid: The root process, usually ``packer``.
+        interval: Seconds between samples.
+        proc: Mount point of procfs.
+        log: Optional logger instance.
+    """
+
+    def __init__(self, pid: int, interval: float = 1.0, proc: str = PROC, log: logging.Logger | None = None) -> None:
+        self.pid: int = pid
+        self.interval: float = interval
+        self.proc: str = proc
+        self.log: logging.Logger = log or logging.getLogger(ProcessTreeMonitor.__name__)
+        self.lock: threading.Lock = threading.Lock()
+        self.stopped: threading.Event = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.started: float = time.monotonic()
+        self.finished: float | None = None
+        self.cpu: dict[int, float] = {}
+        self.io: dict[int, tuple[int, int]] = {}
+        self.samples: int = 0
+        self.rss_total: int = 0
+        self.rss_peak: int = 0
+        self.cpu_percent_peak: float = 0.0
+        self.processes_peak: int = 0
+        self.last: tuple[float, float] | None = None
+
+    def start(self) -> None:
+        """Take a first sample and start sampling in the background."""
+        self.started = time.monotonic()
+        self.sample()
+        self.thread = threading.Thread(target=self.loop, name=f"packerpy-monitor-{self.pid}", daemon=True)
+        self.thread.start()
+
+    def loop(self) -> None:
+        """Sample every :attr:`interval` seconds until :meth:`stop` is called."""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                self.log.debug(f"Stopped sampling process {self.pid}: {e}")
+                return
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.finished = time.monotonic()
+
+    def tree(self) -> dict[int, list[str]]:
+        """Return the :meth:`read_stat` fields of :attr:`pid` and all its live descendants, keyed by pid."""
+        stats: dict[int, list[str]] = {}
+        children: dict[int, list[int]] = {}
+        for entry in os.listdir(self.proc):
+            if entry.isdigit():
+                stat = self.read_stat(int(entry))
+                if stat:
+                    stats[int(entry)] = stat
+                    children.setdefault(int(stat[1]), []).append(int(entry))
+        tree, queue = {}, [self.pid]
+        while queue:
+            pid = queue.pop()
+            if pid in stats:
+                tree[pid] = stats[pid]
+            queue.extend(children.get(pid, []))
+        return tree
+
+    def read_stat(self, pid: int) -> list[str] | None:
+        """Return the fields of ``/proc/<pid>/stat`` after the command name (state first), or ``None`` if gone."""
+        try:
+            with open(os.path.join(self.proc, str(pid), "stat"), "r") as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        # The command name may contain spaces and parentheses; it ends at the last ")".
+        return data[data.rindex(")") + 2 :].split()
+
+    def read_io(self, pid: int) -> tuple[int, int] | None:
+        """Return the ``(read_bytes, write_bytes)`` of *pid*, or ``None`` if unreadable."""
+        try:
+            with open(os.path.join(self.proc, str(pid), "io"), "r") as fp:
+                fields = dict(line.split(":", 1) for line in fp if ":" in line)
+        except OSError:
+            return None
+        return int(fields.get("read_bytes", 0)), int(fields.get("write_bytes", 0))
+
+    def sample(self) -> None:
+        """Record the current usage of the process tree."""
+        now = time.monotonic()
+        rss, processes = 0, 0
+        for pid, stat in self.tree().items():
+            if stat[0] == "Z":
+                continue
+            processes += 1
+            rss += int(stat[21]) * PAGE_SIZE
+            io = self.read_io(pid)
+            with self.lock:
+                self.cpu[pid] = (int(stat[11]) + int(stat[12])) / CLOCK_TICKS
+                if io is not None:
+                    self.io[pid] = io
+        with self.lock:
+            if processes == 0:
+                return
+            cpu = sum(self.cpu.values())
+            if self.last is not None and now > self.last[0]:
+                self.cpu_percent_peak = max(self.cpu_percent_peak, 100 * (cpu - self.last[1]) / (now - self.last[0]))
+            self.last = (now, cpu)
+            self.samples += 1
+            self.rss_total += rss
+            self.rss_peak = max(self.rss_peak, rss)
+            self.processes_peak = max(self.processes_peak, processes)
+
+    def usage(self) -> dict[str, Any]:
+        """Return the usage recorded so far.
+
+        Returns:
+            A JSON-serializable dict: ``samples``, ``seconds`` (wall time),
+            ``cpu_seconds``, ``cpu_percent_avg`` and ``cpu_percent_peak``
+            (100 per busy core), ``rss_bytes_avg``, ``rss_bytes_peak``,
+            ``read_bytes``, ``write_bytes`` and ``processes_peak``.
+        """
+        with self.lock:
+            seconds = (self.finished or time.monotonic()) - self.started
+            cpu = sum(self.cpu.values())
+            return {
+                "samples": self.samples,
+                "seconds": seconds,
+                "cpu_seconds": cpu,
+                "cpu_percent_avg": 100 * cpu / seconds if seconds > 0 else 0.0,
+                "cpu_percent_peak": self.cpu_percent_peak,
+                "rss_bytes_avg": self.rss_total // self.samples if self.samples else 0,
+                "rss_bytes_peak": self.rss_peak,
+                "read_bytes": sum(read for read, _ in self.io.values()),
+                "write_bytes": sum(write for _, write in self.io.values()),
+                "processes_peak": self.processes_peak,
+            }
@@ -2,6 +2,10 @@
 
 from __future__ import annotations
 
+import hashlib
+import os
+from stat import S_ISDIR
+
 
 def parse_list(raw: list | str, delimiter: str = ",") -> list[str]:
     """Parse a value into a list of strings.
@@ -22,3 +26,105 @@ def parse_list(raw: list | str, delimiter: str = ",") -> list[str]:
         return raw.split(delimiter)
     else:
         raise ValueError(f"Invalid type {type(raw)}. Only list or str allowed.")
+
+
+class ScriptResolver:
+    """Resolve script paths into a deterministic, fully expanded list of real paths.
+
+    Directories are walked with :func:`os.scandir` and their entries are
+    returned in sorted order, recursing into sub-directories.  Directory
+    listings are cached per process, keyed on the directory's real path and
+    modification time, and file content hashes are cached keyed on the
+    file's real path, modification time and size.  A script tree shared by
+    many provisioners is therefore only walked and hashed once per run.
+    """
+
+    def __init__(self) -> None:
+        self.directory_cache: dict[str, tuple[int, list[tuple[str, bool]]]] = {}
+        self.digest_cache: dict[str, tuple[int, int, str]] = {}
+
+    def resolve(self, *paths: str, strict: bool = True) -> list[str]:
+        """Expand *paths* into real file paths, recursing into directories.
+
+        Args:
+            *paths: File or directory paths.
+            strict: If ``True``, raise for paths that do not exist.  Otherwise
+                they are returned unchanged.
+
+        Raises:
+            FileExistsError: If *strict* and a path does not exist.
+        """
+        ret: list[str] = []
+        for path in paths:
+            real_path = os.path.realpath(path)
+            try:
+                stat = os.stat(real_path)
+            except OSError:
+                if strict:
+                    raise FileExistsError(f"Invalid path {path}")
+                ret.append(path)
+                continue
+            if S_ISDIR(stat.st_mode):
+                ret.extend(self.walk(real_path, stat.st_mtime_ns, set()))
+            else:
+                ret.append(real_path)
+        return ret
+
+    def walk(self, directory: str, mtime_ns: int, seen: set[str]) -> list[str]:
+        """Return every file below *directory* (a real path) in sorted order."""
+        if directory in seen:
+            return []
+        seen.add(directory)
+        ret: list[str] = []
+        for path, is_dir in self.list_directory(directory, mtime_ns):
+            if is_dir:
+                ret.extend(self.walk(path, os.stat(path).st_mtime_ns, seen))
+            else:
+                ret.append(path)
+        return ret
+
+    def list_directory(self, directory: str, mtime_ns: int) -> list[tuple[str, bool]]:
+        """Return the sorted ``(real path, is directory)`` entries of *directory*, cached on *mtime_ns*."""
+        cached = self.directory_cache.get(directory)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        with os.scandir(directory) as it:
+            entries = sorted(
+                (os.path.realpath(entry.path), entry.is_dir()) for entry in it if entry.is_dir() or entry.is_file()
+            )
+        self.directory_cache[directory] = (mtime_ns, entries)
+        return entries
+
+    def file_digest(self, path: str) -> str:
+        """Return the SHA-256 hex digest of a file, cached on its modification time and size."""
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        cached = self.digest_cache.get(real_path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(real_path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(chunk)
+        self.digest_cache[real_path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+        return digest.hexdigest()
+
+    def digests(self, *paths: str) -> dict[str, str]:
+        """Resolve *paths* and return a ``{real path: SHA-256 hex digest}`` mapping."""
+        return {path: self.file_digest(path) for path in self.resolve(*paths)}
+
+    def fingerprint(self, *paths: str) -> str:
+        """Return a single digest covering the resolved paths of *paths* and their contents."""
+        digest = hashlib.sha256()
+        for path, file_digest in self.digests(*paths).items():
+            digest.update(f"{path}\0{file_digest}\n".encode())
+        return digest.hexdigest()
+
+    def clear(self) -> None:
+        """Drop all cached directory listings and digests."""
+        self.directory_cache.clear()
+        self.digest_cache.clear()
+
+
+# Process-wide resolver shared by all provisioners.
+SCRIPT_RESOLVER = ScriptResolver()
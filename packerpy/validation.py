@@ -0,0 +1,184 @@
+"""Validation of many templates with few ``packer validate`` invocations."""
+
+from __future__ import annotations
+
+import copy
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import Any
+
+from .builder import PackerBuilder
+from .client import PackerClient
+from .output import SecretRedactor
+
+
+def namespace_template(template: dict[str, Any], prefix: str) -> dict[str, Any]:
+    """Return a copy of *template* with every source and build block name prefixed with *prefix*.
+
+    References to the sources (a build block's ``sources``, the labels and
+    ``name`` of its build-level ``source`` override blocks, and the ``only``
+    and ``except`` lists of provisioners and post-processors) are rewritten
+    along, so templates that reuse the same names can share one directory.
+    """
+    template = copy.deepcopy(template)
+
+    def rename(reference: str) -> str:
+        head, _, name = reference.rpartition(".")
+        return f"{head}.{prefix}{name}"
+
+    def rename_filters(attrs: dict[str, Any]) -> None:
+        for key in ("only", "except"):
+            if attrs.get(key):
+                attrs[key] = [rename(reference) for reference in attrs[key]]
+
+    for source in template.get("source", []):
+        for _type, named in source.items():
+            source[_type] = {f"{prefix}{name}": attrs for name, attrs in named.items()}
+    for build in template.get("build", []):
+        build["name"] = f"{prefix}{build['name']}"
+        build["sources"] = [rename(reference) for reference in build.get("sources", [])]
+        if "source" in build:
+            # Override blocks (see SourceOverrideOptimizer) are labelled with the
+            # base source and named after the source they stand for.
+            build["source"] = [
+                {
+                    rename(reference): {**attrs, "name": f"{prefix}{attrs['name']}"} if "name" in attrs else attrs
+                    for reference, attrs in block.items()
+                }
+                for block in build["source"]
+            ]
+        for provisioner in build.get("provisioner", []):
+            for attrs in provisioner.values():
+                rename_filters(attrs)
+        for post_processor in build.get("post-processors", []):
+            for attrs_list in post_processor.get("post-processor", {}).values():
+                for attrs in attrs_list:
+                    rename_filters(attrs)
+    return template
+
+
+def split_errors(output: list[str]) -> list[list[str]]:
+    """Split ``packer validate`` output into one list of lines per ``Error:`` diagnostic."""
+    errors: list[list[str]] = []
+    for line in output:
+        if line.startswith("Error:"):
+            errors.append([])
+        if errors:
+            errors[-1].append(line)
+    return errors
+
+
+class ValidationBatch:
+    """A group of builders validated together by one ``packer validate`` run on a shared directory.
+
+    Every builder's template is written to its own ``packerpyNNNN.pkr.json``
+    file with its sources and build blocks renamed to ``packerpyNNNN-<name>``
+    (see :func:`namespace_template`), so errors can be mapped back to the
+    builder through either the file name or a renamed block.  The
+    ``packer`` blocks are merged into one requirements file.  Builders only
+    share a batch when their required plugins, Packer version constraints
+    and environments agree.
+
+    Args:
+        size: Maximum number of builders in the batch.
+    """
+
+    TOKEN = re.compile(r"packerpy(\d{4})")
+
+    def __init__(self, size: int = 50) -> None:
+        self.size: int = size
+        self.builders: list[PackerBuilder] = []
+        self.templates: list[dict[str, Any]] = []
+        self.plugins: dict[str, Any] = {}
+        self.version_constraint: str = ""
+        self.env: dict[str, str] | None = None
+
+    @staticmethod
+    def requirements(template: dict[str, Any]) -> tuple[str, dict[str, Any]]:
+        """Return the version constraint and required plugins of *template*."""
+        packer = (template.get("packer") or [{}])[0]
+        plugins = {name: attrs for block in packer.get("required_plugins", []) for name, attrs in block.items()}
+        return packer.get("required_version", ""), plugins
+
+    def accepts(self, builder: PackerBuilder, template: dict[str, Any]) -> bool:
+        """Return ``True`` if *builder* with serialized *template* can join this batch."""
+        if len(self.builders) >= self.size:
+            return False
+        if self.env is not None and builder.config.environment() != self.env:
+            return False
+        version_constraint, plugins = ValidationBatch.requirements(template)
+        if version_constraint and self.version_constraint and version_constraint != self.version_constraint:
+            return False
+        return all(self.plugins.get(name, attrs) == attrs for name, attrs in plugins.items())
+
+    def add(self, builder: PackerBuilder, template: dict[str, Any]) -> None:
+        """Add *builder* with serialized *template* to this batch."""
+        version_constraint, plugins = ValidationBatch.requirements(template)
+        self.version_constraint = self.version_constraint or version_constraint
+        self.plugins.update(plugins)
+        self.env = builder.config.environment()
+        self.builders.append(builder)
+        self.templates.append(template)
+
+    def write(self, directory: str) -> None:
+        """Write the batch's template files to *directory*."""
+        requirements: dict[str, Any] = {}
+        if self.version_constraint:
+            requirements["required_version"] = self.version_constraint
+        if self.plugins:
+            requirements["required_plugins"] = [self.plugins]
+        if requirements:
+            with open(os.path.join(directory, "requirements.pkr.json"), "w") as fp:
+                json.dump({"packer": [requirements]}, fp, indent=2)
+        for index, template in enumerate(self.templates):
+            token = f"packerpy{index:04d}"
+            template = {key: value for key, value in template.items() if key != "packer"}
+            with open(os.path.join(directory, f"{token}.pkr.json"), "w") as fp:
+                json.dump(namespace_template(template, f"{token}-"), fp, indent=2)
+
+    def run(self, workspace: str, log: logging.Logger) -> list[str] | None:
+        """Run ``packer init`` and ``packer validate`` on the batch.
+
+        Returns:
+            ``None`` if the batch is valid, otherwise the Packer output.
+        """
+        os.makedirs(workspace, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix="batch-", dir=workspace)
+        try:
+            self.write(directory)
+            client = PackerClient(directory, log=log, env=self.env, tail_lines=100 * len(self.builders) + 100)
+            client.redactor = SecretRedactor([s for builder in self.builders for s in builder.config.secrets()])
+            for command in ("init", "validate"):
+                if client.run(command).returncode != 0:
+                    return list(client.output_tail)
+            return None
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def attribute(self, output: list[str]) -> tuple[dict[int, list[str]], list[str]]:
+        """Map the errors in *output* to the builders they come from.
+
+        Returns:
+            The error lines per builder index, with batch file and block names
+            replaced by the builder's own, and the lines of errors that could
+            not be attributed.
+        """
+        attributed: dict[int, list[str]] = {}
+        unattributed: list[str] = []
+        for error in split_errors(output):
+            indexes = {int(match) for line in error for match in ValidationBatch.TOKEN.findall(line)}
+            indexes &= set(range(len(self.builders)))
+            if not indexes:
+                unattributed.extend(error)
+            for index in indexes:
+                attributed.setdefault(index, []).extend(self.restore(line, index) for line in error)
+        return attributed, unattributed
+
+    def restore(self, line: str, index: int) -> str:
+        """Replace the batch file and block names of builder *index* in *line* with the builder's own."""
+        token = f"packerpy{index:04d}"
+        return line.replace(f"{token}.pkr.json", self.builders[index].config_file).replace(f"{token}-", "")
@@ -0,0 +1,70 @@
+"""Shared-memory transfer of wire payloads to worker processes."""
+
+from __future__ import annotations
+
+import mmap
+import os
+import tempfile
+from types import TracebackType
+
+# tmpfs mount backed by shared memory on Linux.
+SHM_DIR = "/dev/shm"
+
+
+class SharedPayload:
+    """Publish a payload once for many worker processes.
+
+    The payload (usually :meth:`PackerConfig.to_wire()
+    <packerpy.models.PackerConfig.to_wire>`) is written to a file in
+    :data:`SHM_DIR` (a temporary directory elsewhere), and workers receive
+    only its :attr:`path`, which :meth:`read` memory-maps.  Fanning a large
+    config out to many processes then copies it through shared memory
+    instead of pickling it into every worker's pipe.  The publisher owns the
+    file and removes it on :meth:`close`.
+
+    Example::
+
+        with SharedPayload(config.to_wire()) as payload:
+            pool.map(build_variant, [(payload.path, region) for region in regions])
+
+        def build_variant(args):
+            path, region = args
+            config = PackerConfig.from_wire(SharedPayload.read(path)).derive(region, region=region)
+
+    Args:
+        data: The payload.
+        directory: Directory for the backing file.  Defaults to
+            :data:`SHM_DIR` if it exists.
+    """
+
+    def __init__(self, data: bytes, directory: str | None = None) -> None:
+        if directory is None and os.path.isdir(SHM_DIR):
+            directory = SHM_DIR
+        fd, self.path = tempfile.mkstemp(prefix="packerpy-", suffix=".wire", dir=directory)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        self.size: int = len(data)
+
+    def __enter__(self) -> SharedPayload:
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc: BaseException | None, tb: TracebackType | None
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Remove the backing file.  Payloads already read by workers are unaffected."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def read(path: str) -> bytes:
+        """Return the payload published at *path*."""
+        with open(path, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
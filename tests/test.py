@@ -1,28 +1,72 @@
+import copy
+import gzip
 import json
 import os
+import pickle
+import pstats
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from concurrent.futures import Future
 from unittest.mock import MagicMock, patch
 
 from packerpy.builder import PackerBuilder
+from packerpy.checkpoints import (
+    CheckpointStore,
+    amazon_image_exists,
+    google_image_exists,
+    remove_amazon_image,
+    remove_google_image,
+    stage_keys,
+)
 from packerpy.client import PackerClient
 from packerpy.exceptions import PackerBuildError, PackerClientError
+from packerpy.fleet import AdaptiveConcurrency, ConcurrencyController, DurationHistory, Fleet
+from packerpy.journal import BuildJournal
 from packerpy.models import (
     AmazonEbs,
     Builder,
     BuilderResource,
     BuilderSourceConfig,
+    DockerBuilder,
+    DockerPush,
     EmptyBuilderSourceConfig,
     EmptyPostProcessor,
     EmptyProvisioner,
+    FileProvisioner,
+    GoogleComputeBuilder,
+    Manifest,
     PackerConfig,
     PackerResource,
     Plugin,
     PostProcessor,
     Provisioner,
     Requirements,
+    ShellLocalProvisioner,
+    ShellProvisioner,
+)
+from packerpy.optimizers import FileBundleOptimizer, ShellFusionOptimizer, SourceOverrideOptimizer
+from packerpy.output import (
+    CancellationGroup,
+    ErrorsOnlyLoggingPolicy,
+    FatalPatternDetector,
+    LogFileSink,
+    NdjsonLogWriter,
+    RateLimitedLoggingPolicy,
+    SampledLoggingPolicy,
+    SecretRedactor,
+    ThrottleSink,
 )
+from packerpy.profiling import NULL_PROFILER, PhaseProfiler, current_profiler
+from packerpy.resources import PAGE_SIZE, ProcessTreeMonitor, memory_available
+from packerpy.util import ScriptResolver
+from packerpy.validation import namespace_template
+from packerpy.wire import SharedPayload
 
 
 class BasePackerTest(unittest.TestCase):
@@ -287,6 +331,76 @@ class TestBuilderSourceConfig(BasePackerTest):
         )
 
 
+class TestDockerBuilder(BasePackerTest):
+    def test_local_build_vars_do_not_touch_os_environ(self):
+        with patch.dict(os.environ, {}, clear=False):
+            source = DockerBuilder("docker", "ubuntu", commit=True, local_build_vars={"PACKERPY_TEST_VAR": 1})
+            self.assertNotIn("PACKERPY_TEST_VAR", os.environ)
+        self.assertDictEqual(source.local_build_vars, {"PACKERPY_TEST_VAR": "1"})
+
+    def test_json_excludes_local_build_vars(self):
+        source = DockerBuilder("docker", "ubuntu", commit=True, platform="linux/amd64", local_build_vars={"A": "b"})
+        self.assertDictEqual(
+            source.json(), {"docker": {"docker": {"image": "ubuntu", "commit": True, "platform": "linux/amd64"}}}
+        )
+
+
+class TestScriptResolver(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmpdir.name)
+        os.makedirs(os.path.join(self.root, "scripts", "b_nested"))
+        self.files = [
+            os.path.join(self.root, "scripts", "a.sh"),
+            os.path.join(self.root, "scripts", "b_nested", "c.sh"),
+            os.path.join(self.root, "scripts", "d.sh"),
+        ]
+        for path in self.files:
+            with open(path, "w") as f:
+                f.write(os.path.basename(path))
+        self.resolver = ScriptResolver()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resolve_directory_sorted_real_paths(self):
+        self.assertEqual(self.resolver.resolve(os.path.join(self.tmpdir.name, "scripts")), self.files)
+
+    def test_resolve_missing_path(self):
+        with self.assertRaises(FileExistsError):
+            self.resolver.resolve(os.path.join(self.root, "missing.sh"))
+        self.assertEqual(self.resolver.resolve("missing.sh", strict=False), ["missing.sh"])
+
+    def test_directory_listing_cached_until_mtime_changes(self):
+        scripts = os.path.join(self.root, "scripts")
+        self.resolver.resolve(scripts)
+        with patch("packerpy.util.os.scandir", side_effect=AssertionError("cache miss")):
+            self.assertEqual(self.resolver.resolve(scripts), self.files)
+        new_file = os.path.join(scripts, "e.sh")
+        with open(new_file, "w") as f:
+            f.write("e")
+        os.utime(scripts, ns=(0, os.stat(scripts).st_mtime_ns + 1_000_000_000))
+        self.assertEqual(self.resolver.resolve(scripts), self.files + [new_file])
+
+    def test_digest_cached_and_fingerprint_changes_with_content(self):
+        fingerprint = self.resolver.fingerprint(os.path.join(self.root, "scripts"))
+        with patch("builtins.open", side_effect=AssertionError("cache miss")):
+            self.assertEqual(self.resolver.fingerprint(os.path.join(self.root, "scripts")), fingerprint)
+        with open(self.files[0], "w") as f:
+            f.write("changed contents")
+        self.assertNotEqual(self.resolver.fingerprint(os.path.join(self.root, "scripts")), fingerprint)
+
+    def test_shell_local_provisioner_expands_directories(self):
+        provisioner = ShellLocalProvisioner(scripts=[os.path.join(self.root, "scripts")])
+        self.assertEqual(provisioner.scripts, self.files)
+        with self.assertRaises(FileExistsError):
+            ShellLocalProvisioner(script=os.path.join(self.root, "missing.sh"))
+
+    def test_shell_provisioner_keeps_remote_paths(self):
+        provisioner = ShellProvisioner(scripts=["remote.sh", os.path.join(self.root, "scripts")])
+        self.assertEqual(provisioner.scripts, ["remote.sh"] + self.files)
+
+
 class TestBuilderResource(BasePackerTest):
     def setUp(self):
         self.builder_resource = BuilderResource("test_resource")
@@ -494,6 +608,464 @@ class TestPackerConfig(BasePackerTest):
         actual = PackerConfig.load_config("test_config", config_content=config_data)
         self.assertEqual(actual, expected)
 
+    def test_json_multiple_builders(self):
+        second = Builder("second_build")
+        self.config.add_builder(second)
+        self.config.add_builder_source(BuilderSourceConfig("test_bsc_type_3", "test_bsc_name_3"), builder=second)
+        second.add_provisioner(Provisioner("second_provisioner"))
+        builds = self.config.json()["build"]
+        self.assertEqual([build["name"] for build in builds], ["test_config", "second_build"])
+        self.assertEqual(builds[1]["sources"], ["source.test_bsc_type_3.test_bsc_name_3"])
+        self.assertEqual(builds[1]["provisioner"], [{"second_provisioner": {}}])
+        self.assertEqual(len(self.config.json()["source"]), 3)
+
+    def test_add_builder_duplicate_name(self):
+        with self.assertRaises(PackerBuildError):
+            self.config.add_builder(Builder("test_config"))
+
+    def test_load_config_multiple_builders_round_trip(self):
+        config = PackerConfig("multi")
+        config.add_builder_source(EmptyBuilderSourceConfig("one"))
+        second = Builder("second")
+        config.add_builder(second)
+        config.add_builder_source(EmptyBuilderSourceConfig("two"), builder=second)
+        second.add_provisioner(EmptyProvisioner())
+        loaded = PackerConfig.load_config("multi", config_content=json.loads(json.dumps(config.json())))
+        self.assertEqual(len(loaded.builders), 2)
+        self.assertEqual(loaded.builder.sources, ["source.empty.one"])
+        self.assertEqual(loaded, config)
+        self.assertDictEqual(loaded.json(), config.json())
+
+    def test_environment_isolated_per_config(self):
+        other = PackerConfig("other_config")
+        self.config.add_builder_source(DockerBuilder("d1", "ubuntu", commit=True, local_build_vars={"VAR": "one"}))
+        other.add_builder_source(DockerBuilder("d2", "ubuntu", commit=True, local_build_vars={"VAR": "two"}))
+        self.config.set_env(PACKER_LOG=1)
+        self.assertDictEqual(self.config.environment(), {"VAR": "one", "PACKER_LOG": "1"})
+        self.assertDictEqual(other.environment(), {"VAR": "two"})
+
+    def test_environment_config_overrides_source_vars(self):
+        self.config.add_builder_source(DockerBuilder("d1", "ubuntu", commit=True, local_build_vars={"VAR": "source"}))
+        self.config.set_env(VAR="config")
+        self.assertDictEqual(self.config.environment(), {"VAR": "config"})
+
+    def test_clone_shares_resources(self):
+        clone = self.config.clone("clone_config")
+        self.assertEqual(clone.builder.name, "clone_config")
+        self.assertEqual(self.config.builder.name, "test_config")
+        self.assertIs(clone.builder.provisioners[0], self.config.builder.provisioners[0])
+        self.assertIs(clone.requirements, self.config.requirements)
+        self.assertIs(clone.builder_sources["test_bsc_name_1"], self.config.builder_sources["test_bsc_name_1"])
+        clone.builder.add_provisioner(ShellProvisioner(inline=["echo clone"]))
+        clone.add_builder_source(DockerBuilder("d1", "ubuntu", commit=True))
+        clone.set_env(PACKER_LOG=1)
+        self.assertEqual(len(self.config.builder.provisioners), 1)
+        self.assertNotIn("d1", self.config.builder_sources)
+        self.assertEqual(self.config.builder.sources, clone.builder.sources[:2])
+        self.assertDictEqual(self.config.env, {})
+
+    def test_derive_copies_overridden_sources_only(self):
+        base = PackerConfig("web")
+        base.add_builder_source(
+            AmazonEbs("east", "web-{{timestamp}}", "us-east-1", "key", "secret", source_ami="ami-1"),
+            DockerBuilder("local", "ubuntu", commit=True),
+        )
+        base.builder.add_provisioner(ShellProvisioner(inline=["echo hi"] * 1000))
+        variant = base.derive("web-eu", region="eu-west-1", source_overrides={"east": {"source_ami": "ami-2"}})
+        self.assertEqual(variant.builder_sources["east"].region, "eu-west-1")
+        self.assertEqual(variant.builder_sources["east"].source_ami, "ami-2")
+        self.assertEqual(base.builder_sources["east"].region, "us-east-1")
+        self.assertIs(variant.builder_sources["local"], base.builder_sources["local"])
+        self.assertIs(variant.builder.provisioners[0], base.builder.provisioners[0])
+        expected = base.json()
+        expected["source"][0]["amazon-ebs"]["east"].update(region="eu-west-1", source_ami="ami-2")
+        expected["build"][0]["name"] = "web-eu"
+        self.assertDictEqual(variant.json(), expected)
+
+    def test_derive_rejects_unknown_overrides(self):
+        with self.assertRaises(PackerBuildError):
+            self.config.derive("variant", source_overrides={"missing": {"region": "eu-west-1"}})
+        with self.assertRaises(PackerBuildError):
+            self.config.derive("variant", region="eu-west-1")
+        with self.assertRaises(PackerBuildError):
+            self.config.derive("variant", source_overrides={"test_bsc_name_1": {"name": "renamed"}})
+
+
+class TestSourceOverrideOptimizer(BasePackerTest):
+    def setUp(self):
+        self.config = PackerConfig("regions")
+        self.regions = ["us-east-1", "us-east-2", "us-west-1", "us-west-2"]
+        for region in self.regions:
+            self.config.add_builder_source(
+                AmazonEbs(
+                    region,
+                    f"image-{region}",
+                    region,
+                    "test-key",
+                    "test-secret",
+                    instance_type="t3.micro",
+                    source_ami="ami-12345",
+                    ssh_username="ec2-user",
+                    tags={"region": region},
+                )
+            )
+        self.unoptimized = self.config.json()
+        self.config.add_optimizer(SourceOverrideOptimizer())
+
+    def test_factors_common_attributes(self):
+        template = self.config.json()
+        self.assertEqual(
+            template["source"],
+            [
+                {
+                    "amazon-ebs": {
+                        "amazon_ebs_base": {
+                            "access_key": "test-key",
+                            "secret_key": "test-secret",
+                            "source_ami": "ami-12345",
+                            "instance_type": "t3.micro",
+                            "ssh_username": "ec2-user",
+                        }
+                    }
+                }
+            ],
+        )
+        self.assertEqual(template["build"][0]["sources"], [])
+        self.assertEqual(
+            template["build"][0]["source"][0],
+            {
+                "amazon-ebs.amazon_ebs_base": {
+                    "name": "us-east-1",
+                    "ami_name": "image-us-east-1",
+                    "region": "us-east-1",
+                    "tags": {"region": "us-east-1"},
+                }
+            },
+        )
+        self.assertLess(len(json.dumps(template)), len(json.dumps(self.unoptimized)))
+
+    def test_keeps_template_when_not_smaller(self):
+        config = PackerConfig("small")
+        config.add_builder_source(
+            BuilderSourceConfig("test_type", "test_name_1"), BuilderSourceConfig("test_type", "test_name_2")
+        )
+        self.assertDictEqual(SourceOverrideOptimizer().optimize(config.json()), config.json())
+
+    def test_base_name_does_not_clash(self):
+        self.assertEqual(
+            SourceOverrideOptimizer.unique_name("amazon-ebs", {"amazon-ebs.amazon_ebs_base"}), "amazon_ebs_base_2"
+        )
+
+    def test_load_config_expands_overrides(self):
+        loaded = PackerConfig.load_config("regions", config_content=json.loads(json.dumps(self.config.json())))
+        self.assertEqual(sorted(loaded.builder_sources), sorted(self.regions))
+        self.assertDictEqual(loaded.json(), self.unoptimized)
+
+
+class TestShellFusionOptimizer(BasePackerTest):
+    def setUp(self):
+        self.optimizer = ShellFusionOptimizer()
+        self.builder = Builder("fusion")
+        self.builder.add_optimizer(self.optimizer)
+
+    def test_fuses_adjacent_inline_provisioners(self):
+        self.builder.add_provisioner(
+            ShellProvisioner(inline=["a"]),
+            ShellProvisioner(inline=["b", "c"]),
+            FileProvisioner(source="f", destination="/tmp/f"),
+            ShellProvisioner(inline=["d"]),
+            ShellProvisioner(inline=["e"]),
+        )
+        self.assertEqual(
+            self.builder.json()["build"][0]["provisioner"],
+            [
+                {"shell": {"inline": ["a", "b", "c"]}},
+                {"file": {"source": "f", "destination": "/tmp/f"}},
+                {"shell": {"inline": ["d", "e"]}},
+            ],
+        )
+        self.assertEqual(self.optimizer.fused, [("fusion", 0, 2), ("fusion", 3, 2)])
+
+    def test_respects_only_scope(self):
+        scoped = ShellProvisioner(inline=["b"])
+        scoped.add_only_sources(BuilderSourceConfig("docker", "one"))
+        self.builder.add_provisioner(ShellProvisioner(inline=["a"]), scoped, ShellProvisioner(inline=["c"]))
+        self.assertEqual(len(self.builder.json()["build"][0]["provisioner"]), 3)
+        self.assertEqual(self.optimizer.fused, [])
+
+    def test_does_not_fuse_scripts_or_retries(self):
+        provisioners = [
+            {"shell": {"inline": ["a"], "max_retries": 3}},
+            {"shell": {"inline": ["b"], "max_retries": 3}},
+            {"shell": {"script": "setup.sh"}},
+            {"shell": {"script": "setup.sh"}},
+        ]
+        template = {"build": [{"name": "fusion", "provisioner": provisioners}]}
+        self.assertEqual(self.optimizer.optimize(template)["build"][0]["provisioner"], provisioners)
+
+    def test_config_level_optimizer(self):
+        config = PackerConfig("fusion")
+        config.builder.add_provisioner(ShellProvisioner(inline=["a"]), ShellProvisioner(inline=["b"]))
+        config.add_optimizer(ShellFusionOptimizer())
+        self.assertEqual(config.json()["build"][0]["provisioner"], [{"shell": {"inline": ["a", "b"]}}])
+
+
+class TestFileBundleOptimizer(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app_dir = os.path.join(self.tmpdir.name, "app")
+        os.makedirs(os.path.join(self.app_dir, "lib"))
+        for relative in ("main.py", os.path.join("lib", "util.py")):
+            with open(os.path.join(self.app_dir, relative), "w") as f:
+                f.write(relative)
+        self.conf = os.path.join(self.tmpdir.name, "app.conf")
+        with open(self.conf, "w") as f:
+            f.write("conf")
+        self.optimizer = FileBundleOptimizer(cache_dir=os.path.join(self.tmpdir.name, "cache"))
+        self.builder = Builder("bundle")
+        self.builder.add_optimizer(self.optimizer)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_bundles_adjacent_uploads(self):
+        self.builder.add_provisioner(
+            FileProvisioner(source=self.app_dir, destination="/opt"),
+            FileProvisioner(source=self.conf, destination="/etc/app/"),
+            ShellProvisioner(inline=["systemctl restart app"]),
+        )
+        provisioners = self.builder.json()["build"][0]["provisioner"]
+        self.assertEqual(len(provisioners), 3)
+        archive = provisioners[0]["file"]["source"]
+        remote_archive = provisioners[0]["file"]["destination"]
+        self.assertEqual(remote_archive, f"/tmp/{os.path.basename(archive)}")
+        self.assertEqual(
+            provisioners[1], {"shell": {"inline": [f"tar -xzf {remote_archive} -C /", f"rm -f {remote_archive}"]}}
+        )
+        with tarfile.open(archive) as tar:
+            self.assertEqual(tar.getnames(), ["etc/app/app.conf", "opt/app/lib/util.py", "opt/app/main.py"])
+        self.assertEqual(self.optimizer.bundled, [("bundle", 0, 2, archive)])
+
+    def test_archive_is_cached_by_content(self):
+        self.builder.add_provisioner(FileProvisioner(source=self.app_dir + "/", destination="/opt/app"))
+        first = self.builder.json()["build"][0]["provisioner"][0]["file"]["source"]
+        self.assertEqual(self.builder.json()["build"][0]["provisioner"][0]["file"]["source"], first)
+        with open(self.conf, "w") as f:
+            f.write("changed")
+        with open(os.path.join(self.app_dir, "main.py"), "w") as f:
+            f.write("changed")
+        self.assertNotEqual(self.builder.json()["build"][0]["provisioner"][0]["file"]["source"], first)
+
+    def test_keeps_differently_scoped_uploads_apart(self):
+        scoped = FileProvisioner(source=self.conf, destination="/etc/app.conf")
+        scoped.add_only_sources(BuilderSourceConfig("docker", "one"))
+        self.builder.add_provisioner(FileProvisioner(source=self.conf, destination="/etc/app.conf"), scoped)
+        provisioners = self.builder.json()["build"][0]["provisioner"]
+        self.assertEqual([next(iter(p)) for p in provisioners], ["file", "file"])
+        self.assertEqual(self.optimizer.bundled, [])
+
+
+class TestSecretRedactor(BasePackerTest):
+    def test_redacts_all_secrets_in_one_pass(self):
+        redactor = SecretRedactor(["secret", "secretkey", "a+b*c?", "tok"])
+        self.assertEqual(
+            redactor.redact("key=secretkey val=secret expr=a+b*c? tok"),
+            "key=<redacted> val=<redacted> expr=<redacted> tok",
+        )
+
+    def test_no_secrets(self):
+        redactor = SecretRedactor()
+        self.assertIsNone(redactor.pattern)
+        self.assertEqual(redactor.redact("nothing to hide"), "nothing to hide")
+
+    def test_long_secrets(self):
+        token = "".join(chr(ord("a") + i % 26) for i in range(2500))
+        redactor = SecretRedactor([token, token[:1200], "other"])
+        self.assertEqual(redactor.redact(f"token={token} short={token[:1200]}!"), "token=<redacted> short=<redacted>!")
+
+    def test_config_secrets(self):
+        config = PackerConfig("secrets")
+        config.add_builder_source(
+            AmazonEbs("ami", "ami", "us-east-1", "AKIAEXAMPLE", "supersecret", token="sessiontoken")
+        )
+        config.builder.add_post_processor(
+            DockerPush(login=True, login_server="registry", login_username="user", login_password="hunter22")
+        )
+        self.assertEqual(sorted(config.secrets()), ["AKIAEXAMPLE", "hunter22", "sessiontoken", "supersecret"])
+
+
+class TestLogFileSink(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_gzip_compression(self):
+        sink = LogFileSink(self.tmpdir.name, compression="gzip")
+        sink.open("build")
+        sink.write("line1")
+        sink.close()
+        with gzip.open(os.path.join(self.tmpdir.name, "packer-build.log.gz"), "rt") as f:
+            self.assertEqual(f.read(), "line1\n")
+
+    def test_size_rotation(self):
+        sink = LogFileSink(self.tmpdir.name, max_bytes=10, backup_count=2)
+        sink.open("build")
+        for line in ("aaaaaaaaa", "bbbbbbbbb", "ccccccccc", "ddd"):
+            sink.write(line)
+        sink.close()
+        path = os.path.join(self.tmpdir.name, "packer-build.log")
+        with open(path) as f:
+            self.assertEqual(f.read(), "ddd\n")
+        with open(f"{path}.1") as f:
+            self.assertEqual(f.read(), "ccccccccc\n")
+        with open(f"{path}.2") as f:
+            self.assertEqual(f.read(), "bbbbbbbbb\n")
+        self.assertFalse(os.path.exists(f"{path}.3"))
+
+    def test_no_rotation_without_backups(self):
+        sink = LogFileSink(self.tmpdir.name, max_bytes=20)
+        sink.open("build")
+        for index in range(10):
+            sink.write(f"line{index}")
+        sink.close()
+        path = os.path.join(self.tmpdir.name, "packer-build.log")
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), [f"line{index}" for index in range(10)])
+        self.assertFalse(os.path.exists(f"{path}.1"))
+
+    def test_previous_run_kept_as_backup(self):
+        sink = LogFileSink(self.tmpdir.name, backup_count=1)
+        for run in ("first", "second"):
+            sink.open("build")
+            sink.write(run)
+            sink.close()
+        with open(os.path.join(self.tmpdir.name, "packer-build.log.1")) as f:
+            self.assertEqual(f.read(), "first\n")
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(ValueError):
+            LogFileSink(self.tmpdir.name, compression="bz2")
+
+
+class TestNdjsonSink(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "logs", "packer.ndjson")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records(self):
+        writer = NdjsonLogWriter(self.path)
+        sink = writer.sink("my-build")
+        sink.open("build")
+        sink.write("==> amazon-ebs.ubuntu: Prevalidating AMI Name")
+        sink.write("Build finished")
+        sink.close(0)
+        writer.close()
+        records = self.read_records()
+        self.assertEqual([record["event"] for record in records], ["start", "line", "line", "end"])
+        self.assertEqual(records[1]["source"], "amazon-ebs.ubuntu")
+        self.assertIsNone(records[2]["source"])
+        self.assertEqual(records[3]["returncode"], 0)
+        for record in records:
+            self.assertEqual((record["build"], record["command"]), ("my-build", "build"))
+            self.assertIn("timestamp", record)
+            self.assertGreaterEqual(record["offset"], 0)
+
+    def test_buffers_until_threshold(self):
+        writer = NdjsonLogWriter(self.path, flush_bytes=1 << 20, flush_interval=3600)
+        sink = writer.sink("my-build")
+        sink.open("build")
+        self.assertEqual(os.path.getsize(self.path), 0)
+        writer.flush_bytes = 1
+        sink.write("line")
+        self.assertEqual(len(self.read_records()), 2)
+        writer.close()
+
+    def test_shared_across_threads(self):
+        writer = NdjsonLogWriter(self.path, flush_bytes=512)
+
+        def run(build):
+            sink = writer.sink(build)
+            sink.open("build")
+            for i in range(200):
+                sink.write(f"line {i}")
+            sink.close(0)
+
+        threads = [threading.Thread(target=run, args=(f"build-{i}",)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        records = self.read_records()
+        self.assertEqual(len(records), 4 * 202)
+        for i in range(4):
+            lines = [r["line"] for r in records if r["build"] == f"build-{i}" and r["event"] == "line"]
+            self.assertEqual(lines, [f"line {n}" for n in range(200)])
+
+
+class TestLoggingPolicy(BasePackerTest):
+    def test_errors_only(self):
+        policy = ErrorsOnlyLoggingPolicy()
+        self.assertFalse(policy.allow("==> amazon-ebs.ami: Waiting for SSH"))
+        self.assertTrue(policy.allow("==> amazon-ebs.ami: Error launching source instance"))
+        self.assertTrue(policy.allow("Warning: deprecated option"))
+
+    def test_every_nth(self):
+        policy = SampledLoggingPolicy(3)
+        self.assertEqual([policy.allow(f"line {i}") for i in range(7)], [True, False, False, True, False, False, True])
+
+    def test_rate_limited(self):
+        policy = RateLimitedLoggingPolicy(lines_per_second=10, burst=2)
+        with patch("packerpy.output.time.monotonic", return_value=policy.updated):
+            self.assertEqual([policy.allow("line") for _ in range(3)], [True, True, False])
+            self.assertTrue(policy.allow("Build 'ami' errored"))
+        with patch("packerpy.output.time.monotonic", return_value=policy.updated + 0.15):
+            self.assertTrue(policy.allow("line"))
+
+
+class TestFatalPatternDetector(BasePackerTest):
+    def test_default_patterns(self):
+        detector = FatalPatternDetector()
+        self.assertEqual(
+            detector.match("==> amazon-ebs.ami: AuthFailure: AWS was not able to validate the provided credentials"),
+            "invalid-credentials",
+        )
+        self.assertEqual(detector.match("InvalidAMIID.NotFound: image ami-1 does not exist"), "missing-source-image")
+        self.assertEqual(detector.match("Error launching source instance: VcpuLimitExceeded"), "quota-exceeded")
+        self.assertIsNone(detector.match("==> amazon-ebs.ami: Waiting for SSH to become available..."))
+
+    def test_custom_patterns(self):
+        detector = FatalPatternDetector({"disk-full": r"No space left on device"})
+        self.assertEqual(detector.match("write /tmp/x: No space left on device"), "disk-full")
+        self.assertIsNone(detector.match("AuthFailure"))
+        self.assertIsNone(FatalPatternDetector({}).match("AuthFailure"))
+
+    def test_cancellation_group(self):
+        group = CancellationGroup()
+        origin, sibling, finished = MagicMock(), MagicMock(), MagicMock()
+        sibling.poll.return_value = None
+        finished.poll.return_value = 0
+        for process in (origin, sibling, finished):
+            group.register(process)
+        group.cancel("AuthFailure", origin=origin)
+        self.assertTrue(group.cancelled)
+        sibling.terminate.assert_called_once()
+        origin.terminate.assert_not_called()
+        finished.terminate.assert_not_called()
+        late = MagicMock()
+        group.register(late)
+        late.terminate.assert_called_once()
+        self.assertIs(CancellationGroup.for_key("us-east-1"), CancellationGroup.for_key("us-east-1"))
+
 
 class _ConcreteBuilder(PackerBuilder):
     """Minimal concrete subclass for testing PackerBuilder."""
@@ -519,6 +1091,14 @@ class TestPackerClient(BasePackerTest):
             result = self.client.run("validate")
         self.assertIs(result, mock_proc)
 
+    def test_run_calls_start_callbacks(self):
+        mock_proc = MagicMock(pid=321, stdout=[], returncode=0)
+        started = []
+        self.client.on_start.append(lambda command, pid: started.append((command, pid)))
+        with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+            self.client.run("build")
+        self.assertEqual(started, [("build", 321)])
+
     def test_run_streams_output_to_logger(self):
         mock_proc = MagicMock()
         mock_proc.stdout = ["line1\n", "line2\n"]
@@ -529,6 +1109,38 @@ class TestPackerClient(BasePackerTest):
         self.assertIn("INFO:PackerClient:line1", cm.output)
         self.assertIn("INFO:PackerClient:line2", cm.output)
 
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs procfs")
+    def test_run_samples_resource_usage(self):
+        mock_proc = MagicMock(pid=os.getpid(), stdout=["line1\n"], returncode=0)
+        self.client.resource_interval = 0.01
+        with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+            self.client.run("validate")
+        usage = self.client.resource_usage["validate"]
+        self.assertGreaterEqual(usage["samples"], 1)
+        self.assertGreater(usage["rss_bytes_peak"], 0)
+        self.assertEqual(json.loads(json.dumps(usage)), usage)
+
+    def test_run_terminates_on_fatal_pattern(self):
+        mock_proc = MagicMock()
+        mock_proc.stdout = ["==> amazon-ebs.ami: Prevalidating AMI Name\n", "Error: AuthFailure\n", "more\n"]
+        sibling = MagicMock()
+        sibling.poll.return_value = None
+        group = CancellationGroup()
+        group.register(sibling)
+        self.client.fatal_patterns = FatalPatternDetector()
+        self.client.cancellation_group = group
+        with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+            with self.assertRaises(PackerBuildError) as cm:
+                self.client.run("build")
+        self.assertIn("invalid-credentials", str(cm.exception))
+        self.assertIn("Error: AuthFailure", str(cm.exception))
+        mock_proc.terminate.assert_called_once()
+        sibling.terminate.assert_called_once()
+        with patch("packerpy.client.subprocess.Popen") as popen:
+            with self.assertRaises(PackerBuildError):
+                self.client.run("build")
+        popen.assert_not_called()
+
     def test_run_writes_stream_file(self):
         mock_proc = MagicMock()
         mock_proc.stdout = ["line1\n"]
@@ -543,6 +1155,58 @@ class TestPackerClient(BasePackerTest):
             with open(log_path) as f:
                 self.assertEqual(f.read(), "line1\n")
 
+    def test_run_redacts_secrets(self):
+        mock_proc = MagicMock()
+        mock_proc.stdout = ["using key supersecret\n"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.client.stream_file_dir = tmpdir
+            self.client.redactor = SecretRedactor(["supersecret"])
+            with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+                with self.assertLogs("PackerClient", level="INFO") as cm:
+                    self.client.run("build")
+            with open(os.path.join(tmpdir, "packer-build.log")) as f:
+                self.assertEqual(f.read(), "using key <redacted>\n")
+        self.assertEqual(cm.output, ["INFO:PackerClient:using key <redacted>"])
+
+    def test_run_keeps_output_tail(self):
+        mock_proc = MagicMock()
+        mock_proc.stdout = [f"line{i}\n" for i in range(5)]
+        with patch.object(PackerClient, "verify_packer_installation"):
+            client = PackerClient("test.pkr.json", tail_lines=2)
+        with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+            with self.assertLogs("PackerClient", level="INFO"):
+                client.run("build")
+        self.assertEqual(list(client.output_tail), ["line3", "line4"])
+        mock_proc.wait.assert_called_once()
+
+    def test_run_counts_suppressed_lines(self):
+        mock_proc = MagicMock()
+        mock_proc.stdout = ["step 1\n", "step 2\n", "Error: boom\n"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.client.stream_file_dir = tmpdir
+            self.client.logging_policy = ErrorsOnlyLoggingPolicy()
+            with patch("packerpy.client.subprocess.Popen", return_value=mock_proc):
+                with self.assertLogs("PackerClient", level="INFO") as cm:
+                    self.client.run("build")
+            with open(os.path.join(tmpdir, "packer-build.log")) as f:
+                self.assertEqual(f.read(), "step 1\nstep 2\nError: boom\n")
+        self.assertEqual(
+            cm.output,
+            ["INFO:PackerClient:Error: boom", "INFO:PackerClient:Suppressed 2 of 3 output lines of packer build"],
+        )
+        self.assertEqual(self.client.suppressed_lines, {"build": 2})
+
+    def test_run_passes_env_overlay(self):
+        mock_proc = MagicMock()
+        mock_proc.stdout = []
+        self.client.env = {"PACKER_LOG": "1"}
+        with patch("packerpy.client.subprocess.Popen", return_value=mock_proc) as mock_popen:
+            self.client.run("validate")
+        env = mock_popen.call_args.kwargs["env"]
+        self.assertEqual(env["PACKER_LOG"], "1")
+        self.assertEqual(env.get("PATH"), os.environ.get("PATH"))
+        self.assertNotIn("PACKER_LOG", os.environ)
+
     def test_verify_packer_installation_success(self):
         with patch("packerpy.client.subprocess.check_call") as mock_check:
             PackerClient.verify_packer_installation()
@@ -561,9 +1225,13 @@ class TestPackerClient(BasePackerTest):
 
 class TestPackerBuilder(BasePackerTest):
     def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
         with patch("packerpy.builder.PackerClient"):
-            self.builder = _ConcreteBuilder("test-build")
-        self.mock_client = self.builder.client
+            self.builder = _ConcreteBuilder("test-build", config_file=os.path.join(self.tmpdir.name, "test.pkr.json"))
+            self.mock_client = self.builder.client
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
 
     def _make_proc(self, returncode: int = 0) -> MagicMock:
         proc = MagicMock()
@@ -622,6 +1290,41 @@ class TestPackerBuilder(BasePackerTest):
         with self.assertRaises(PackerBuildError):
             self.builder.build()
 
+    def test_add_manifest_post_processor_to_every_build_block(self):
+        self.builder.config.add_builder(Builder("second"))
+        self.builder.add_manifest_post_processor()
+        for builder in self.builder.config.builders:
+            self.assertEqual(sum(isinstance(pp, Manifest) for pp in builder.post_processors), 1)
+
+    def test_build_writes_config_and_passes_parallel_builds(self):
+        self.builder.parallel_builds = 4
+        self.mock_client.run.return_value = self._make_proc(returncode=1)
+
+        def run_side_effect(command, *args):
+            return self._make_proc(returncode=0 if command in ("init", "validate") else 1)
+
+        self.mock_client.run.side_effect = run_side_effect
+        with self.assertRaises(PackerBuildError):
+            self.builder.build()
+        self.mock_client.run.assert_called_with("build", "-parallel-builds=4")
+        with open(self.builder.config_file) as f:
+            self.assertEqual(json.load(f), self.builder.config.json())
+
+    def test_build_failure_carries_output_tail(self):
+        self.mock_client.run.return_value = self._make_proc(returncode=1)
+        self.mock_client.output_tail = ["Error: something broke"]
+        with self.assertRaises(PackerBuildError) as cm:
+            self.builder.build()
+        self.assertEqual(cm.exception.output, ["Error: something broke"])
+
+    def test_build_applies_config_environment(self):
+        self.mock_client.env = {}
+        self.mock_client.run.return_value = self._make_proc(returncode=1)
+        self.builder.config.set_env(PACKER_CACHE_DIR="/tmp/cache")
+        with self.assertRaises(PackerBuildError):
+            self.builder.build()
+        self.assertDictEqual(self.mock_client.env, {"PACKER_CACHE_DIR": "/tmp/cache"})
+
     def test_build_success(self):
         self.mock_client.run.return_value = self._make_proc(returncode=0)
         manifest = {"builds": [{"artifact_id": "ami-12345"}]}
@@ -632,3 +1335,1148 @@ class TestPackerBuilder(BasePackerTest):
             self.builder.build()  # should not raise
         finally:
             os.unlink(self.builder.manifest_file)
+
+
+class _DockerFleetBuilder(PackerBuilder):
+    def __init__(self, name, image="ubuntu"):
+        super().__init__(name)
+        self.image = image
+        self.configure_calls = 0
+
+    def configure(self) -> None:
+        self.configure_calls += 1
+        self.config.add_builder_source(DockerBuilder(self.config.config_name, image=self.image, commit=True))
+
+
+class TestFleet(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = DurationHistory(os.path.join(self.tmpdir.name, "durations.json"), default_estimate=60)
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fingerprint_ignores_manifest(self):
+        builder = _DockerFleetBuilder("a")
+        builder.configure()
+        fingerprint = builder.config.fingerprint()
+        builder.add_manifest_post_processor()
+        self.assertEqual(builder.config.fingerprint(), fingerprint)
+        builder.config.builder_sources["a"].image = "debian"
+        self.assertNotEqual(builder.config.fingerprint(), fingerprint)
+
+    def test_fingerprint_covers_local_scripts(self):
+        script = os.path.join(self.tmpdir.name, "setup.sh")
+        with open(script, "w") as fp:
+            fp.write("echo one\n")
+        config = PackerConfig("scripts")
+        config.add_builder_source(DockerBuilder("a", image="ubuntu", commit=True))
+        config.builder.add_provisioner(ShellProvisioner(script=script))
+        fingerprint = config.fingerprint()
+        self.assertEqual(config.local_files(), [script])
+        with open(script, "w") as fp:
+            fp.write("echo one; echo two\n")
+        self.assertNotEqual(config.fingerprint(), fingerprint)
+
+    def test_fingerprint_ignores_credentials(self):
+        config = PackerConfig("credentials")
+        source = AmazonEbs("a", "a", "us-east-1", "AKIA1", "secret1", token="token1", source_ami="ami-1")
+        config.add_builder_source(source)
+        push = DockerPush(login=True, login_server="registry", login_username="user", login_password="hunter22")
+        config.builder.add_post_processor(push)
+        fingerprint = config.fingerprint()
+        source.access_key, source.secret_key, source.token = "AKIA2", "secret2", "token2"
+        push.login_password = "hunter23"
+        self.assertEqual(config.fingerprint(), fingerprint)
+        source.source_ami = "ami-2"
+        self.assertNotEqual(config.fingerprint(), fingerprint)
+
+    def test_history_estimates(self):
+        builder = _DockerFleetBuilder("a")
+        builder.configure()
+        self.assertEqual(self.history.estimate(builder), 60)
+        self.history.record(builder, 100)
+        self.history.record(builder, 200)
+        self.assertEqual(self.history.estimate(builder), 150)
+        reloaded = DurationHistory(self.history.path)
+        self.assertEqual(reloaded.estimate(builder), 150)
+        builder.config.builder_sources["a"].image = "debian"
+        self.assertEqual(reloaded.estimate(builder), 150)
+
+    def test_longest_first(self):
+        short, long, unseen = _DockerFleetBuilder("short"), _DockerFleetBuilder("long"), _DockerFleetBuilder("unseen")
+        fleet = Fleet([short, unseen, long], max_workers=2, history=self.history)
+        fleet.configure()
+        self.history.record(short, 10)
+        self.history.record(long, 7200)
+        self.assertEqual([b for b, _ in fleet.schedule()], [long, unseen, short])
+        self.assertEqual(fleet.assign(), [[long], [unseen, short]])
+        self.assertEqual(long.configure_calls, 1)
+
+    def test_run_records_durations(self):
+        ok, failing = _DockerFleetBuilder("ok"), _DockerFleetBuilder("failing")
+        fleet = Fleet([ok, failing], history=self.history)
+        with (
+            patch.object(ok, "build"),
+            patch.object(failing, "build", side_effect=PackerBuildError("Packer build failed")),
+        ):
+            results = fleet.run()
+        self.assertIsNone(results["ok"])
+        self.assertIsInstance(results["failing"], PackerBuildError)
+        self.assertIn(DurationHistory.key(ok), self.history.records)
+        self.assertNotIn(DurationHistory.key(failing), self.history.records)
+
+    def test_run_resets_cancelled_groups(self):
+        group = CancellationGroup.for_key("fleet-reset")
+        self.addCleanup(group.reset)
+        fatal, queued = _DockerFleetBuilder("fatal"), _DockerFleetBuilder("queued")
+        for builder in (fatal, queued):
+            builder.client.cancellation_group = group
+
+        def cancel():
+            group.cancel("AuthFailure")
+            raise PackerBuildError("AuthFailure")
+
+        def check():
+            if group.cancelled:
+                raise PackerBuildError(f"Cancelled: {group.reason}")
+
+        fleet = Fleet([fatal, queued], max_workers=1, history=self.history)
+        with patch.object(fatal, "build", side_effect=cancel), patch.object(queued, "build", side_effect=check):
+            results = fleet.run()
+        self.assertIn("Cancelled", str(results["queued"]))
+        self.assertFalse(CancellationGroup.for_key("fleet-reset").cancelled)
+        with patch.object(queued, "build", side_effect=check):
+            self.assertIsNone(Fleet([queued], history=self.history).run()["queued"])
+
+    def test_default_files_are_separated(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        self.addCleanup(os.chdir, cwd)
+        first, second = _DockerFleetBuilder("first"), _DockerFleetBuilder("second")
+        journal = BuildJournal("journal.jsonl")
+        self.addCleanup(journal.close)
+        fleet = Fleet([first, second], max_workers=2, history=self.history, journal=journal)
+        self.assertEqual(first.config_file, "packer-first.pkr.json")
+        self.assertEqual(second.manifest_file, "packer-second-manifest.json")
+        self.assertEqual(second.client.file, "packer-second.pkr.json")
+
+        def build(builder):
+            with open(builder.manifest_file, "w") as fp:
+                json.dump({"builds": [{"artifact_id": f"sha256:{builder.config.config_name}"}]}, fp)
+
+        with (
+            patch.object(first, "build", side_effect=lambda: build(first)),
+            patch.object(second, "build", side_effect=lambda: build(second)),
+        ):
+            self.assertEqual(fleet.run(), {"first": None, "second": None})
+        self.assertEqual(journal.last(first)["artifact_id"], "sha256:first")
+        self.assertEqual(journal.last(second)["artifact_id"], "sha256:second")
+
+        shared = _DockerFleetBuilder("shared")
+        shared.set_files(manifest_file=first.manifest_file)
+        with self.assertRaises(PackerBuildError):
+            fleet.add(shared)
+
+
+class TestAdaptiveConcurrency(BasePackerTest):
+    def setUp(self):
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_aimd(self):
+        controller = ConcurrencyController("amazon-ebs:us-east-1", initial=2, maximum=4, cooldown=0)
+        self.assertTrue(controller.try_acquire())
+        self.assertTrue(controller.try_acquire())
+        self.assertFalse(controller.try_acquire())
+        controller.release(True)
+        controller.release(True)
+        self.assertAlmostEqual(controller.limit, 2.5 + 1 / 2.5)
+        self.assertTrue(controller.try_acquire())
+        controller.release(False, throttled=True)
+        self.assertAlmostEqual(controller.limit, (2.5 + 1 / 2.5) / 2)
+        for _ in range(3):
+            controller.try_acquire()
+            controller.release(False)
+        self.assertEqual(controller.limit, 1)
+        self.assertTrue(controller.try_acquire())
+        self.assertFalse(controller.try_acquire())
+
+    def test_cooldown(self):
+        controller = ConcurrencyController("docker:local", initial=8, cooldown=60)
+        controller.throttle()
+        controller.throttle()
+        self.assertEqual(controller.limit, 4)
+
+    def test_keys(self):
+        builder = _DockerFleetBuilder("local")
+        builder.configure()
+        builder.config.add_builder_source(
+            AmazonEbs(name="ami", ami_name="a", region="eu-west-1", access_key="k", secret_key="s", source_ami="ami-1")
+        )
+        self.assertEqual(AdaptiveConcurrency.keys(builder), ["amazon-ebs:eu-west-1", "docker:local"])
+
+    def test_throttle_sink(self):
+        lines = []
+        sink = ThrottleSink(lines.append)
+        sink.write("==> amazon-ebs.ami: Waiting for instance to become ready")
+        sink.write("Error: RequestLimitExceeded: Request limit exceeded.")
+        self.assertEqual(sink.throttled, 1)
+        self.assertEqual(lines, ["Error: RequestLimitExceeded: Request limit exceeded."])
+
+    def test_fleet_backs_off_on_throttling(self):
+        concurrency = AdaptiveConcurrency(initial=4, cooldown=0)
+        builders = [_DockerFleetBuilder(f"b{i}") for i in range(3)]
+
+        def throttled_build(builder):
+            for sink in builder.client.sinks:
+                sink.write("Error: Throttling: Rate exceeded")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fleet = Fleet(
+                builders,
+                max_workers=1,
+                history=DurationHistory(os.path.join(tmpdir, "d.json")),
+                concurrency=concurrency,
+            )
+            with patch.object(Fleet, "build", side_effect=throttled_build):
+                results = fleet.run()
+        self.assertEqual(results, {"b0": None, "b1": None, "b2": None})
+        controller = concurrency.controllers["docker:local"]
+        self.assertEqual(controller.limit, 1)
+        self.assertEqual(controller.active, 0)
+        self.assertEqual(builders[0].client.sinks, [])
+
+
+class TestBuildJournal(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.tmpdir.name, "journal.jsonl")
+        self.history = DurationHistory(os.path.join(self.tmpdir.name, "durations.json"))
+
+    def builder(self, name):
+        builder = _DockerFleetBuilder(name)
+        builder.manifest_file = os.path.join(self.tmpdir.name, f"{name}-manifest.json")
+        return builder
+
+    def write_manifest(self, builder, artifact_id):
+        with open(builder.manifest_file, "w") as fp:
+            json.dump({"builds": [{"artifact_id": artifact_id, "packer_run_uuid": "u"}], "last_run_uuid": "u"}, fp)
+
+    def test_records_are_durable_and_reloaded(self):
+        builder = self.builder("a")
+        builder.configure()
+        journal = BuildJournal(self.path)
+        journal.record("planned", builder)
+        journal.record("succeeded", builder, artifact_id="ami-1")
+        journal.close()
+        with open(self.path, "a") as fp:
+            fp.write('{"build": "a", "event": "fai')
+        reloaded = BuildJournal(self.path)
+        self.addCleanup(reloaded.close)
+        self.assertTrue(reloaded.completed(builder))
+        self.assertEqual(reloaded.last(builder)["artifact_id"], "ami-1")
+        builder.config.builder_sources["a"].image = "debian"
+        self.assertFalse(reloaded.completed(builder))
+
+    def test_resume_skips_completed_and_reattaches(self):
+        done, interrupted, crashed = self.builder("done"), self.builder("interrupted"), self.builder("crashed")
+        for builder in (done, interrupted, crashed):
+            builder.configure()
+        journal = BuildJournal(self.path, poll_interval=0)
+        journal.record("succeeded", done, artifact_id="ami-done")
+        journal.record("started", interrupted, pid=12345, workspace=self.tmpdir.name)
+        journal.record("started", crashed, pid=12346, workspace=self.tmpdir.name)
+        journal.close()
+        self.write_manifest(interrupted, "ami-interrupted")
+
+        journal = BuildJournal(self.path, poll_interval=0)
+        self.addCleanup(journal.close)
+        fleet = Fleet([done, interrupted, crashed], history=self.history, journal=journal)
+        for builder in (done, interrupted, crashed):
+            builder.configured = True
+        alive = iter([True, False, False])
+        with (
+            patch.object(BuildJournal, "process_alive", side_effect=lambda pid, start: next(alive)),
+            patch.object(PackerBuilder, "build") as build,
+            patch.object(PackerBuilder, "artifact_id", side_effect=lambda: "ami-interrupted"),
+        ):
+            results = fleet.run()
+        self.assertEqual(results, {"done": None, "interrupted": None, "crashed": None})
+        build.assert_called_once()
+        self.assertEqual(journal.last(interrupted)["event"], "succeeded")
+        self.assertTrue(journal.last(interrupted)["reattached"])
+        self.assertEqual(journal.last(crashed)["event"], "succeeded")
+
+    def test_failure_and_start_are_journaled(self):
+        builder = self.builder("a")
+        journal = BuildJournal(self.path)
+        self.addCleanup(journal.close)
+        fleet = Fleet([builder], history=self.history, journal=journal)
+
+        def failing_build():
+            for callback in builder.client.on_start:
+                callback("build", 4242)
+            raise PackerBuildError("Packer build failed")
+
+        with patch.object(builder, "build", side_effect=failing_build):
+            results = fleet.run()
+        self.assertIsInstance(results["a"], PackerBuildError)
+        with open(self.path) as fp:
+            events = [json.loads(line) for line in fp]
+        self.assertEqual([e["event"] for e in events], ["planned", "started", "failed"])
+        self.assertEqual(events[1]["pid"], 4242)
+        self.assertIn("process_start", events[1])
+        self.assertEqual(builder.client.on_start, [])
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs procfs")
+    def test_reused_pid_is_not_waited_for(self):
+        start = BuildJournal.process_start(os.getpid())
+        self.assertIsNotNone(start)
+        self.assertTrue(BuildJournal.process_alive(os.getpid(), start))
+        self.assertTrue(BuildJournal.process_alive(os.getpid()))
+        self.assertFalse(BuildJournal.process_alive(os.getpid(), str(int(start) + 1)))
+
+
+class TestPlan(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.history = DurationHistory(os.path.join(self.tmpdir.name, "durations.json"), default_estimate=60)
+
+    def builder(self, name):
+        builder = _DockerFleetBuilder(name)
+        builder.manifest_file = os.path.join(self.tmpdir.name, f"{name}-manifest.json")
+        return builder
+
+    def test_plan_does_not_run_packer(self):
+        builder = self.builder("a")
+        with patch("packerpy.client.subprocess") as subprocess_mock:
+            plan = builder.plan(self.history)
+        subprocess_mock.check_call.assert_not_called()
+        self.assertNotIn("client", builder.__dict__)
+        self.assertEqual(plan["fingerprint"], builder.config.fingerprint())
+        self.assertEqual(plan["sources"], ["source.docker.a"])
+        self.assertEqual(plan["builds"], [{"name": "a", "sources": ["source.docker.a"]}])
+        self.assertFalse(plan["cached"])
+        self.assertEqual(plan["estimated_seconds"], 60)
+        self.assertEqual(json.loads(json.dumps(plan)), plan)
+        builder.plan()
+        self.assertEqual(builder.configure_calls, 1)
+
+    def test_cache_hit_uses_manifest_fingerprint(self):
+        builder = self.builder("a")
+        builder.ensure_configured()
+        builder.add_manifest_post_processor()
+        manifest = next(p for p in builder.config.builder.post_processors if isinstance(p, Manifest))
+        self.assertEqual(manifest.custom_data, {"fingerprint": builder.config.fingerprint()})
+        with open(builder.manifest_file, "w") as fp:
+            json.dump({"builds": [{"artifact_id": "sha256:1", "custom_data": manifest.custom_data}]}, fp)
+        plan = builder.plan()
+        self.assertTrue(plan["cached"])
+        self.assertEqual(plan["artifact_id"], "sha256:1")
+        builder.config.builder_sources["a"].image = "debian"
+        self.assertFalse(builder.plan()["cached"])
+
+    def test_fleet_plan(self):
+        short, long = self.builder("short"), self.builder("long")
+        fleet = Fleet([short, long], max_workers=1, history=self.history)
+        fleet.configure()
+        self.history.record(short, 10)
+        self.history.record(long, 100)
+        plan = fleet.plan()
+        self.assertEqual([p["name"] for p in plan["builds"]], ["long", "short"])
+        self.assertEqual([p["start_seconds"] for p in plan["builds"]], [0, 100])
+        self.assertEqual(plan["makespan_seconds"], 110)
+
+
+class TestBuildGraph(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.history = DurationHistory(os.path.join(self.tmpdir.name, "durations.json"), default_estimate=10)
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inject_artifact(self):
+        ami = AmazonEbs(name="ami", ami_name="a", region="eu-west-1", access_key="k", secret_key="s", source_ami="x")
+        ami.inject_artifact("us-east-1:ami-1,eu-west-1:ami-2")
+        self.assertEqual(ami.source_ami, "ami-2")
+        with self.assertRaises(PackerBuildError):
+            ami.inject_artifact("us-east-1:ami-1")
+        docker = DockerBuilder("d", image="ubuntu", commit=True)
+        docker.inject_artifact("sha256:abc")
+        self.assertEqual(docker.image, "sha256:abc")
+        with self.assertRaises(PackerBuildError):
+            BuilderSourceConfig("null", "n").inject_artifact("x")
+
+    def test_cycle_detected(self):
+        a, b = _DockerFleetBuilder("a"), _DockerFleetBuilder("b")
+        a.add_upstream(b)
+        b.add_upstream(a)
+        with self.assertRaises(PackerBuildError) as cm:
+            Fleet([a], history=self.history).schedule()
+        self.assertIn("a -> b -> a", str(cm.exception))
+
+    def test_critical_path_first(self):
+        base, hardened, app, lone = (_DockerFleetBuilder(n) for n in ("base", "hardened", "app", "lone"))
+        hardened.add_upstream(base)
+        app.add_upstream(hardened)
+        fleet = Fleet([app, lone], max_workers=2, history=self.history)
+        fleet.configure()
+        self.history.record(lone, 25)
+        self.assertEqual([b.config.config_name for b, _ in fleet.schedule()], ["base", "lone", "hardened", "app"])
+        starts = {b.config.config_name: start for b, _, start, _ in fleet.simulate()}
+        self.assertEqual(starts, {"base": 0, "lone": 0, "hardened": 10, "app": 20})
+
+    def test_run_injects_artifacts_and_skips_downstream_of_failures(self):
+        base, app, broken, child = (_DockerFleetBuilder(n) for n in ("base", "app", "broken", "child"))
+        app.add_upstream(base)
+        child.add_upstream(broken)
+        built = []
+
+        def build(builder):
+            built.append((builder.config.config_name, builder.config.builder_sources[builder.config.config_name].image))
+            if builder is broken:
+                raise PackerBuildError("Packer build failed")
+
+        fleet = Fleet([app, child], history=self.history)
+        with (
+            patch.object(Fleet, "build", side_effect=build),
+            patch.object(PackerBuilder, "artifact_id", return_value="sha256:base"),
+        ):
+            results = fleet.run()
+        self.assertIn(("base", "ubuntu"), built)
+        self.assertIn(("app", "sha256:base"), built)
+        self.assertLess(built.index(("base", "ubuntu")), built.index(("app", "sha256:base")))
+        self.assertNotIn("child", [name for name, _ in built])
+        self.assertIsNone(results["app"])
+        self.assertIsInstance(results["child"], PackerBuildError)
+        self.assertIn("broken", str(results["child"]))
+
+
+class _StagedDockerBuilder(PackerBuilder):
+    def __init__(self, tmpdir, steps, store):
+        super().__init__(
+            "staged",
+            config_file=os.path.join(tmpdir, "staged.pkr.json"),
+            manifest_file=os.path.join(tmpdir, "manifest.json"),
+            checkpoints=store,
+        )
+        self.steps = steps
+
+    def configure(self) -> None:
+        self.config.add_builder_source(DockerBuilder("app", image="ubuntu:24.04", commit=True))
+        self.config.builder.add_provisioner(*(ShellProvisioner(inline=[step]) for step in self.steps))
+
+
+class _DeferredStagedDockerBuilder(_StagedDockerBuilder):
+    def configure(self) -> None:
+        self.config.add_builder_source(DockerBuilder("app", image=self.image(), commit=True))
+        self.config.builder.add_provisioner(
+            *(ShellProvisioner(inline=[step], execute_command=lambda: "sudo sh {{.Path}}") for step in self.steps)
+        )
+
+    async def image(self):
+        return "ubuntu:24.04"
+
+
+class TestCheckpoints(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.discarded = []
+        patcher = patch.multiple(
+            CheckpointStore, VALIDATORS={"docker": lambda image: True}, DISCARDERS={"docker": self.discarded.append}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = CheckpointStore(os.path.join(self.tmpdir.name, "checkpoints.json"), max_entries=10)
+
+    def test_stage_keys_chain_prefixes(self):
+        source = DockerBuilder("app", image="ubuntu", commit=True)
+        first = stage_keys(source, [[ShellProvisioner(inline=["a"])], [ShellProvisioner(inline=["b"])]])
+        second = stage_keys(source, [[ShellProvisioner(inline=["a"])], [ShellProvisioner(inline=["c"])]])
+        self.assertEqual(first[0], second[0])
+        self.assertNotEqual(first[1], second[1])
+        script = os.path.join(self.tmpdir.name, "setup.sh")
+        with open(script, "w") as fp:
+            fp.write("echo 1")
+        before = stage_keys(source, [[FileProvisioner(source=script, destination="/tmp/setup.sh")]])
+        with open(script, "w") as fp:
+            fp.write("echo 2")
+        os.utime(script, ns=(1, 1))
+        self.assertNotEqual(before, stage_keys(source, [[FileProvisioner(source=script, destination="/tmp/setup.sh")]]))
+
+    def test_store_evicts_least_recently_used(self):
+        store = CheckpointStore(self.store.path, max_entries=2)
+        store.put("a", "packerpy-checkpoint:a", "docker")
+        store.put("b", "packerpy-checkpoint:b", "docker")
+        store.entries["a"]["used"] = store.entries["b"]["used"] + 1
+        store.put("c", "packerpy-checkpoint:c", "docker")
+        self.assertEqual(self.discarded, ["packerpy-checkpoint:b"])
+        self.assertEqual(CheckpointStore(store.path).get("a"), "packerpy-checkpoint:a")
+        with patch.dict(CheckpointStore.VALIDATORS, {"docker": lambda image: False}):
+            self.assertIsNone(store.get("c"))
+        self.assertNotIn("c", store.entries)
+
+    def test_cloud_checkpoints(self):
+        states, commands = {"ami-1": "available"}, []
+
+        def run(command, **kwargs):
+            commands.append(command)
+            if command[-3:] == ["Images[0].State", "--output", "text"]:
+                return subprocess.CompletedProcess(command, 0, states.get(command[6], "None"), "")
+            if "describe-images" in command:
+                return subprocess.CompletedProcess(command, 0, "snap-1\tsnap-2\n", "")
+            if command[:3] == ["gcloud", "compute", "images"] and command[3] == "describe":
+                return subprocess.CompletedProcess(command, 1, "", f"The resource '{command[4]}' was not found")
+            return subprocess.CompletedProcess(command, 0, "", "")
+
+        store = CheckpointStore(
+            self.store.path,
+            max_entries=1,
+            validators={"amazon-ebs": amazon_image_exists, "googlecompute": google_image_exists},
+            discarders={"amazon-ebs": remove_amazon_image, "googlecompute": remove_google_image},
+        )
+        with patch("packerpy.checkpoints.subprocess.run", side_effect=run):
+            store.put("a", "us-east-1:ami-1", "amazon-ebs")
+            self.assertEqual(store.get("a"), "us-east-1:ami-1")
+            states["ami-1"] = "deregistered"
+            self.assertIsNone(store.get("a"))
+            store.put("a", "us-east-1:ami-1", "amazon-ebs")
+            store.put("g", "golden-stage-1", "googlecompute")
+            self.assertIsNone(store.get("g"))
+        self.assertIn(["aws", "ec2", "--region", "us-east-1", "deregister-image", "--image-id", "ami-1"], commands)
+        self.assertIn(["aws", "ec2", "--region", "us-east-1", "delete-snapshot", "--snapshot-id", "snap-2"], commands)
+        store.put("a", "us-east-1:ami-2", "amazon-ebs")
+        with (
+            patch("packerpy.checkpoints.subprocess.run", side_effect=FileNotFoundError("aws")),
+            self.assertLogs(store.log, "WARNING") as logs,
+        ):
+            store.put("z", "azure-image", "azure-arm")
+            store.put("b", "us-east-1:ami-3", "amazon-ebs")
+        self.assertIn("us-east-1:ami-2", logs.output[0])
+        self.assertIn("azure-image", logs.output[1])
+
+    def test_stage_keys_ignore_credentials(self):
+        stages = [[ShellProvisioner(inline=["a"])]]
+        first = stage_keys(AmazonEbs("ami", "ami", "us-east-1", "AKIA1", "secret1", source_ami="ami-1"), stages)
+        second = stage_keys(AmazonEbs("ami", "ami", "us-east-1", "AKIA2", "secret2", source_ami="ami-1"), stages)
+        self.assertEqual(first, second)
+
+    def build(self, steps, builder_class=_StagedDockerBuilder):
+        builder = builder_class(self.tmpdir.name, steps, self.store)
+        builder.client = MagicMock()
+        builder.client.run.return_value.returncode = 0
+        executed = []
+        builder.execute = lambda config, config_file: executed.append(config.json())
+        with patch.object(PackerBuilder, "artifact_exists", return_value=True):
+            builder.run()
+        return executed
+
+    def test_resumes_from_deepest_checkpoint(self):
+        executed = self.build(["apt-get update", "apt-get install -y nginx", "echo v1"])
+        self.assertEqual(len(executed), 3)
+        keys = list(self.store.entries)
+        images = [template["source"][0]["docker"]["app"]["image"] for template in executed]
+        self.assertEqual(images[0], "ubuntu:24.04")
+        self.assertIn(images[1].removeprefix("packerpy-checkpoint:"), keys)
+        self.assertFalse(executed[1]["source"][0]["docker"]["app"]["pull"])
+        tag = executed[0]["build"][0]["post-processors"][0]["post-processor"]["docker-tag"][0]
+        self.assertEqual(tag["repository"], "packerpy-checkpoint")
+        self.assertEqual([p["shell"]["inline"] for p in executed[2]["build"][0]["provisioner"]], [["echo v1"]])
+
+        executed = self.build(["apt-get update", "apt-get install -y nginx", "echo v2"])
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(executed[0]["source"][0]["docker"]["app"]["image"], images[2])
+        self.assertEqual([p["shell"]["inline"] for p in executed[0]["build"][0]["provisioner"]], [["echo v2"]])
+
+    def test_resumes_with_deferred_values(self):
+        executed = self.build(["apt-get update", "echo v1"], _DeferredStagedDockerBuilder)
+        self.assertEqual(len(executed), 2)
+        self.assertEqual(executed[0]["source"][0]["docker"]["app"]["image"], "ubuntu:24.04")
+        self.assertEqual(executed[0]["build"][0]["provisioner"][0]["shell"]["execute_command"], "sudo sh {{.Path}}")
+        executed = self.build(["apt-get update", "echo v2"], _DeferredStagedDockerBuilder)
+        self.assertEqual(len(executed), 1)
+
+    def test_plan_resumes_with_deferred_values(self):
+        steps = ["apt-get update", "apt-get install -y nginx", "echo v1"]
+        self.build(steps, _DeferredStagedDockerBuilder)
+        self.assertEqual(len(self.store.entries), 2)
+        builder = _DeferredStagedDockerBuilder(self.tmpdir.name, steps, self.store)
+        self.assertEqual(builder.plan()["resume_stage"], 2)
+        self.assertEqual(len(self.build(steps, _DeferredStagedDockerBuilder)), 1)
+
+
+class _StagedAmiBuilder(PackerBuilder):
+    def __init__(self, tmpdir, store):
+        super().__init__(
+            "golden",
+            config_file=os.path.join(tmpdir, "golden.pkr.json"),
+            manifest_file=os.path.join(tmpdir, "manifest.json"),
+            checkpoints=store,
+        )
+
+    def configure(self) -> None:
+        self.config.add_builder_source(
+            AmazonEbs(
+                name="golden",
+                ami_name="golden-{{timestamp}}",
+                region="us-east-1",
+                access_key="k",
+                secret_key="s",
+                source_ami="ami-base",
+                ami_regions=["eu-west-1"],
+            )
+        )
+        self.config.builder.add_provisioner(ShellProvisioner(inline=["os"]), ShellProvisioner(inline=["packages"]))
+        self.config.builder.add_stage_boundary()
+        self.config.builder.add_provisioner(ShellProvisioner(inline=["hardening"]))
+        self.config.builder.add_stage_boundary()
+        self.config.builder.add_provisioner(ShellProvisioner(inline=["app"]))
+
+
+class TestStageBoundaries(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = CheckpointStore(
+            os.path.join(self.tmpdir.name, "checkpoints.json"), validators={"amazon-ebs": lambda artifact: True}
+        )
+
+    def build(self, fail_at=None):
+        builder = _StagedAmiBuilder(self.tmpdir.name, self.store)
+        builder.client = MagicMock()
+        executed = []
+
+        def execute(config, config_file):
+            template = config.json()
+            executed.append(template)
+            if len(executed) - 1 == fail_at:
+                raise PackerBuildError("Packer build failed")
+            if ".stage-" in config_file:
+                manifest = config_file.replace(".pkr.json", ".manifest.json")
+                with open(manifest, "w") as fp:
+                    json.dump({"builds": [{"artifact_id": f"us-east-1:ami-{len(executed)}"}]}, fp)
+
+        builder.execute = execute
+        with patch.object(PackerBuilder, "artifact_exists", return_value=True):
+            builder.run()
+        return builder, executed
+
+    def test_stages_split_at_boundaries(self):
+        builder = _StagedAmiBuilder(self.tmpdir.name, self.store)
+        builder.ensure_configured()
+        self.assertEqual([len(stage) for stage in builder.stages()], [2, 1, 1])
+        self.assertEqual(builder.plan()["stages"], 3)
+
+    def test_resume_from_last_successful_stage(self):
+        with self.assertRaises(PackerBuildError):
+            self.build(fail_at=2)
+        builder, executed = self.build()
+        self.assertEqual(len(executed), 1)
+        source = executed[0]["source"][0]["amazon-ebs"]["golden"]
+        self.assertEqual(source["source_ami"], "ami-2")
+        self.assertEqual(source["ami_regions"], ["eu-west-1"])
+        self.assertEqual(builder.plan()["resume_stage"], 2)
+
+    def test_intermediate_stage_sources(self):
+        _, executed = self.build()
+        first, second = (template["source"][0]["amazon-ebs"]["golden"] for template in executed[:2])
+        self.assertEqual(first["source_ami"], "ami-base")
+        self.assertNotIn("ami_regions", first)
+        self.assertRegex(first["ami_name"], r"^golden-\{\{timestamp\}\}-stage-[0-9a-f]{12}$")
+        self.assertEqual(second["source_ami"], "ami-1")
+        google = GoogleComputeBuilder(
+            name="g", project_id="p", zone="z", source_image_family="debian-12", image_family="golden"
+        )
+        checkpoint, post_processors, artifact = google.checkpoint("0123456789abcdef")
+        self.assertEqual(checkpoint.image_name, "packer-stage-0123456789ab-{{timestamp}}")
+        self.assertIsNone(checkpoint.image_family)
+        self.assertEqual((post_processors, artifact), ([], None))
+        self.assertEqual(google.image_family, "golden")
+
+
+class TestLazyImports(BasePackerTest):
+    def run_python(self, code):
+        return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split()
+
+    def test_import_defers_hcl_parser(self):
+        loaded = self.run_python(
+            "import sys\n"
+            "import packerpy\n"
+            "from packerpy import PackerBuilder, PackerConfig\n"
+            "print('hcl2' in sys.modules, 'lark' in sys.modules)"
+        )
+        self.assertEqual(loaded, ["False", "False"])
+
+    def test_import_defers_submodules(self):
+        loaded = self.run_python(
+            "import sys\nimport packerpy\nprint('packerpy.models' in sys.modules, 'packerpy.fleet' in sys.modules)"
+        )
+        self.assertEqual(loaded, ["False", "False"])
+
+    def test_lazy_attributes(self):
+        import packerpy
+
+        self.assertIs(packerpy.PackerConfig, PackerConfig)
+        self.assertIs(packerpy.Fleet, Fleet)
+        self.assertIn("PackerBuilder", dir(packerpy))
+        self.assertEqual(set(packerpy.__all__) - {"PackerBuildError", "PackerClientError"}, set(packerpy.LAZY_IMPORTS))
+        with self.assertRaises(AttributeError):
+            packerpy.NotAThing
+
+
+class _ProfiledBuilder(PackerBuilder):
+    def configure(self) -> None:
+        template = {"source": [{"docker": {"d": {"image": "ubuntu", "commit": True}}}]}
+        loaded = PackerConfig.load_config("loaded", config_content=json.dumps(template), config_type="json")
+        self.config.add_builder_source(*loaded.builder_sources.values())
+
+
+class TestPhaseProfiler(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config_file = os.path.join(self.tmpdir.name, "build.pkr.json")
+
+    def test_from_setting(self):
+        with patch.dict(os.environ, {"PACKERPY_PROFILE": "cpu"}):
+            profiler = PhaseProfiler.from_setting(None, self.tmpdir.name)
+            self.assertIs(PhaseProfiler.from_setting(False, self.tmpdir.name), NULL_PROFILER)
+        self.assertEqual((profiler.cpu, profiler.memory), (True, False))
+        profiler = PhaseProfiler.from_setting(True, self.tmpdir.name)
+        self.assertEqual((profiler.cpu, profiler.memory), (True, True))
+        self.assertIs(PhaseProfiler.from_setting(profiler, "elsewhere"), profiler)
+        with patch.dict(os.environ, {"PACKERPY_PROFILE": ""}):
+            self.assertIs(PhaseProfiler.from_setting(None, self.tmpdir.name), NULL_PROFILER)
+        with self.assertRaises(ValueError):
+            PhaseProfiler.from_setting("gpu", self.tmpdir.name)
+
+    def test_builder_phases_write_reports(self):
+        builder = _ProfiledBuilder("profiled", config_file=self.config_file, profile=True)
+        builder.ensure_configured()
+        builder.write_config()
+        builder.write_config()
+        directory = os.path.join(self.tmpdir.name, "build.profile")
+        self.assertEqual(builder.profiler.directory, directory)
+        for label in ("configure", "load", "serialize", "serialize.2"):
+            self.assertTrue(os.path.exists(os.path.join(directory, f"{label}.pstats")), label)
+            with open(os.path.join(directory, f"{label}.allocations.txt")) as fp:
+                self.assertTrue(fp.readline().startswith(f"# {label}: peak traced memory"))
+        functions = pstats.Stats(os.path.join(directory, "configure.pstats")).stats
+        self.assertIn("configure", {function for _, _, function in functions})
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIs(current_profiler(), NULL_PROFILER)
+
+    def test_disabled_by_default(self):
+        with patch.dict(os.environ, {"PACKERPY_PROFILE": ""}):
+            builder = _ProfiledBuilder("plain", config_file=self.config_file)
+        builder.ensure_configured()
+        builder.write_config()
+        self.assertIs(builder.profiler, NULL_PROFILER)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["build.pkr.json"])
+
+
+class TestProcessTreeMonitor(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.proc = self.tmpdir.name
+
+    def add_process(self, pid, ppid, ticks=0, pages=0, io=(0, 0), state="S"):
+        fields = ["0"] * 50
+        fields[:2] = [state, str(ppid)]
+        fields[11], fields[12], fields[21] = str(ticks), str(ticks), str(pages)
+        os.makedirs(os.path.join(self.proc, str(pid)), exist_ok=True)
+        with open(os.path.join(self.proc, str(pid), "stat"), "w") as fp:
+            fp.write(f"{pid} (odd ) name) {' '.join(fields)}\n")
+        with open(os.path.join(self.proc, str(pid), "io"), "w") as fp:
+            fp.write(f"rchar: 1\nread_bytes: {io[0]}\nwrite_bytes: {io[1]}\n")
+
+    def test_sample_process_tree(self):
+        self.add_process(10, 1, ticks=100, pages=10, io=(1000, 10))
+        self.add_process(11, 10, ticks=50, pages=20, io=(500, 5))
+        self.add_process(12, 11, pages=30)
+        self.add_process(13, 10, state="Z")
+        self.add_process(20, 1, ticks=1000, pages=1000)
+        monitor = ProcessTreeMonitor(10, proc=self.proc)
+        self.assertEqual(sorted(monitor.tree()), [10, 11, 12, 13])
+        monitor.sample()
+        self.add_process(11, 10, ticks=60, pages=5, io=(600, 5))
+        os.remove(os.path.join(self.proc, "12", "stat"))
+        monitor.sample()
+        usage = monitor.usage()
+        self.assertEqual(usage["samples"], 2)
+        self.assertEqual(usage["processes_peak"], 3)
+        self.assertEqual(usage["rss_bytes_peak"], 60 * PAGE_SIZE)
+        self.assertEqual(usage["rss_bytes_avg"], (60 + 15) * PAGE_SIZE // 2)
+        self.assertEqual(usage["cpu_seconds"], (200 + 120) / os.sysconf("SC_CLK_TCK"))
+        self.assertEqual((usage["read_bytes"], usage["write_bytes"]), (1600, 15))
+
+    def test_memory_available(self):
+        with open(os.path.join(self.proc, "meminfo"), "w") as fp:
+            fp.write("MemTotal: 2048 kB\nMemAvailable: 1024 kB\n")
+        self.assertEqual(memory_available(self.proc), 1024 * 1024)
+        self.assertIsNone(memory_available(os.path.join(self.proc, "missing")))
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs procfs")
+    def test_monitor_child_processes(self):
+        code = "import subprocess, sys; subprocess.run([sys.executable, '-c', 'x = bytearray(64 << 20); input()'])"
+        proc = subprocess.Popen([sys.executable, "-c", code], stdin=subprocess.PIPE)
+        monitor = ProcessTreeMonitor(proc.pid, interval=0.01)
+        monitor.start()
+        while monitor.usage()["processes_peak"] < 2 or monitor.usage()["rss_bytes_peak"] < 64 << 20:
+            time.sleep(0.01)
+        proc.communicate(b"\n")
+        monitor.stop()
+        self.assertGreaterEqual(monitor.usage()["rss_bytes_peak"], 64 << 20)
+
+
+class TestFleetAdmission(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.history = DurationHistory(os.path.join(self.tmpdir.name, "durations.json"))
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_runs_locally(self):
+        docker = _DockerFleetBuilder("docker")
+        docker.configure()
+        self.assertTrue(Fleet.runs_locally(docker))
+        ami = PackerBuilder("ami")
+        ami.config.add_builder_source(AmazonEbs("ami", "ami", "us-east-1", "key", "secret", source_ami="ami-1"))
+        self.assertFalse(Fleet.runs_locally(ami))
+        ami.config.builder.add_provisioner(ShellLocalProvisioner(inline=["make"]))
+        self.assertTrue(Fleet.runs_locally(ami))
+
+    def test_admit_uses_recorded_peak_memory(self):
+        builder = _DockerFleetBuilder("docker")
+        builder.configure()
+        fleet = Fleet([builder], history=self.history, memory_headroom=1 << 30)
+        with patch("packerpy.fleet.memory_available", return_value=3 << 30):
+            self.assertTrue(fleet.admit(builder))
+            self.history.record(builder, 60, rss_bytes_peak=3 << 30)
+            self.assertFalse(fleet.admit(builder))
+        self.history.record(builder, 60)
+        self.assertEqual(self.history.expected_memory(builder), 3 << 30)
+        self.assertTrue(Fleet([builder], history=self.history).admit(builder))
+
+    def test_run_holds_back_local_builds(self):
+        builders = [_DockerFleetBuilder(name) for name in ("a", "b")]
+        fleet = Fleet(builders, max_workers=2, history=self.history, memory_headroom=1 << 30)
+        running, overlap = [], []
+
+        def build(fleet, builder):
+            running.append(builder)
+            overlap.append(len(running))
+            time.sleep(0.05)
+            running.remove(builder)
+
+        with patch("packerpy.fleet.memory_available", return_value=1 << 29), patch.object(Fleet, "build", build):
+            self.assertEqual(fleet.run(), {"a": None, "b": None})
+        self.assertEqual(overlap, [1, 1])
+
+
+class _ValidatedBuilder(PackerBuilder):
+    def __init__(self, name, image="ubuntu", plugin_version="1.0.0"):
+        super().__init__(name, config_file=f"{name}.pkr.json")
+        self.image = image
+        self.plugin_version = plugin_version
+
+    def configure(self) -> None:
+        self.config.requirements.add_plugin(Plugin("docker", self.plugin_version, ">=", "github.com/hashicorp/docker"))
+        source = DockerBuilder("app", image=self.image, commit=True)
+        self.config.add_builder_source(source)
+        provisioner = ShellProvisioner(inline=["echo hi"])
+        provisioner.add_only_sources(source)
+        self.config.builder.add_provisioner(provisioner)
+
+
+class _OptimizedValidatedBuilder(_ValidatedBuilder):
+    def configure(self) -> None:
+        for region in ("eu", "us"):
+            self.config.add_builder_source(
+                DockerBuilder(region, image="ubuntu:24.04", commit=True, platform="linux/amd64", pull=True)
+            )
+        self.config.add_optimizer(SourceOverrideOptimizer())
+
+
+class TestBatchValidation(BasePackerTest):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.workspace = os.path.join(self.tmpdir.name, "validate")
+        patcher = patch.object(PackerClient, "verify_packer_installation")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batches = []
+
+    def fleet(self, builders):
+        return Fleet(builders, history=DurationHistory(os.path.join(self.tmpdir.name, "durations.json")))
+
+    def fake_packer(self, global_error=False):
+        def run(client, command, *args):
+            files = sorted(os.listdir(client.file))
+            if command == "validate":
+                self.batches.append(files)
+            failed = False
+            for name in files:
+                with open(os.path.join(client.file, name)) as fp:
+                    template = json.load(fp)
+                for source in template.get("source", []):
+                    for source_name, attrs in source.get("docker", {}).items():
+                        if command == "validate" and attrs["image"] == "broken":
+                            failed = True
+                            if not global_error:
+                                client.output_tail.extend(
+                                    [f"Error: docker.{source_name}: image not found", "", f"  on {name} line 4:"]
+                                )
+                declared = {
+                    f"{_type}.{n}" for source in template.get("source", []) for _type in source for n in source[_type]
+                }
+                for build in template.get("build", []):
+                    for block in build.get("source", []):
+                        for reference in set(block) - declared:
+                            failed = True
+                            client.output_tail.extend(
+                                [f"Error: Unknown source {reference}", "", f"  on {name} line 9:"]
+                            )
+            if failed and global_error:
+                client.output_tail.append("Error: Failed to initialize build")
+            return MagicMock(returncode=1 if failed else 0)
+
+        return patch.object(PackerClient, "run", autospec=True, side_effect=run)
+
+    def test_namespace_template(self):
+        builder = _ValidatedBuilder("a")
+        builder.configure()
+        template = namespace_template(builder.config.json(), "p-")
+        self.assertEqual(list(template["source"][0]["docker"]), ["p-app"])
+        self.assertEqual(template["build"][0]["name"], "p-a")
+        self.assertEqual(template["build"][0]["sources"], ["source.docker.p-app"])
+        self.assertEqual(template["build"][0]["provisioner"][0]["shell"]["only"], ["docker.p-app"])
+        self.assertEqual(builder.config.json()["build"][0]["name"], "a")
+
+    def test_validate_in_one_batch(self):
+        builders = [_ValidatedBuilder(name) for name in ("a", "b", "c")]
+        with self.fake_packer():
+            results = self.fleet(builders).validate(workspace=self.workspace)
+        self.assertEqual(results, {"a": None, "b": None, "c": None})
+        self.assertEqual(
+            self.batches,
+            [["packerpy0000.pkr.json", "packerpy0001.pkr.json", "packerpy0002.pkr.json", "requirements.pkr.json"]],
+        )
+        self.assertEqual(os.listdir(self.workspace), [])
+
+    def test_errors_mapped_to_builders(self):
+        builders = [_ValidatedBuilder("a"), _ValidatedBuilder("broken", image="broken"), _ValidatedBuilder("c")]
+        with self.fake_packer():
+            results = self.fleet(builders).validate(workspace=self.workspace)
+        self.assertIsNone(results["a"])
+        self.assertIsNone(results["c"])
+        self.assertIn("broken.pkr.json", str(results["broken"]))
+        self.assertEqual(
+            results["broken"].output, ["Error: docker.app: image not found", "", "  on broken.pkr.json line 4:"]
+        )
+        self.assertEqual([len(batch) for batch in self.batches], [4, 3])
+
+    def test_unattributed_errors_validate_individually(self):
+        builders = [_ValidatedBuilder("a"), _ValidatedBuilder("broken", image="broken")]
+        with self.fake_packer(global_error=True):
+            results = self.fleet(builders).validate(workspace=self.workspace)
+        self.assertIsNone(results["a"])
+        self.assertEqual(results["broken"].output, ["Error: Failed to initialize build"])
+        self.assertEqual([len(batch) for batch in self.batches], [3, 2, 2])
+
+    def test_conflicting_plugins_split_batches(self):
+        builders = [_ValidatedBuilder("a"), _ValidatedBuilder("b", plugin_version="2.0.0"), _ValidatedBuilder("c")]
+        with self.fake_packer():
+            results = self.fleet(builders).validate(workspace=self.workspace)
+        self.assertEqual(results, {"a": None, "b": None, "c": None})
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [2, 3])
+
+    def test_source_overrides_are_namespaced(self):
+        builder = _OptimizedValidatedBuilder("optimized")
+        builder.configure()
+        self.assertIn("source", builder.config.json()["build"][0])
+        template = namespace_template(builder.config.json(), "p-")
+        self.assertEqual(
+            [
+                (reference, attrs["name"])
+                for block in template["build"][0]["source"]
+                for reference, attrs in block.items()
+            ],
+            [("docker.p-docker_base", "p-eu"), ("docker.p-docker_base", "p-us")],
+        )
+        with self.fake_packer():
+            results = self.fleet([builder, _ValidatedBuilder("a")]).validate(workspace=self.workspace)
+        self.assertEqual(results, {"optimized": None, "a": None})
+        self.assertEqual(len(self.batches), 1)
+
+
+class TestDeferredValues(BasePackerTest):
+    def test_json_resolves_deferred_values_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+        calls = []
+
+        def lookup(value):
+            def resolve():
+                calls.append(value)
+                barrier.wait()
+                return value
+
+            return resolve
+
+        async def latest_ami():
+            return "ami-async"
+
+        future = Future()
+        future.set_result("ami-future")
+        config = PackerConfig("deferred")
+        config.add_builder_source(
+            AmazonEbs("a", "a", "us-east-1", lookup("AKIA1"), lookup("secret1"), source_ami=latest_ami()),
+            AmazonEbs("b", "b", "us-east-1", lookup("AKIA2"), "secret2", source_ami=future),
+        )
+        template = config.json()
+        self.assertEqual(template["source"][0]["amazon-ebs"]["a"]["access_key"], "AKIA1")
+        self.assertEqual(template["source"][0]["amazon-ebs"]["a"]["source_ami"], "ami-async")
+        self.assertEqual(template["source"][1]["amazon-ebs"]["b"]["source_ami"], "ami-future")
+        self.assertEqual(config.json(), template)
+        self.assertEqual(sorted(calls), ["AKIA1", "AKIA2", "secret1"])
+        self.assertIn("secret1", config.secrets())
+        self.assertIn("secret2", config.secrets())
+
+    def test_lookup_errors_raise(self):
+        config = PackerConfig("deferred")
+        config.add_builder_source(AmazonEbs("a", "a", "us-east-1", lambda: 1 / 0, "secret", source_ami="ami-1"))
+        with self.assertRaises(PackerBuildError) as cm:
+            config.json()
+        self.assertIn("division by zero", str(cm.exception))
+
+    def test_clones_share_resolved_values(self):
+        calls = []
+        base = PackerConfig("base")
+        base.add_builder_source(
+            AmazonEbs("a", "a", "us-east-1", lambda: calls.append(1) or "AKIA", "secret", source_ami="ami-1")
+        )
+        for region in ("eu-west-1", "eu-west-2"):
+            self.assertEqual(
+                base.derive(region, region=region).json()["source"][0]["amazon-ebs"]["a"]["access_key"], "AKIA"
+            )
+        self.assertEqual(calls, [1])
+
+    def test_fleet_resolves_all_builds_in_one_batch(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        class _LookupBuilder(PackerBuilder):
+            def configure(self):
+                self.config.add_builder_source(DockerBuilder(self.config.config_name, image=self.image, commit=True))
+
+            def image(self):
+                barrier.wait()
+                return "ubuntu"
+
+        with patch.object(PackerClient, "verify_packer_installation"), tempfile.TemporaryDirectory() as tmpdir:
+            builders = [_LookupBuilder("a"), _LookupBuilder("b")]
+            fleet = Fleet(builders, history=DurationHistory(os.path.join(tmpdir, "durations.json")))
+            fleet.configure()
+        self.assertEqual(len(fleet.resolver.cache), 2)
+        self.assertTrue(all(builder.config.resolver is fleet.resolver for builder in builders))
+        self.assertEqual(builders[1].config.json()["source"][0]["docker"]["b"]["image"], "ubuntu")
+
+    def test_fleet_keeps_values_resolved_by_builders(self):
+        class _AsyncBuilder(PackerBuilder):
+            def configure(self):
+                self.config.add_builder_source(DockerBuilder("app", image=self.image(), commit=True))
+
+            async def image(self):
+                return "ubuntu"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            builder = _AsyncBuilder("async", manifest_file=os.path.join(tmpdir, "manifest.json"))
+            self.assertEqual(builder.plan()["builds"][0]["sources"], ["source.docker.app"])
+            fleet = Fleet([builder], history=DurationHistory(os.path.join(tmpdir, "durations.json")))
+            fleet.plan()
+        self.assertEqual(builder.config.json()["source"][0]["docker"]["app"]["image"], "ubuntu")
+
+
+class TestWireFormat(BasePackerTest):
+    def setUp(self):
+        self.config = PackerConfig("wire")
+        self.config.set_env(PKR_VAR_region="eu-west-1")
+        self.config.add_builder_source(
+            DockerBuilder("ubuntu", image=lambda: "ubuntu:24.04", commit=True, local_build_vars={"DOCKER_BUILDKIT": 1})
+        )
+        self.config.builder.add_provisioner(ShellProvisioner(inline=["apt-get update"]))
+        self.config.builder.add_stage_boundary()
+        self.config.builder.add_provisioner(ShellProvisioner(inline=["apt-get install -y nginx"]))
+
+    def test_round_trip(self):
+        data = self.config.to_wire()
+        self.assertIsInstance(data, bytes)
+        self.assertIn(b'"image":"ubuntu:24.04"', data)
+        config = PackerConfig.from_wire(data)
+        self.assertEqual(config.config_name, "wire")
+        self.assertEqual(config.json(), self.config.json())
+        self.assertEqual(config.env, self.config.env)
+        self.assertEqual(config.environment(), {"DOCKER_BUILDKIT": "1", "PKR_VAR_region": "eu-west-1"})
+        self.assertEqual(config.builder.stage_boundaries, [1])
+        self.assertEqual(config.to_wire(), data)
+
+    def test_pickle_keeps_the_object(self):
+        config = PackerConfig("pickled")
+        config.add_builder_source(DockerBuilder("ubuntu", image="ubuntu:24.04", commit=True, local_build_vars={"A": 1}))
+        config.add_optimizer(ShellFusionOptimizer())
+        config.json()
+        unpickled = pickle.loads(pickle.dumps(config))
+        self.assertEqual(unpickled.json(), config.json())
+        self.assertEqual(unpickled.environment(), {"A": "1"})
+        self.assertEqual(len(unpickled.optimizers), 1)
+        self.assertEqual(unpickled.resolver.cache, {})
+
+    def test_unknown_types_raise(self):
+        self.config.builder.add_provisioner(Provisioner("ansible"))
+        with self.assertRaises(PackerBuildError) as cm:
+            self.config.to_wire()
+        self.assertIn("ansible", str(cm.exception))
+        with self.assertRaises(PackerBuildError):
+            PackerConfig.from_wire(b'{"format":0}')
+
+    def test_copies_keep_object_semantics(self):
+        shallow = copy.copy(self.config)
+        self.assertIs(shallow.builders, self.config.builders)
+        deep = copy.deepcopy(self.config)
+        self.assertIsNot(deep.builders, self.config.builders)
+        self.assertIs(deep.resolver, self.config.resolver)
+        self.assertEqual(deep.json(), self.config.json())
+
+    def test_shared_payload(self):
+        data = self.config.to_wire()
+        with SharedPayload(data) as payload:
+            self.assertEqual(payload.size, len(data))
+            self.assertEqual(PackerConfig.from_wire(SharedPayload.read(payload.path)).json(), self.config.json())
+        self.assertFalse(os.path.exists(payload.path))
+        with tempfile.TemporaryDirectory() as tmpdir, SharedPayload(b"", directory=tmpdir) as payload:
+            self.assertEqual(SharedPayload.read(payload.path), b"")
+
+    def test_builder_from_wire(self):
+        with patch.object(PackerClient, "verify_packer_installation"):
+            builder = PackerBuilder.from_wire(self.config.to_wire(), env={"PKR_VAR_size": "large"})
+        self.assertTrue(builder.configured)
+        self.assertEqual(builder.config.config_name, "wire")
+        self.assertEqual(builder.config.env["PKR_VAR_region"], "eu-west-1")
+        self.assertEqual(builder.config.env["PKR_VAR_size"], "large")
+        self.assertEqual(builder.config.json(), self.config.json())